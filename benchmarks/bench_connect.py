@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+"""End-to-end connect benchmark of odrd.
+
+Starts a fake DHCP server and a fake OpenVPN management console, runs odrd
+against them and fires client connects at odrd's command socket, the same
+way the connect hook does.  A connect counts as complete once odrd has
+written the deferred return value.  Reports connects per second, connect
+latencies and odrd's CPU time and memory.  The CPU time and memory of DHCP
+worker processes (option dhcp_workers) are not included.
+
+Needs to run as root (or with CAP_NET_BIND_SERVICE), as the fake DHCP server
+has to answer from port 67.  Example:
+
+    python3 benchmarks/bench_connect.py --clients 2000 --concurrency 200 \\
+        --latency 0.005 --loss 0.01
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from fakedhcp import FakeDhcpServer  # noqa: E402
+from fakeovpn import FakeOvpnMgmtServer  # noqa: E402
+from odr.hookclient import CC_RET_DEFERRED, CC_RET_SUCCEEDED, send_command  # noqa: E402
+
+CONFIG = """\
+[daemon]
+cmd_sockets = {tmpdir}/cmd.sock
+cmd_socket_uids = {uid}
+default_realm = bench
+secret = bench
+{daemon_options}
+
+[ovpn-server bench]
+mgmt_socket = {tmpdir}/mgmt.sock
+
+[realm bench]
+dhcp_listening_ip = {local_ip}
+dhcp_local_port = {local_port}
+dhcp_server_ips = {server_ip}
+expected_dhcp_lease_time = 3600
+"""
+
+
+def proc_stats(pid):
+    """@return: Returns the process' CPU time in seconds and its current and
+        peak resident set size in KiB.
+    """
+    with open('/proc/{}/stat'.format(pid)) as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    cpu = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    mem = {}
+    with open('/proc/{}/status'.format(pid)) as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            if key in ('VmRSS', 'VmHWM'):
+                mem[key] = int(value.split()[0])
+    return cpu, mem.get('VmRSS', 0), mem.get('VmHWM', 0)
+
+
+def wait_for_socket(path, proc, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not os.path.exists(path):
+        if proc.poll() is not None:
+            raise RuntimeError('odrd exited with {}'.format(proc.returncode))
+        if time.monotonic() > deadline:
+            raise RuntimeError('odrd did not create {}'.format(path))
+        time.sleep(0.05)
+
+
+def connect(index, tmpdir, socket_path, timeout):
+    """Performs a single connect like the connect hook and waits for odrd's
+    answer.
+
+    @return: Returns the connect's latency in seconds and its result.
+    """
+    ret_path = os.path.join(tmpdir, 'ret', str(index))
+    cfg_path = os.path.join(tmpdir, 'cfg', str(index))
+    with open(ret_path, 'w+') as ret_f, open(cfg_path, 'w') as cfg_f:
+        ret_f.write(str(CC_RET_DEFERRED))
+        ret_f.flush()
+        start = time.monotonic()
+        status = send_command(
+            'request',
+            {
+                'full_username': 'client{}@bench'.format(index),
+                'ret_file_idx': '0',
+                'config_file_idx': '1',
+                'daemon_name': 'bench',
+            },
+            fds=[ret_f.fileno(), cfg_f.fileno()],
+            socket_path=socket_path,
+        )
+        if status != 'OK':
+            return time.monotonic() - start, 'rejected'
+        deadline = start + timeout
+        while True:
+            ret = os.pread(ret_f.fileno(), 1, 0)
+            if ret and ret != str(CC_RET_DEFERRED).encode():
+                break
+            if time.monotonic() > deadline:
+                return time.monotonic() - start, 'timeout'
+            time.sleep(0.001)
+    result = 'ok' if ret == str(CC_RET_SUCCEEDED).encode() else 'failed'
+    return time.monotonic() - start, result
+
+
+def percentile(values, p):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=100)
+    parser.add_argument(
+        '--latency', type=float, default=0.0, help='DHCP server latency in seconds'
+    )
+    parser.add_argument(
+        '--loss', type=float, default=0.0, help='ratio of dropped DHCP packets'
+    )
+    parser.add_argument(
+        '--nack', type=float, default=0.0, help='ratio of NACKed DHCP REQUESTs'
+    )
+    parser.add_argument('--server-ip', default='127.0.0.2')
+    parser.add_argument('--local-ip', default='127.0.0.1')
+    parser.add_argument('--local-port', type=int, default=1067)
+    parser.add_argument(
+        '--timeout', type=float, default=60, help='maximum wait per connect'
+    )
+    parser.add_argument(
+        '--daemon-option',
+        action='append',
+        default=[],
+        metavar='KEY=VALUE',
+        help='additional [daemon] option for odrd, may be repeated',
+    )
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp(prefix='odr-bench-')
+    os.mkdir(os.path.join(tmpdir, 'ret'))
+    os.mkdir(os.path.join(tmpdir, 'cfg'))
+    config_path = os.path.join(tmpdir, 'odr.conf')
+    with open(config_path, 'w') as f:
+        f.write(
+            CONFIG.format(
+                tmpdir=tmpdir,
+                uid=os.getuid(),
+                daemon_options='\n'.join(
+                    option.replace('=', ' = ', 1) for option in args.daemon_option
+                ),
+                local_ip=args.local_ip,
+                local_port=args.local_port,
+                server_ip=args.server_ip,
+            )
+        )
+
+    dhcp_server = FakeDhcpServer(
+        (args.server_ip, 67),
+        latency=args.latency,
+        loss=args.loss,
+        nack_ratio=args.nack,
+    )
+    dhcp_server.start()
+    mgmt_server = FakeOvpnMgmtServer(os.path.join(tmpdir, 'mgmt.sock'))
+    mgmt_server.start()
+
+    odrd = subprocess.Popen(
+        [sys.executable, '-m', 'odr.odrd', '-c', config_path, '--keep-user'],
+        cwd=ROOT,
+    )
+    try:
+        socket_path = os.path.join(tmpdir, 'cmd.sock')
+        wait_for_socket(socket_path, odrd)
+        cpu_before, _, _ = proc_stats(odrd.pid)
+
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            futures = [
+                executor.submit(connect, index, tmpdir, socket_path, args.timeout)
+                for index in range(args.clients)
+            ]
+            results = [future.result() for future in futures]
+        duration = time.monotonic() - start
+        cpu_after, rss, peak_rss = proc_stats(odrd.pid)
+    finally:
+        odrd.terminate()
+        odrd.wait()
+        mgmt_server.stop()
+        dhcp_server.stop()
+
+    latencies = [latency for latency, result in results if result == 'ok']
+    outcomes = {}
+    for _, result in results:
+        outcomes[result] = outcomes.get(result, 0) + 1
+
+    cpu = cpu_after - cpu_before
+    print('connects:      {} in {:.2f}s'.format(len(results), duration))
+    print(
+        'outcomes:      '
+        + ', '.join('{}={}'.format(k, v) for k, v in sorted(outcomes.items()))
+    )
+    print('connects/sec:  {:.1f}'.format(len(latencies) / duration))
+    print('latency p50:   {:.1f} ms'.format(percentile(latencies, 50) * 1000))
+    print('latency p99:   {:.1f} ms'.format(percentile(latencies, 99) * 1000))
+    print('odrd CPU:      {:.2f}s ({:.0f}%)'.format(cpu, 100 * cpu / duration))
+    print('odrd RSS:      {} KiB (peak {} KiB)'.format(rss, peak_rss))
+    print('DHCP server:   {}'.format(dict(dhcp_server.stats)))
+
+if __name__ == '__main__':
+    main()
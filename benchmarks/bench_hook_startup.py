@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+"""Measures the start-up cost of the OpenVPN hook per invocation.
+
+OpenVPN starts a new interpreter for every client connect and disconnect, so
+interpreter start-up and imports are paid once per client.  Each variant is
+run a number of times and the mean wall time per run is printed.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HOOK = os.path.join(ROOT, 'odr', 'hookclient.py')
+
+VARIANTS = [
+    ('python -c pass', [sys.executable, '-c', 'pass']),
+    ('python -S -c pass', [sys.executable, '-S', '-c', 'pass']),
+    ('python -S -c "import json"', [sys.executable, '-S', '-c', 'import json']),
+    ('import odr.ovpn (old hook)', [sys.executable, '-c', 'import odr.ovpn']),
+    ('python -S hookclient.py', [sys.executable, '-S', HOOK, 'usage']),
+]
+
+
+def bench(cmd, runs):
+    start = time.perf_counter()
+    for _ in range(runs):
+        subprocess.run(
+            cmd,
+            cwd=ROOT,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+    return (time.perf_counter() - start) / runs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--runs', type=int, default=50)
+    args = parser.parse_args()
+
+    for name, cmd in VARIANTS:
+        print('{:30} {:8.2f} ms'.format(name, bench(cmd, args.runs) * 1000))
+
+
+if __name__ == '__main__':
+    main()
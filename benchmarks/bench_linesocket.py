@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""Measures how fast LineSocket splits a large "status 2" reply into lines.
+
+A writer thread sends the fake management console's answer to "status 2"
+over a socket pair, while LineSocket.recvlines() is called until EOF, like
+the socket loop would.  For comparison, the same is done with the previous
+implementation, which read 1024 bytes per call into an immutable buffer.
+
+    python3 benchmarks/bench_linesocket.py --clients 50000 --runs 5
+"""
+
+import argparse
+import os
+import socket
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from fakeovpn import FakeOvpnMgmtServer, generate_clients  # noqa: E402
+from odr.linesocket import LineSocket  # noqa: E402
+
+
+class LegacyLineSocket(LineSocket):
+    """The previous recvlines() implementation."""
+
+    def __init__(self, socket):
+        super().__init__(socket)
+        self._in_buf = b''
+
+    def recvlines(self):
+        new_data = self._socket.recv(1024)
+        if len(new_data) == 0:
+            lines = self._in_buf.split(b'\n')
+            self._in_buf = b''
+            if lines == [b'']:
+                return None
+            return lines
+        self._in_buf += new_data.replace(b'\r\n', b'\n')
+        *lines, self._in_buf = self._in_buf.split(b'\n')
+        return [line + b'\n' for line in lines]
+
+
+def run(cls, dump):
+    """@return: Returns the wall time, the number of recvlines() calls and the
+        number of lines.
+    """
+    ours, theirs = socket.socketpair()
+    linesock = cls(ours)
+
+    def write():
+        theirs.sendall(dump)
+        theirs.close()
+
+    writer = threading.Thread(target=write)
+    start = time.perf_counter()
+    writer.start()
+    calls = 0
+    num_lines = 0
+    while True:
+        lines = linesock.recvlines()
+        calls += 1
+        if lines is None:
+            break
+        num_lines += len(lines)
+    duration = time.perf_counter() - start
+    writer.join()
+    linesock.close()
+    return duration, calls, num_lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--clients', type=int, default=50000)
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    server = FakeOvpnMgmtServer('/nonexistent')
+    server.clients = generate_clients(args.clients)
+    dump = server.status()
+    print('status dump:   {:8.1f} KiB'.format(len(dump) / 1024))
+
+    for name, cls in (('previous', LegacyLineSocket), ('current', LineSocket)):
+        results = [run(cls, dump) for _ in range(args.runs)]
+        duration, calls, num_lines = min(results)
+        print(
+            '{:9s}      {:8.1f} ms, {:6d} calls, {} lines, {:.0f} MiB/s'.format(
+                name + ':',
+                duration * 1000,
+                calls,
+                num_lines,
+                len(dump) / duration / 2 ** 20,
+            )
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""Measures the cost of syncing odrd's client list with a large server.
+
+Runs a fake OpenVPN management console with a synthetic client list in a
+separate process and lets an OvpnClientManager poll it via "status 2".  The
+first poll detects all clients, the following polls find the list
+unchanged, as in a steady state.  Reports the CPU time of each poll and, in
+an additional poll traced with tracemalloc, the peak memory allocated while
+polling.
+
+    python3 benchmarks/bench_status_poll.py --clients 50000 --polls 5
+"""
+
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from fakeovpn import FakeOvpnMgmtServer, generate_clients  # noqa: E402
+from odr.odrd import OvpnClientManager  # noqa: E402
+from odr.ovpn import OvpnServer  # noqa: E402
+from odr.parse import ParseUsername  # noqa: E402
+from odr.realmdata import RealmData  # noqa: E402
+from odr.refreshscheduler import RefreshScheduler  # noqa: E402
+from odr.socketloop import SocketLoop  # noqa: E402
+from odr.timeoutmgr import TimeoutManager  # noqa: E402
+
+
+def serve(path, clients, ready):
+    server = FakeOvpnMgmtServer(path)
+    server.clients = clients
+    server.start()
+    ready.set()
+    while True:
+        time.sleep(3600)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--clients', type=int, default=50000)
+    parser.add_argument('--polls', type=int, default=5)
+    parser.add_argument(
+        '--pending-ratio',
+        type=float,
+        default=0.0,
+        help='ratio of clients without virtual address',
+    )
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(prefix='odr-bench-'), 'mgmt.sock')
+    ready = multiprocessing.Event()
+    fake = multiprocessing.Process(
+        target=serve,
+        args=(
+            path,
+            generate_clients(args.clients, pending_ratio=args.pending_ratio),
+            ready,
+        ),
+        daemon=True,
+    )
+    fake.start()
+    ready.wait()
+
+    sloop = SocketLoop()
+    timeout_mgr = TimeoutManager()
+    sloop.add_idle_handler(timeout_mgr.check_timeouts)
+    sloop.set_deadline_clb(timeout_mgr.next_timeout_time)
+
+    realm_data = RealmData('bench')
+    realm_data.dhcp_listening_ip = '127.0.0.1'
+    realm_data.dhcp_server_ips = ['127.0.0.2']
+    server = OvpnServer(sloop, name='bench', socket_fn=path)
+    client_mgr = OvpnClientManager(
+        timeout_mgr=timeout_mgr,
+        realms_data={'bench': realm_data},
+        parse_username_clb=ParseUsername(default_realm='bench').parse_username,
+        servers={'bench': server},
+        # The detected clients' refreshes are never started.
+        refresh_scheduler=RefreshScheduler(timeout_mgr, lambda **kwargs: None),
+        sync_interval=3600,
+    )
+
+    finish_sync = client_mgr._finish_sync
+
+    def poll(start_sync=True):
+        """Runs a single poll and returns its CPU time."""
+        done = []
+
+        def on_list_done(*args, **kwargs):
+            finish_sync(*args, **kwargs)
+            done.append(time.thread_time())
+            sloop.quit()
+
+        client_mgr._finish_sync = on_list_done
+        start = time.thread_time()
+        if start_sync:
+            client_mgr.sync_clients()
+        sloop._run = True
+        sloop.run()
+        assert done, 'poll did not complete'
+        return done[0] - start
+
+    # The manager's own initial sync is started by the first loop run.
+    print('initial poll:  {:8.1f} ms'.format(poll(start_sync=False) * 1000))
+    times = [poll() for _ in range(args.polls)]
+    print(
+        'steady poll:   {:8.1f} ms (min {:.1f} ms, {:.1f} us per client)'.format(
+            sum(times) / len(times) * 1000,
+            min(times) * 1000,
+            min(times) / args.clients * 1e6,
+        )
+    )
+
+    tracemalloc.start()
+    base, _ = tracemalloc.get_traced_memory()
+    poll()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(
+        'poll memory:   {:8.1f} KiB peak, {:.1f} KiB retained'.format(
+            (peak - base) / 1024, (current - base) / 1024
+        )
+    )
+    print('tracked:       {:8d} clients'.format(len(client_mgr._clients_by_username)))
+    fake.terminate()
+
+
+if __name__ == '__main__':
+    main()
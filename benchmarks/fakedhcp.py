@@ -0,0 +1,187 @@
+"""A fake DHCP server for load tests.
+
+Answers DHCP DISCOVERs with OFFERs and REQUESTs with ACKs (or NACKs) like a
+DHCP server that serves relay agents.  Answers are sent back to the address
+the request came from, after a configurable latency.  Requests can be dropped
+randomly to simulate packet loss.
+
+The server runs on its own thread.  As odr's requestors only accept answers
+from port 67, binding the server needs root or CAP_NET_BIND_SERVICE.
+"""
+
+import collections
+import heapq
+import itertools
+import random
+import selectors
+import socket
+import threading
+import time
+
+from ipaddress import IPv4Address, IPv4Network
+from typing import Dict, List, Tuple
+
+from odr.dhcppacket import (
+    BOOTREPLY,
+    BOOTREQUEST,
+    DHCP_ACK,
+    DHCP_DISCOVER,
+    DHCP_NACK,
+    DHCP_OFFER,
+    DHCP_REQUEST,
+    DhcpPacket,
+)
+
+# Header fields copied from the request into the answer.
+_COPIED_FIELDS = ('htype', 'hlen', 'xid', 'flags', 'giaddr', 'chaddr')
+
+
+class FakeDhcpServer:
+    """Serves leases from a subnet.  Each client identifier always gets the
+    same address.
+
+    The counters in stats are updated by the server's thread: "received",
+    "dropped", "offer", "ack" and "nack".
+    """
+
+    def __init__(
+        self,
+        address: Tuple[str, int] = ('127.0.0.2', 67),
+        latency: float = 0.0,
+        loss: float = 0.0,
+        nack_ratio: float = 0.0,
+        subnet: str = '10.128.0.0/10',
+        lease_time: int = 3600,
+    ) -> None:
+        """\
+        @param address: Address to listen on.
+        @param latency: Seconds to wait before answering.
+        @param loss: Ratio of requests that are dropped.
+        @param nack_ratio: Ratio of REQUESTs that are answered with a NACK.
+        @param subnet: Subnet the leases are taken from.
+        @param lease_time: Lease time in seconds.
+        """
+        self._address = address
+        self._latency = latency
+        self._loss = loss
+        self._nack_ratio = nack_ratio
+        self._lease_time = lease_time
+        self._network = IPv4Network(subnet)
+        self._hosts = self._network.hosts()
+        self._leases = {}  # type: Dict[bytes, IPv4Address]
+        # Heap of answers waiting for their latency to pass.
+        self._pending = []  # type: List[Tuple[float, int, bytes, Tuple[str, int]]]
+        self._seq = itertools.count()
+        self._sock = None  # type: socket.socket
+        self._thread = None  # type: threading.Thread
+        self._running = False
+        self.stats = collections.Counter()  # type: collections.Counter
+
+    def start(self) -> None:
+        """Binds the server's socket and starts its thread.
+        """
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind(self._address)
+        self._sock.setblocking(False)
+        self._running = True
+        self._thread = threading.Thread(
+            target=self._run, name='fakedhcp', daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stops the server's thread and closes its socket.
+        """
+        self._running = False
+        self._thread.join()
+        self._sock.close()
+
+    def _run(self) -> None:
+        selector = selectors.DefaultSelector()
+        selector.register(self._sock, selectors.EVENT_READ)
+        while self._running:
+            timeout = 0.05
+            if self._pending:
+                timeout = min(timeout, max(0, self._pending[0][0] - time.monotonic()))
+            if selector.select(timeout):
+                self._receive()
+            self._send_due()
+        selector.close()
+
+    def _receive(self) -> None:
+        while True:
+            try:
+                data, addr = self._sock.recvfrom(2048)
+            except BlockingIOError:
+                return
+            self.stats['received'] += 1
+            if self._loss > 0 and random.random() < self._loss:
+                self.stats['dropped'] += 1
+                continue
+            answer = self._answer(DhcpPacket.decode(data, addr))
+            if answer is None:
+                continue
+            if self._latency > 0:
+                heapq.heappush(
+                    self._pending,
+                    (time.monotonic() + self._latency, next(self._seq), answer, addr),
+                )
+            else:
+                self._send(answer, addr)
+
+    def _send_due(self) -> None:
+        now = time.monotonic()
+        while self._pending and self._pending[0][0] <= now:
+            _, _, answer, addr = heapq.heappop(self._pending)
+            self._send(answer, addr)
+
+    def _send(self, answer: bytes, addr: Tuple[str, int]) -> None:
+        try:
+            self._sock.sendto(answer, addr)
+        except BlockingIOError:
+            self.stats['send_failed'] += 1
+
+    def _lease_for(self, client_identifier: bytes) -> IPv4Address:
+        address = self._leases.get(client_identifier)
+        if address is None:
+            address = self._leases[client_identifier] = next(self._hosts)
+        return address
+
+    def _answer(self, request: DhcpPacket) -> bytes:
+        """@return: Returns the encoded answer to the request or None.
+        """
+        if not request.is_dhcp_packet() or request.get_option('op')[0] != BOOTREQUEST:
+            return None
+        message_type = request.message_type
+        client_identifier = request.get_option('client_identifier')
+        if message_type == DHCP_DISCOVER:
+            answer_type = DHCP_OFFER
+        elif message_type == DHCP_REQUEST:
+            if self._nack_ratio > 0 and random.random() < self._nack_ratio:
+                answer_type = DHCP_NACK
+            else:
+                answer_type = DHCP_ACK
+        else:
+            return None
+
+        answer = DhcpPacket()
+        answer.set_option('op', bytes([BOOTREPLY]))
+        for field in _COPIED_FIELDS:
+            answer.set_option(field, request.get_option(field))
+        answer.set_option('dhcp_message_type', bytes([answer_type]))
+        answer.set_option(
+            'server_identifier', IPv4Address(self._address[0]).packed
+        )
+        if answer_type == DHCP_NACK:
+            self.stats['nack'] += 1
+            return answer.encode()
+
+        answer.set_option('yiaddr', self._lease_for(client_identifier).packed)
+        answer.set_option('subnet_mask', self._network.netmask.packed)
+        answer.set_option('router', next(self._network.hosts()).packed)
+        answer.set_option('domain_name_server', IPv4Address('10.0.0.53').packed)
+        answer.set_option('domain_name', b'bench.example')
+        answer.set_option('ip_address_lease_time', self._lease_time.to_bytes(4, 'big'))
+        self.stats['offer' if answer_type == DHCP_OFFER else 'ack'] += 1
+        return answer.encode()
@@ -0,0 +1,233 @@
+"""A fake OpenVPN management console for load tests.
+
+Listens on a UNIX socket and speaks just enough of the management protocol
+for odrd: the ">INFO" greeting, "status 2", "kill" and, for servers running
+with --management-client-auth, ">CLIENT:CONNECT" notifications and the
+"client-auth", "client-auth-nt" and "client-deny" commands.
+
+The clients listed by "status 2" are taken from the clients dictionary,
+which maps common names to virtual addresses.  Clients authorised via
+"client-auth" are added to it with the address of their "ifconfig-push"
+line.  generate_clients() creates synthetic client lists of any size.
+
+The server runs on its own thread.
+"""
+
+import itertools
+import os
+import selectors
+import socket
+import threading
+import time
+
+from ipaddress import IPv4Network
+from typing import Dict, List, Optional
+
+GREETING = (
+    b">INFO:OpenVPN Management Interface Version 1 -- type 'help' for more info\r\n"
+)
+
+
+def generate_clients(
+    count: int,
+    realm: str = 'bench',
+    subnet: str = '10.128.0.0/10',
+    pending_ratio: float = 0.0,
+) -> Dict[str, str]:
+    """Generates a synthetic client list.
+
+    @param count: Number of clients.
+    @param realm: Realm part of the clients' common names.
+    @param subnet: Subnet the clients' virtual addresses are taken from.
+    @param pending_ratio: Ratio of clients that have not been assigned a
+        virtual address yet.
+    @return: Returns a dictionary mapping common names to virtual addresses.
+    """
+    hosts = IPv4Network(subnet).hosts()
+    pending_every = int(1 / pending_ratio) if pending_ratio > 0 else 0
+    clients = {}
+    for index in range(count):
+        address = str(next(hosts))
+        if pending_every and index % pending_every == 0:
+            address = ''
+        clients['client{}@{}'.format(index, realm)] = address
+    return clients
+
+
+class _Connection:
+    def __init__(self, sock: socket.socket) -> None:
+        self.sock = sock
+        self.buf = b''
+        # Pending "client-auth" command: client ID and config lines.
+        self.auth_cid = None  # type: Optional[int]
+        self.auth_lines = []  # type: List[str]
+
+
+class FakeOvpnMgmtServer:
+    """Stand-in for the management console of a single OpenVPN server.
+    """
+
+    def __init__(self, path: str) -> None:
+        """\
+        @param path: Path of the UNIX socket to listen on.
+        """
+        self._path = path
+        self.clients = {}  # type: Dict[str, str]
+        # Maps the client IDs of ">CLIENT:CONNECT" notifications to the
+        # client's common name.
+        self.connecting = {}  # type: Dict[int, str]
+        # Maps client IDs to "auth", "auth-nt" or "deny", once answered.
+        self.auth_results = {}  # type: Dict[int, str]
+        self._cids = itertools.count()
+        self._listener = None  # type: socket.socket
+        self._thread = None  # type: threading.Thread
+        self._running = False
+        # Serialises writes to the connections, as notifications may be sent
+        # from other threads.
+        self._send_lock = threading.Lock()
+        self._conns = {}  # type: Dict[socket.socket, _Connection]
+
+    def start(self) -> None:
+        """Creates the listening socket and starts the server's thread.
+        """
+        if os.path.exists(self._path):
+            os.unlink(self._path)
+        self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._listener.bind(self._path)
+        self._listener.listen(1)
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='fakeovpn', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stops the server's thread and removes the socket.
+        """
+        self._running = False
+        self._thread.join()
+        self._listener.close()
+        os.unlink(self._path)
+
+    def _send(self, conn: _Connection, data: bytes) -> None:
+        with self._send_lock:
+            conn.sock.sendall(data)
+
+    def _run(self) -> None:
+        selector = selectors.DefaultSelector()
+        selector.register(self._listener, selectors.EVENT_READ)
+        while self._running:
+            for key, _ in selector.select(0.05):
+                if key.fileobj is self._listener:
+                    sock, _ = self._listener.accept()
+                    conn = _Connection(sock)
+                    self._send(conn, GREETING)
+                    self._conns[sock] = conn
+                    selector.register(sock, selectors.EVENT_READ)
+                    continue
+                conn = self._conns[key.fileobj]
+                data = conn.sock.recv(65536)
+                if not data:
+                    selector.unregister(conn.sock)
+                    del self._conns[conn.sock]
+                    conn.sock.close()
+                    continue
+                *lines, conn.buf = (conn.buf + data).split(b'\n')
+                for line in lines:
+                    answer = self.handle_command(conn, line.rstrip(b'\r').decode())
+                    if answer:
+                        self._send(conn, answer)
+        for conn in self._conns.values():
+            conn.sock.close()
+        self._conns.clear()
+        selector.close()
+
+    def connect_client(self, common_name: str) -> int:
+        """Sends a ">CLIENT:CONNECT" notification for a new client to all
+        management connections.  May be called from any thread.
+
+        @return: Returns the client ID.
+        """
+        cid = next(self._cids)
+        self.connecting[cid] = common_name
+        notification = (
+            '>CLIENT:CONNECT,{},0\r\n'
+            '>CLIENT:ENV,common_name={}\r\n'
+            '>CLIENT:ENV,END\r\n'.format(cid, common_name).encode()
+        )
+        for conn in list(self._conns.values()):
+            self._send(conn, notification)
+        return cid
+
+    def handle_command(self, conn: _Connection, cmd: str) -> bytes:
+        """@return: Returns the console's complete answer to the command.
+        """
+        if conn.auth_cid is not None:
+            # Config lines of a "client-auth" command.
+            if cmd != 'END':
+                conn.auth_lines.append(cmd)
+                return b''
+            self._authorise(conn.auth_cid, conn.auth_lines)
+            conn.auth_cid = None
+            conn.auth_lines = []
+            return b'SUCCESS: client-auth command succeeded\r\n'
+
+        if cmd == 'status 2':
+            return self.status()
+        if cmd.startswith('kill '):
+            common_name = cmd[len('kill ') :].strip('"')
+            if self.clients.pop(common_name, None) is None:
+                return b'ERROR: common name \'%s\' not found\r\n' % common_name.encode()
+            return b'SUCCESS: common name \'%s\' found, 1 client(s) killed\r\n' % (
+                common_name.encode()
+            )
+
+        name, _, args = cmd.partition(' ')
+        if name in ('client-auth', 'client-auth-nt', 'client-deny'):
+            cid = int(args.split()[0])
+            if cid not in self.connecting:
+                return b'ERROR: client-auth command failed\r\n'
+            if name == 'client-auth':
+                conn.auth_cid = cid
+                return b''
+            if name == 'client-auth-nt':
+                self._authorise(cid, [])
+            else:
+                del self.connecting[cid]
+                self.auth_results[cid] = 'deny'
+            return ('SUCCESS: {} command succeeded\r\n'.format(name)).encode()
+        return b'ERROR: unknown command, enter \'help\' for more options\r\n'
+
+    def _authorise(self, cid: int, config_lines: List[str]) -> None:
+        common_name = self.connecting.pop(cid)
+        self.auth_results[cid] = 'auth' if config_lines else 'auth-nt'
+        address = ''
+        for line in config_lines:
+            if line.startswith('ifconfig-push '):
+                address = line.split()[1]
+        self.clients[common_name] = address
+
+    def status(self) -> bytes:
+        """@return: Returns the answer to "status 2".
+        """
+        now = int(time.time())
+        since = time.ctime(now)
+        lines = [
+            'TITLE,OpenVPN 2.4.7 x86_64-pc-linux-gnu',
+            'TIME,{},{}'.format(since, now),
+            'HEADER,CLIENT_LIST,Common Name,Real Address,Virtual Address,'
+            'Virtual IPv6 Address,Bytes Received,Bytes Sent,Connected Since,'
+            'Connected Since (time_t),Username,Client ID,Peer ID',
+        ]
+        client_line = 'CLIENT_LIST,{0},192.0.2.1:{1},{2},,1024,2048,{3},{4},{0},{5},{5}'
+        for cid, (common_name, address) in enumerate(list(self.clients.items())):
+            lines.append(
+                client_line.format(
+                    common_name, 1024 + cid % 60000, address, since, now, cid
+                )
+            )
+        lines.append(
+            'HEADER,ROUTING_TABLE,Virtual Address,Common Name,Real Address,'
+            'Last Ref,Last Ref (time_t)'
+        )
+        lines.append('GLOBAL_STATS,Max bcast/mcast queue length,0')
+        lines.append('END')
+        return ('\r\n'.join(lines) + '\r\n').encode()
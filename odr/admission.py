@@ -0,0 +1,284 @@
+"""Admission control for initial DHCP requests.
+
+Limits the number of initial DHCP requests in flight per realm and per
+requestor.  Requests beyond the limits wait in a queue per realm, ordered by
+priority and then by arrival.  Optionally, requests are rejected right away
+if their estimated wait exceeds a maximum, e.g. OpenVPN's hand-window, and
+waiting requests are failed once they have waited that long.
+"""
+
+import heapq
+import itertools
+import logging
+import time
+
+from functools import partial
+from typing import Any, Callable, Dict, List, Tuple
+
+from prometheus_client import Counter, Gauge, Histogram
+
+from odr.timeoutmgr import TimeoutManager
+
+M_ADMISSION_QUEUE_LENGTH = Gauge(
+    "dhcp_admission_queue_length",
+    "number of initial dhcp requests waiting for admission",
+    ("realm",),
+)
+M_ADMISSION_WAIT = Histogram(
+    "dhcp_admission_wait_seconds",
+    "time initial dhcp requests waited for admission",
+    ("realm",),
+)
+M_ADMISSION_REJECTED_COUNT = Counter(
+    "dhcp_admission_rejected_count",
+    "number of initial dhcp requests rejected due to overload",
+    ("realm",),
+)
+
+
+class _PendingRequest:
+    __slots__ = (
+        'priority',
+        'seq',
+        'realm',
+        'requestor_key',
+        'submit_time',
+        'start_time',
+        'success_handler',
+        'failure_handler',
+        'kwargs',
+        'timeout',
+    )
+
+    def __init__(self, priority, seq, realm, requestor_key, success, failure, kwargs):
+        self.priority = priority
+        self.seq = seq
+        self.realm = realm
+        self.requestor_key = requestor_key
+        self.submit_time = time.time()
+        self.start_time = None  # type: Any
+        self.success_handler = success
+        self.failure_handler = failure
+        self.kwargs = kwargs
+        self.timeout = None  # type: Any
+
+    def __lt__(self, other: "_PendingRequest") -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class AdmissionController:
+    """Starts initial DHCP requests, as long as the in-flight limits allow.
+    Otherwise the requests are queued.  Lower priority values are admitted
+    first.
+
+    A limit of 0 means no limit.
+    """
+
+    # Weight of the latest request duration in the average duration.
+    DURATION_WEIGHT = 0.2
+
+    def __init__(
+        self,
+        start_request_clb: Callable[..., bool],
+        timeout_mgr: TimeoutManager,
+        max_in_flight_per_realm: int = 0,
+        max_in_flight_per_requestor: int = 0,
+        max_wait: float = 0,
+    ) -> None:
+        """\
+        @param start_request_clb: Call-back that starts an initial DHCP
+            request.  Returns False if the request could not be started.
+        @param timeout_mgr: Instance of the timeout manager.  Used to fail
+            requests that waited for too long.
+        @param max_in_flight_per_realm: Maximum number of requests in flight
+            per realm.
+        @param max_in_flight_per_requestor: Maximum number of requests in
+            flight per requestor, i.e. DHCP listening address.
+        @param max_wait: Maximum time in seconds a request may wait for
+            admission.
+        """
+        self._log = logging.getLogger('admissionctrl')
+        self._start_request = start_request_clb
+        self._timeout_mgr = timeout_mgr
+        self._max_per_realm = max_in_flight_per_realm
+        self._max_per_requestor = max_in_flight_per_requestor
+        self._max_wait = max_wait
+        self._seq = itertools.count()
+        self._in_flight_by_realm = {}  # type: Dict[str, int]
+        self._in_flight_by_requestor = {}  # type: Dict[Tuple[str, str], int]
+        # Maps realm names to heaps of waiting requests.
+        self._queues = {}  # type: Dict[str, List[_PendingRequest]]
+        # Average time a request is in flight.  Starts with a guess.
+        self._avg_duration = 1.0
+        self._dispatching = False
+
+    def queue_length(self, realm: str) -> int:
+        """@return: Returns the number of requests waiting for admission.
+        """
+        return len(self._queues.get(realm, ()))
+
+    def estimated_wait(self, realm: str) -> float:
+        """@return: Returns the estimated time in seconds a new request for
+            the realm would have to wait for admission.
+        """
+        queued = self.queue_length(realm)
+        if queued == 0 and self._realm_has_capacity(realm):
+            return 0.0
+        limit = self._max_per_realm or self._max_per_requestor or 1
+        return (queued + 1) * self._avg_duration / limit
+
+    def accepts(self, realm: str) -> bool:
+        """Checks whether a new request for the realm would be accepted.
+        Rejections are counted.
+
+        @return: Returns False if the estimated wait exceeds the maximum wait.
+        """
+        if self._max_wait <= 0 or self.estimated_wait(realm) <= self._max_wait:
+            return True
+        self._log.warning(
+            'rejecting request for realm "%s", estimated wait is %.1fs',
+            realm,
+            self.estimated_wait(realm),
+        )
+        M_ADMISSION_REJECTED_COUNT.labels(realm).inc()
+        return False
+
+    def submit(
+        self,
+        realm: str,
+        success_handler_clb: Callable[[Dict[str, Any]], None],
+        failure_handler_clb: Callable[[], None],
+        priority: int = 0,
+        **kwargs
+    ) -> None:
+        """Starts the request now or as soon as the limits allow.  The keyword
+        arguments are passed on to the start request call-back, together with
+        the realm, and need to include device and local_ip.
+
+        @param realm: Name of the realm the request is for.
+        @param success_handler_clb: Called with the request's result in case
+            the request succeeded.
+        @param failure_handler_clb: Called in case the request failed or
+            waited for too long.
+        @param priority: Requests with lower values are admitted first.
+        """
+        entry = _PendingRequest(
+            priority,
+            next(self._seq),
+            realm,
+            (kwargs['device'], kwargs['local_ip']),
+            success_handler_clb,
+            failure_handler_clb,
+            kwargs,
+        )
+        queue = self._queues.setdefault(realm, [])
+        heapq.heappush(queue, entry)
+        M_ADMISSION_QUEUE_LENGTH.labels(realm).inc()
+        if self._max_wait > 0:
+            entry.timeout = self._timeout_mgr.add_abs_timeout(
+                entry.submit_time + self._max_wait, partial(self._expire, entry)
+            )
+        self._dispatch()
+
+    def _realm_has_capacity(self, realm: str) -> bool:
+        return (
+            self._max_per_realm <= 0
+            or self._in_flight_by_realm.get(realm, 0) < self._max_per_realm
+        )
+
+    def _has_capacity(self, entry: _PendingRequest) -> bool:
+        return self._realm_has_capacity(entry.realm) and (
+            self._max_per_requestor <= 0
+            or self._in_flight_by_requestor.get(entry.requestor_key, 0)
+            < self._max_per_requestor
+        )
+
+    def _dispatch(self) -> None:
+        """Starts waiting requests as long as the limits allow.  The realms'
+        queues are served in the order of their first request.
+        """
+        if self._dispatching:
+            # Requests that finish while being started are picked up by the
+            # running loop.
+            return
+        self._dispatching = True
+        try:
+            while True:
+                candidates = [
+                    queue[0]
+                    for queue in self._queues.values()
+                    if queue and self._has_capacity(queue[0])
+                ]
+                if not candidates:
+                    return
+                entry = min(candidates)
+                heapq.heappop(self._queues[entry.realm])
+                M_ADMISSION_QUEUE_LENGTH.labels(entry.realm).dec()
+                self._start(entry)
+        finally:
+            self._dispatching = False
+
+    def _expire(self, entry: _PendingRequest) -> None:
+        """Fails a request that is still waiting after the maximum wait.
+        """
+        entry.timeout = None
+        queue = self._queues[entry.realm]
+        queue.remove(entry)
+        heapq.heapify(queue)
+        M_ADMISSION_QUEUE_LENGTH.labels(entry.realm).dec()
+        waited = time.time() - entry.submit_time
+        M_ADMISSION_WAIT.labels(entry.realm).observe(waited)
+        self._log.warning(
+            'request for realm "%s" waited %.1fs, giving up', entry.realm, waited
+        )
+        entry.failure_handler()
+
+    def _start(self, entry: _PendingRequest) -> None:
+        if entry.timeout is not None:
+            self._timeout_mgr.del_timeout_object(entry.timeout)
+            entry.timeout = None
+        now = time.time()
+        waited = now - entry.submit_time
+        M_ADMISSION_WAIT.labels(entry.realm).observe(waited)
+        if self._max_wait > 0 and waited > self._max_wait:
+            self._log.warning(
+                'request for realm "%s" waited %.1fs, giving up', entry.realm, waited
+            )
+            entry.failure_handler()
+            return
+
+        entry.start_time = now
+        self._in_flight_by_realm[entry.realm] = (
+            self._in_flight_by_realm.get(entry.realm, 0) + 1
+        )
+        self._in_flight_by_requestor[entry.requestor_key] = (
+            self._in_flight_by_requestor.get(entry.requestor_key, 0) + 1
+        )
+        try:
+            started = self._start_request(
+                success_handler_clb=lambda res: self._finish(
+                    entry, entry.success_handler, res
+                ),
+                failure_handler_clb=lambda: self._finish(entry, entry.failure_handler),
+                realm=entry.realm,
+                **entry.kwargs
+            )
+        except Exception:
+            self._log.exception('Adding a new DHCP request failed')
+            started = False
+        if not started:
+            self._finish(entry, entry.failure_handler)
+
+    def _finish(self, entry: _PendingRequest, handler: Callable, *args) -> None:
+        if entry.start_time is None:
+            # Already finished.
+            return
+        duration = time.time() - entry.start_time
+        entry.start_time = None
+        self._avg_duration += self.DURATION_WEIGHT * (duration - self._avg_duration)
+        self._in_flight_by_realm[entry.realm] -= 1
+        self._in_flight_by_requestor[entry.requestor_key] -= 1
+        try:
+            handler(*args)
+        finally:
+            self._dispatch()
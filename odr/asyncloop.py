@@ -0,0 +1,259 @@
+"""Runs odr's socket handlers and timeouts on an asyncio event loop.
+
+This is an adapter: The existing socket handlers, idle handlers and timeout
+objects are registered with the event loop through add_reader() and call_at().
+The components themselves are unchanged, they don't run as asyncio protocols
+or tasks, don't use asyncio's transports and DHCP requests are not awaitable.
+What the adapter provides is asyncio's (or uvloop's) event loop and timer
+implementation underneath the existing call-back interfaces.
+
+The handler duration and loop lag metrics of odr.socketloop are recorded as
+well.  The lag is measured for each timer, as the loop has no single deadline.
+"""
+
+import asyncio
+import logging
+import time
+
+from typing import Any, Callable, Dict
+
+from odr.socketloop import M_HANDLER_DURATION, M_LOOP_LAG, _handler_name
+from odr.timeoutmgr import TimeoutObject
+
+
+def new_event_loop(use_uvloop: bool = False) -> asyncio.AbstractEventLoop:
+    """Create a new asyncio event loop.
+
+    @param use_uvloop: Use uvloop's event loop implementation.
+    @raises ImportError: If uvloop was requested but is not available.
+    """
+    if use_uvloop:
+        import uvloop
+
+        return uvloop.new_event_loop()
+    return asyncio.new_event_loop()
+
+
+class AsyncioSocketLoop:
+    """Provides the interface of odr.socketloop.SocketLoop on top of an
+    asyncio event loop.  Each handler's socket is registered as a reader with
+    the event loop.
+
+    Idle handlers are called once after each batch of socket activity or
+    timeouts, i.e. as soon as the event loop has run all ready call-backs.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop = None) -> None:
+        """\
+        @param loop: The asyncio event loop to run on.  Defaults to a new
+            event loop.
+        """
+        if loop is None:
+            loop = asyncio.new_event_loop()
+        self._loop = loop
+        # Maps file descriptors to socket handlers.
+        self._socket_handlers = {}  # type: Dict[int, Any]
+        self._handler_fds = {}  # type: Dict[int, int]
+        self._idle_handlers = []
+        self._idle_scheduled = False
+        # Handler calls taking longer are logged.  0 disables the logging.
+        self.slow_handler_threshold = 0.0
+        # Maps handler names to their duration metric.
+        self._handler_metrics = {}  # type: Dict[str, Any]
+        self.log = logging.getLogger('asyncsocketloop')
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        """@return: Returns the underlying asyncio event loop.
+        """
+        return self._loop
+
+    def _handle_socket(self, fd: int) -> None:
+        socket_handler = self._socket_handlers.get(fd)
+        if socket_handler is None:
+            return
+        start = time.monotonic()
+        try:
+            socket_handler.handle_socket()
+        except Exception:
+            self.log.exception('socket handler failed, removing')
+            self.del_socket_handler(socket_handler)
+        self.record_duration(type(socket_handler).__name__, start)
+        self.schedule_idle()
+
+    def _handle_idle_handlers(self) -> None:
+        self._idle_scheduled = False
+        for idle_handler in self._idle_handlers[:]:
+            start = time.monotonic()
+            try:
+                idle_handler()
+            except Exception:
+                self.log.exception('idle handler failed, removing')
+                self.del_idle_handler(idle_handler)
+            self.record_duration(_handler_name(idle_handler), start)
+
+    def record_duration(self, name: str, start: float) -> None:
+        """Records the duration of a handler call, like SocketLoop does.
+
+        @param name: Name of the handler, used as metrics label.
+        @param start: Start of the call, as returned by time.monotonic().
+        """
+        duration = time.monotonic() - start
+        metric = self._handler_metrics.get(name)
+        if metric is None:
+            metric = self._handler_metrics[name] = M_HANDLER_DURATION.labels(name)
+        metric.observe(duration)
+        if 0 < self.slow_handler_threshold <= duration:
+            self.log.warning('slow handler %s took %.3fs', name, duration)
+
+    def schedule_idle(self) -> None:
+        """Make sure the idle handlers get called once the currently ready
+        call-backs have run.
+        """
+        if not self._idle_scheduled:
+            self._idle_scheduled = True
+            self._loop.call_soon(self._handle_idle_handlers)
+
+    def run(self) -> None:
+        """Runs the event loop until the quit method is called.
+        """
+        self._loop.run_forever()
+
+    def add_socket_handler(self, socket_handler) -> None:
+        """Add an additional socket handler.
+        @param socket_handler: The socket handler instance to add.
+        """
+        fd = socket_handler.socket.fileno()
+        self.log.debug('adding socket_handler for socket %d', fd)
+        self._loop.add_reader(fd, self._handle_socket, fd)
+        self._socket_handlers[fd] = socket_handler
+        self._handler_fds[id(socket_handler)] = fd
+
+    def del_socket_handler(self, socket_handler) -> None:
+        """Remove a previously added socket handler.
+        @param socket_handler: The socket handler instance to remove.  Removing
+            a handler that is not registered (anymore) is a no-op.
+        """
+        fd = self._handler_fds.pop(id(socket_handler), None)
+        if fd is None:
+            return
+        self.log.debug('removing socket_handler for socket %d', fd)
+        self._loop.remove_reader(fd)
+        del self._socket_handlers[fd]
+
+    def add_idle_handler(self, idle_handler) -> None:
+        """Add an idle handler.
+        @param idle_handler: The idle handler instance to add.
+        """
+        self.log.debug('adding idle_handler')
+        self._idle_handlers.append(idle_handler)
+
+    def del_idle_handler(self, idle_handler) -> None:
+        """Remove a previously added idle handler.
+        @param idle_handler: The idle handler instance to remove.
+        """
+        self.log.debug('removing idle_handler')
+        self._idle_handlers.remove(idle_handler)
+
+    def _call_from_thread(self, clb: Callable[[], None]) -> None:
+        try:
+            clb()
+        except Exception:
+            self.log.exception('call-back from thread failed')
+        self.schedule_idle()
+
+    def call_from_thread(self, clb: Callable[[], None]) -> None:
+        """Have a call-back called by the event loop's thread.  May be called
+        from any thread.
+        @param clb: The call-back, called without arguments.
+        """
+        self._loop.call_soon_threadsafe(self._call_from_thread, clb)
+
+    def set_deadline_clb(self, deadline_clb) -> None:
+        """Only provided for interface compatibility.  The event loop keeps
+        track of its own deadlines.
+        """
+
+    @property
+    def sockets(self):
+        """@return: Returns the list of sockets that we have handlers for.
+        """
+        return [handler.socket for handler in self._socket_handlers.values()]
+
+    def quit(self) -> None:
+        """Request that the event loop be stopped soon.  May be called from a
+        signal handler.
+        """
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+
+class AsyncioTimeoutManager:
+    """Provides the interface of odr.timeoutmgr.TimeoutManager on top of the
+    timers of an asyncio event loop.
+
+    Timeout times are absolute wall-clock times, as with TimeoutManager.  They
+    are converted to the event loop's clock when the timeout object is added.
+
+    As with TimeoutManager, exceptions raised by timeout handlers are not
+    caught.  They propagate to the event loop, which logs them.
+    """
+
+    def __init__(self, sloop: AsyncioSocketLoop) -> None:
+        """\
+        @param sloop: The socket loop whose event loop the timers run on.
+        """
+        self._sloop = sloop
+        self._loop = sloop.loop
+        # Maps id(timeout object) to its timer handle.
+        self._handles = {}  # type: Dict[int, asyncio.TimerHandle]
+
+    def add_rel_timeout(
+        self, timeout_secs: float, timeout_func: Callable[[], None]
+    ) -> TimeoutObject:
+        """See TimeoutManager.add_rel_timeout."""
+        return self.add_abs_timeout(time.time() + timeout_secs, timeout_func)
+
+    def add_abs_timeout(
+        self, timeout_time: float, timeout_func: Callable[[], None]
+    ) -> TimeoutObject:
+        """See TimeoutManager.add_abs_timeout."""
+        obj = TimeoutObject(timeout_time, timeout_func)
+        self.add_timeout_object(obj)
+        return obj
+
+    def add_timeout_object(self, timeout_object) -> None:
+        """See TimeoutManager.add_timeout_object."""
+        when = self._loop.time() + (timeout_object.timeout_time - time.time())
+        self._handles[id(timeout_object)] = self._loop.call_at(
+            when, self._handle_timeout, timeout_object
+        )
+
+    def del_timeout_object(self, timeout_object) -> None:
+        """See TimeoutManager.del_timeout_object."""
+        try:
+            handle = self._handles.pop(id(timeout_object))
+        except KeyError:
+            raise ValueError('unknown timeout object {!r}'.format(timeout_object))
+        handle.cancel()
+
+    def _handle_timeout(self, timeout_object) -> None:
+        handle = self._handles.pop(id(timeout_object))
+        M_LOOP_LAG.observe(max(0.0, self._loop.time() - handle.when()))
+        start = time.monotonic()
+        try:
+            timeout_object.handle_timeout()
+        finally:
+            self._sloop.record_duration(_handler_name(self._handle_timeout), start)
+            self._sloop.schedule_idle()
+
+    def check_timeouts(self) -> None:
+        """Only provided for interface compatibility.  Timeouts are handled
+        by the event loop.
+        """
+
+    def next_timeout_time(self) -> None:
+        """Only provided for interface compatibility.  Timeouts are handled
+        by the event loop.
+        """
+        return None
+
@@ -18,62 +18,9 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import os
-import socket
-import json
-import odr.ovpn as ovpn
-from odr import fdsend
-
-SCRIPT_NAME = 'odr-ovpn-connect'
-CMD_SOCKET = '/var/run/odr/cmd.sock'
-
-
-def main():
-    #
-    # Gather configuration
-    #
-
-    cfg_f = open(os.environ['client_connect_config_file'], 'w')
-    ret_f = open(os.environ['client_connect_deferred_file'], 'w')
-    full_username = os.environ['username']
-    daemon_name = ovpn.determine_daemon_name(script_name=SCRIPT_NAME)
-
-    #
-    # Build and submit command
-    #
-
-    params = {
-        'full_username': full_username,
-        'ret_file_idx': '0',
-        'config_file_idx': '1',
-    }
-    if daemon_name is not None:
-        params['daemon_name'] = daemon_name
-
-    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-    sock.connect(CMD_SOCKET)
-
-    ovpn.write_deferred_ret_file(ret_f, ovpn.CC_RET_DEFERRED)
-    try:
-        result = {"cmd": "request"}
-        result.update(params)
-        fdsend.send_fds(
-            sock,
-            [json.dumps(result).encode("utf-8")],
-            fds=[ret_f.fileno(), cfg_f.fileno()],
-        )
-
-        data = sock.recv(1024)
-        if not data:
-            raise RuntimeError('no response from odr')
-
-        status = json.loads(data.decode("utf-8"))["cmd"]
-        if status != 'OK':
-            raise RuntimeError('starting dhcp request failed (ret: "%s")' % data)
-    except Exception:
-        ovpn.write_deferred_ret_file(ret_f, ovpn.CC_RET_FAILED)
-        raise
-
+# The hook's implementation lives in odr.hookclient, which can also be run
+# directly with "python3 -S" to avoid the start-up cost of the site module.
+from odr.hookclient import connect_main as main
 
 if __name__ == '__main__':
     main()
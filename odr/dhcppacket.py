@@ -0,0 +1,267 @@
+"""Dependency-free encoding and decoding of DHCP packets.
+
+The option names and the produced bytes match the subset of pydhcplib that
+odr used before: header fields and options are addressed by pydhcplib's names,
+values are byte strings, options are encoded in ascending order of their code
+and followed by the end option.
+"""
+
+import struct
+
+from typing import Dict, Optional, Tuple, Union
+
+BOOTREQUEST = 1
+BOOTREPLY = 2
+
+DHCP_DISCOVER = 1
+DHCP_OFFER = 2
+DHCP_REQUEST = 3
+DHCP_DECLINE = 4
+DHCP_ACK = 5
+DHCP_NACK = 6
+DHCP_RELEASE = 7
+DHCP_INFORM = 8
+
+MAGIC_COOKIE = b'\x63\x82\x53\x63'
+
+# Offset of the magic cookie, which is also the length of the BOOTP header.
+HEADER_LEN = 236
+# Offset of the first option.
+OPTIONS_OFFSET = HEADER_LEN + len(MAGIC_COOKIE)
+
+OPTION_PAD = 0
+OPTION_END = 255
+
+# Maps the names of the fixed BOOTP header fields to offset and length.
+HEADER_FIELDS = {
+    'op': (0, 1),
+    'htype': (1, 1),
+    'hlen': (2, 1),
+    'hops': (3, 1),
+    'xid': (4, 4),
+    'secs': (8, 2),
+    'flags': (10, 2),
+    'ciaddr': (12, 4),
+    'yiaddr': (16, 4),
+    'siaddr': (20, 4),
+    'giaddr': (24, 4),
+    'chaddr': (28, 16),
+    'sname': (44, 64),
+    'file': (108, 128),
+}  # type: Dict[str, Tuple[int, int]]
+
+# Maps the names of the supported DHCP options to their option code.
+OPTION_CODES = {
+    'subnet_mask': 1,
+    'router': 3,
+    'domain_name_server': 6,
+    'domain_name': 15,
+    'request_ip_address': 50,
+    'ip_address_lease_time': 51,
+    'dhcp_message_type': 53,
+    'server_identifier': 54,
+    'parameter_request_list': 55,
+    'renewal_time_value': 58,
+    'rebinding_time_value': 59,
+    'client_identifier': 61,
+    'relay_agent': 82,
+    'classless_static_route': 121,
+}  # type: Dict[str, int]
+
+_XID = struct.Struct('!I')
+_XID_OFFSET = HEADER_FIELDS['xid'][0]
+
+_OPT_MESSAGE_TYPE = OPTION_CODES['dhcp_message_type']
+
+SourceAddress = Tuple[str, int]
+
+
+class DhcpPacket:
+    """A DHCP packet.
+
+    Decoded packets keep a reference to the received data.  Header fields are
+    read directly from it; the options are indexed by offset on first access
+    and only copied when retrieved.
+
+    Packets can also be built by setting header fields and options and then
+    be encoded into their wire format.
+    """
+
+    __slots__ = ('source_address', '_data', '_option_index', '_options')
+
+    def __init__(self, source_address: Optional[SourceAddress] = None) -> None:
+        """Creates an empty packet with an all-zero header.
+
+        @param source_address: Address tuple the packet was received from.
+        """
+        self.source_address = source_address
+        data = bytearray(OPTIONS_OFFSET)
+        data[HEADER_LEN:OPTIONS_OFFSET] = MAGIC_COOKIE
+        self._data = memoryview(data)
+        # Maps option codes to offset and length of the option's value.
+        self._option_index = {}  # type: Optional[Dict[int, Tuple[int, int]]]
+        # Maps option codes to option values that were explicitly set.
+        self._options = {}  # type: Dict[int, bytes]
+
+    @classmethod
+    def decode(
+        cls,
+        data: Union[bytes, bytearray, memoryview],
+        source_address: Optional[SourceAddress] = None,
+    ) -> "DhcpPacket":
+        """Creates a packet from received data.  The data is not copied, so a
+        mutable buffer must not be modified while the packet is in use.
+
+        @param data: The packet's wire format.
+        @param source_address: Address tuple the packet was received from.
+        """
+        packet = cls.__new__(cls)
+        packet.source_address = source_address
+        packet._data = memoryview(data)
+        packet._option_index = None
+        packet._options = {}
+        return packet
+
+    def _index_options(self) -> Dict[int, Tuple[int, int]]:
+        """Determines offset and length of all options.  Later occurrences of
+        an option replace earlier ones.
+        """
+        index = {}  # type: Dict[int, Tuple[int, int]]
+        self._option_index = index
+        if not self.is_dhcp_packet():
+            return index
+        data = self._data
+        end = len(data)
+        pos = OPTIONS_OFFSET
+        while pos < end:
+            code = data[pos]
+            if code == OPTION_PAD:
+                pos += 1
+                continue
+            if code == OPTION_END or pos + 1 >= end:
+                break
+            length = data[pos + 1]
+            if pos + 2 + length > end:
+                # Truncated option.
+                break
+            index[code] = (pos + 2, length)
+            pos += 2 + length
+        return index
+
+    def is_dhcp_packet(self) -> bool:
+        """@return: Returns True if the packet carries the DHCP magic cookie.
+        """
+        return (
+            len(self._data) >= OPTIONS_OFFSET
+            and self._data[HEADER_LEN:OPTIONS_OFFSET] == MAGIC_COOKIE
+        )
+
+    @property
+    def xid(self) -> int:
+        """The transaction identifier."""
+        return _XID.unpack_from(self._data, _XID_OFFSET)[0]
+
+    @property
+    def message_type(self) -> Optional[int]:
+        """The DHCP message type or None if the packet has none."""
+        value = self.get_option(_OPT_MESSAGE_TYPE)
+        if len(value) != 1:
+            return None
+        return value[0]
+
+    def _option_code(self, name: Union[str, int]) -> int:
+        if isinstance(name, int):
+            return name
+        try:
+            return OPTION_CODES[name]
+        except KeyError:
+            raise KeyError('unknown DHCP option "{}"'.format(name))
+
+    def get_option(self, name: Union[str, int]) -> bytes:
+        """@param name: Name of a header field or name or code of an option.
+        @return: Returns the value of the header field or option.  Options
+            that are not present return an empty value.
+        """
+        field = HEADER_FIELDS.get(name)  # type: ignore
+        if field is not None:
+            offset, length = field
+            return bytes(self._data[offset : offset + length])
+
+        code = self._option_code(name)
+        if code in self._options:
+            return self._options[code]
+        index = self._option_index
+        if index is None:
+            index = self._index_options()
+        if code not in index:
+            return b''
+        offset, length = index[code]
+        return bytes(self._data[offset : offset + length])
+
+    def has_option(self, name: Union[str, int]) -> bool:
+        """@param name: Name of a header field or name or code of an option.
+        @return: Returns True for header fields and options that are present.
+        """
+        if name in HEADER_FIELDS:
+            return True
+        code = self._option_code(name)
+        if code in self._options:
+            return True
+        index = self._option_index
+        if index is None:
+            index = self._index_options()
+        return code in index
+
+    def set_option(self, name: str, value: bytes) -> None:
+        """Sets a header field or option.
+
+        @param name: Name of a header field or name or code of an option.
+        @param value: The new value.
+        @raises ValueError: If the value has the wrong length.
+        """
+        field = HEADER_FIELDS.get(name)  # type: ignore
+        if field is not None:
+            offset, length = field
+            if len(value) != length:
+                raise ValueError(
+                    'header field "{}" needs {} bytes, got {}'.format(
+                        name, length, len(value)
+                    )
+                )
+            if self._data.readonly:
+                self._data = memoryview(bytearray(self._data))
+            self._data[offset : offset + length] = value
+            return
+
+        if len(value) > 255:
+            raise ValueError('value of option "{}" is too long'.format(name))
+        self._options[self._option_code(name)] = bytes(value)
+
+    def _all_options(self) -> Dict[int, bytes]:
+        index = self._option_index
+        if index is None:
+            index = self._index_options()
+        options = {
+            code: bytes(self._data[offset : offset + length])
+            for code, (offset, length) in index.items()
+        }
+        options.update(self._options)
+        return options
+
+    def encode(self) -> bytes:
+        """@return: Returns the packet's wire format.  The options are encoded
+            in ascending order of their code.
+        """
+        options = sorted(self._all_options().items())
+        size = OPTIONS_OFFSET + sum(2 + len(value) for _, value in options) + 1
+        buf = bytearray(size)
+        buf[:HEADER_LEN] = self._data[:HEADER_LEN]
+        buf[HEADER_LEN:OPTIONS_OFFSET] = MAGIC_COOKIE
+        pos = OPTIONS_OFFSET
+        for code, value in options:
+            buf[pos] = code
+            buf[pos + 1] = len(value)
+            buf[pos + 2 : pos + 2 + len(value)] = value
+            pos += 2 + len(value)
+        buf[pos] = OPTION_END
+        return bytes(buf)
@@ -17,22 +17,222 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import collections
+import functools
 import random
+import struct
 import time
 import logging
 
-from typing import Dict, Optional, Tuple, List, Callable, Iterable, Any
+from typing import Dict, Deque, Optional, Tuple, List, Callable, Iterable, Any
 from ipaddress import IPv4Address, IPv4Network
 
+from prometheus_client import Counter, Gauge, Histogram
+
+from odr.dhcppacket import (
+    BOOTREQUEST,
+    DHCP_ACK,
+    DHCP_DISCOVER,
+    DHCP_NACK,
+    DHCP_OFFER,
+    DHCP_REQUEST,
+    OPTION_CODES,
+    OPTION_END,
+    OPTIONS_OFFSET,
+    HEADER_FIELDS,
+    DhcpPacket,
+)
 from odr.listeningsocket import ListeningSocket
+from odr.mmsg import BatchReceiver, send_batch
 from odr.timeoutmgr import TimeoutManager, TimeoutObject
 
-from pydhcplib.dhcp_packet import DhcpPacket
-
 
 DHCP_SUBOPTION_LINKSEL = 5
 DHCP_SUBOPTION_LINKSEL_LEN = 4
 
+M_DHCP_OFFER_LATENCY = Histogram(
+    "dhcp_offer_latency_seconds",
+    "time from the first DHCP DISCOVER until the OFFER was received",
+    ("realm", "server"),
+)
+M_DHCP_ACK_LATENCY = Histogram(
+    "dhcp_ack_latency_seconds",
+    "time from the first DHCP REQUEST until the ACK was received",
+    ("request", "realm", "server"),
+)
+M_DHCP_NACK_COUNT = Counter(
+    "dhcp_nack_count",
+    "number of DHCP NACKs received",
+    ("request", "realm", "server"),
+)
+M_DHCP_TIMEOUT_COUNT = Counter(
+    "dhcp_timeout_count",
+    "number of DHCP requests that timed out after all retransmits",
+    ("request", "realm"),
+)
+M_DHCP_RETRANSMIT_COUNT = Counter(
+    "dhcp_retransmit_count",
+    "number of DHCP packets retransmitted after a timeout",
+    ("request", "realm"),
+)
+M_DHCP_UNKNOWN_XID_COUNT = Counter(
+    "dhcp_unknown_xid_count",
+    "number of DHCP answers dropped because their xid was unknown",
+    ("requestor",),
+)
+M_DHCP_REQUESTS_IN_FLIGHT = Gauge(
+    "dhcp_requests_in_flight",
+    "number of DHCP requests waiting for an answer",
+    ("requestor",),
+)
+
+_XID = struct.Struct('!I')
+_XID_OFFSET = HEADER_FIELDS['xid'][0]
+
+# 'classless_static_route' must be requested before 'router'.
+DHCP_PARAMETER_REQUEST_LIST = bytes(
+    OPTION_CODES[name]
+    for name in (
+        'subnet_mask',
+        'classless_static_route',
+        'router',
+        'domain_name_server',
+        'domain_name',
+        'renewal_time_value',
+        'rebinding_time_value',
+    )
+)
+
+
+class DhcpRequestTemplate:
+    """Pre-encoded wire format of the DHCP requests we send via one local IP
+    address for one target subnet.
+
+    Everything but the XID, the message type, the client identifier and the
+    optional requested IP address and server identifier is identical for all
+    of these requests, so it is encoded only once.  The result matches what
+    encoding a full DhcpPacket produces, i.e. the options are in ascending
+    order of their code.
+    """
+
+    _OPT_REQUEST_IP_ADDRESS = OPTION_CODES['request_ip_address']
+    _OPT_DHCP_MESSAGE_TYPE = OPTION_CODES['dhcp_message_type']
+    _OPT_SERVER_IDENTIFIER = OPTION_CODES['server_identifier']
+    _OPT_CLIENT_IDENTIFIER = OPTION_CODES['client_identifier']
+
+    def __init__(
+        self,
+        local_ip: IPv4Address,
+        target_addr: Optional[IPv4Address],
+        lease_time: Optional[int],
+    ) -> None:
+        """\
+        :ivar local_ip: IP address from which the requests originate.
+        :ivar target_addr: Address of the subnet to request an address for
+                (see DhcpAddressRequest), or None.
+        :ivar lease_time: Requested lease time or None.
+        """
+        packet = DhcpPacket()
+        packet.set_option("op", bytes((BOOTREQUEST,)))
+        packet.set_option("htype", b"\x01")
+        # We pretend to be a gateway, so the packet hop count is > 0 here.
+        packet.set_option("hops", b"\x01")
+        # We're the gateway.
+        packet.set_option("giaddr", local_ip.packed)
+        self._header = packet.encode()[:OPTIONS_OFFSET]
+
+        # Options 51 and 55 go between the requested IP address (50) and the
+        # client identifier (61), option 82 follows the client identifier.
+        self._lease_time_opt = b''
+        if lease_time is not None:
+            self._lease_time_opt = bytes(
+                (OPTION_CODES['ip_address_lease_time'], 4)
+            ) + lease_time.to_bytes(4, "big")
+        self._param_list_opt = (
+            bytes((OPTION_CODES['parameter_request_list'],))
+            + bytes((len(DHCP_PARAMETER_REQUEST_LIST),))
+            + DHCP_PARAMETER_REQUEST_LIST
+        )
+        tail = b''
+        if target_addr:
+            relay_agent = (
+                bytes((DHCP_SUBOPTION_LINKSEL, DHCP_SUBOPTION_LINKSEL_LEN))
+                + target_addr.packed
+            )
+            tail += bytes((OPTION_CODES['relay_agent'], len(relay_agent)))
+            tail += relay_agent
+        tail += bytes((OPTION_END,))
+        self._tail = tail
+
+    def build(
+        self,
+        xid: int,
+        message_type: int,
+        client_identifier: bytes,
+        requested_ip: Optional[bytes] = None,
+        server_identifier: Optional[bytes] = None,
+    ) -> bytes:
+        """:returns: the encoded request packet.  An empty server identifier
+                is omitted, like a missing one.
+        """
+        if not server_identifier:
+            server_identifier = None
+        size = (
+            len(self._header)
+            + len(self._lease_time_opt)
+            + 3
+            + len(self._param_list_opt)
+            + 2
+            + len(client_identifier)
+            + len(self._tail)
+        )
+        if requested_ip is not None:
+            size += 2 + len(requested_ip)
+        if server_identifier is not None:
+            size += 2 + len(server_identifier)
+
+        buf = bytearray(size)
+        pos = len(self._header)
+        buf[:pos] = self._header
+        _XID.pack_into(buf, _XID_OFFSET, xid)
+        if requested_ip is not None:
+            buf[pos] = self._OPT_REQUEST_IP_ADDRESS
+            buf[pos + 1] = len(requested_ip)
+            pos += 2
+            buf[pos : pos + len(requested_ip)] = requested_ip
+            pos += len(requested_ip)
+        buf[pos : pos + len(self._lease_time_opt)] = self._lease_time_opt
+        pos += len(self._lease_time_opt)
+        buf[pos : pos + 3] = bytes((self._OPT_DHCP_MESSAGE_TYPE, 1, message_type))
+        pos += 3
+        if server_identifier is not None:
+            buf[pos] = self._OPT_SERVER_IDENTIFIER
+            buf[pos + 1] = len(server_identifier)
+            pos += 2
+            buf[pos : pos + len(server_identifier)] = server_identifier
+            pos += len(server_identifier)
+        buf[pos : pos + len(self._param_list_opt)] = self._param_list_opt
+        pos += len(self._param_list_opt)
+        buf[pos] = self._OPT_CLIENT_IDENTIFIER
+        buf[pos + 1] = len(client_identifier)
+        pos += 2
+        buf[pos : pos + len(client_identifier)] = client_identifier
+        pos += len(client_identifier)
+        buf[pos:] = self._tail
+        return bytes(buf)
+
+
+@functools.lru_cache(maxsize=None)
+def get_request_template(
+    local_ip: IPv4Address,
+    target_addr: Optional[IPv4Address],
+    lease_time: Optional[int],
+) -> DhcpRequestTemplate:
+    """:returns: the shared request template for the given parameters.  As
+            these only depend on the realm, there is one template per realm.
+    """
+    return DhcpRequestTemplate(local_ip, target_addr, lease_time)
+
 
 class DhcpAddressRequest:
     """Represents the request for an IP address (and additional settings
@@ -52,6 +252,9 @@ class DhcpAddressRequest:
     AR_DISCOVER = 1
     AR_REQUEST = 2
 
+    # Kind of request, used as metrics label.
+    REQUEST_TYPE = ''
+
     def __init__(
         self,
         *,
@@ -66,7 +269,8 @@ class DhcpAddressRequest:
         target_addr: str = None,
         max_retries: int = 3,
         timeout: int = 4,
-        lease_time: int = None
+        lease_time: int = None,
+        realm: str = ''
     ) -> None:
         """Sets up the address request.
 
@@ -97,6 +301,8 @@ class DhcpAddressRequest:
                 timing out and/or retrying the request.  Defaults to 5 seconds.
         :ivar lease_time: DHCP lease time we would like to have. Defaults to
                 None, meaning no specific lease time is requested.
+        :ivar realm: Name of the realm the request is for.  Only used as
+                metrics label.
         """
         self._log = log
         self._requestor = requestor
@@ -110,6 +316,10 @@ class DhcpAddressRequest:
         self._max_retries = max_retries
         self._initial_timeout = timeout
         self._lease_time = lease_time
+        self._realm = realm
+        self._template = get_request_template(
+            self._local_ip, self._target_addr, self._lease_time
+        )
 
         self._start_time = int(time.time())
 
@@ -123,10 +333,12 @@ class DhcpAddressRequest:
         self._timeout = self._initial_timeout
         # When will the packet time out?
         self._timeout_obj = None  # type: Optional[TimeoutObject]
-        # What was the contents of the last packet?  (Used for retry.)
-        self._last_packet = None  # type: Optional[DhcpPacket]
+        # What was the encoded contents of the last packet?  (Used for retry.)
+        self._last_packet = None  # type: Optional[bytes]
         # Number of packet retries
         self._packet_retries = 0
+        # When was the last packet first sent?  (Used for metrics.)
+        self._packet_sent_time = 0.0
 
     def __del__(self) -> None:
         self._log.debug('xid %d destroyed', self.xid)
@@ -137,44 +349,6 @@ class DhcpAddressRequest:
         """
         return self._xid
 
-    def _generate_base_packet(self) -> DhcpPacket:
-        packet = DhcpPacket()
-        packet.AddLine("op: BOOTREQUEST")
-        packet.AddLine("htype: 1")
-        packet.SetOption("xid", self._xid.to_bytes(4, "big"))
-
-        # We're the gateway.
-        packet.SetOption("giaddr", self._local_ip.packed)
-
-        if self._target_addr:
-            packet.SetOption(
-                "relay_agent",
-                bytes((DHCP_SUBOPTION_LINKSEL, DHCP_SUBOPTION_LINKSEL_LEN))
-                + self._target_addr.packed,
-            )
-
-        # Request IP address, etc. for the following client identifier.
-        packet.SetOption("client_identifier", self._client_identifier)
-
-        # We pretend to be a gateway, so the packet hop count is > 0 here.
-        packet.AddLine("hops: 1")
-
-        return packet
-
-    def _add_option_list(self, packet: DhcpPacket) -> None:
-        # 'classless_static_route' must be requested before 'router'.
-        packet.AddLine(
-            "parameter_request_list: subnet_mask,"
-            "classless_static_route,router,"
-            "domain_name_server,domain_name,renewal_time_value,"
-            "rebinding_time_value"
-        )
-
-    def _set_lease_time(self, packet: DhcpPacket) -> None:
-        if self._lease_time is None:
-            return
-        packet.SetOption('ip_address_lease_time', self._lease_time.to_bytes(4, "big"))
-
     def _retrieve_server_ip(self, packet: DhcpPacket) -> None:
         """In case we're sending the requests to more than one DHCP server,
         attempt to determine which DHCP server answered, so that we can restrict
@@ -183,7 +357,7 @@ class DhcpAddressRequest:
         if len(self._server_ips) > 1:
             self._log.debug("Attempting to find server ip")
             try:
-                self._server_ips = [IPv4Address(packet.GetOption('server_identifier'))]
+                self._server_ips = [IPv4Address(packet.get_option('server_identifier'))]
             except Exception:
                 self._log.exception("invalid server ip response")
             else:
@@ -191,11 +365,12 @@ class DhcpAddressRequest:
                 # will communicate from now on.
                 self._log.debug("Found server ip %s", self._server_ips[0])
 
-    def _send_packet(self, packet: DhcpPacket) -> None:
+    def _send_packet(self, packet: bytes) -> None:
         """Method to initially send a packet.
         """
         self._last_packet = packet
         self._packet_retries = 0
+        self._packet_sent_time = time.monotonic()
         self._timeout = self._initial_timeout
         self._send_to_server(packet)
 
@@ -203,11 +378,12 @@ class DhcpAddressRequest:
         """Method to re-send the packet that was sent last.
         """
         assert self._last_packet is not None
+        M_DHCP_RETRANSMIT_COUNT.labels(self.REQUEST_TYPE, self._realm).inc()
         self._packet_retries += 1
         self._timeout *= 2
         self._send_to_server(self._last_packet)
 
-    def _send_to_server(self, packet: DhcpPacket) -> None:
+    def _send_to_server(self, packet: bytes) -> None:
         """Method that does the actual packet sending.  The packet is sent once
         for each DHCP server destination.
         """
@@ -260,8 +436,11 @@ class DhcpAddressRequest:
             return
         if self._timeout_obj:
             self._timeout_mgr.del_timeout_object(self._timeout_obj)
+        M_DHCP_OFFER_LATENCY.labels(
+            self._realm, offer_packet.source_address[0]
+        ).observe(time.monotonic() - self._packet_sent_time)
         req_packet = self._generate_request(offer_packet)
-        self._retrieve_server_ip(req_packet)
+        self._retrieve_server_ip(offer_packet)
         self._state = self.AR_REQUEST
         self._send_packet(req_packet)
 
@@ -282,9 +461,14 @@ class DhcpAddressRequest:
             return
         if self._timeout_obj:
             self._timeout_mgr.del_timeout_object(self._timeout_obj)
+        M_DHCP_ACK_LATENCY.labels(
+            self.REQUEST_TYPE, self._realm, packet.source_address[0]
+        ).observe(time.monotonic() - self._packet_sent_time)
         self._requestor.del_request(self)
         result = {}  # type: Dict[str, Any]
-        result['domain'] = packet.GetOption('domain_name').decode("ascii")
+        result['domain'] = packet.get_option('domain_name').decode("ascii")
+        # The DHCP server that granted the lease.  Renewals are sent there.
+        result['server_ip'] = packet.source_address[0]
 
         translate_ips = {
             'yiaddr': 'ip_address',
@@ -292,22 +476,22 @@ class DhcpAddressRequest:
             'router': 'gateway',
         }
         for opt_name in translate_ips:
-            if not packet.IsOption(opt_name):
+            if not packet.has_option(opt_name):
                 continue
-            val = packet.GetOption(opt_name)
+            val = packet.get_option(opt_name)
             if len(val) == 4:
                 result[translate_ips[opt_name]] = str(IPv4Address(val))
 
         dns = []  # type: List[str]
         result['dns'] = dns
-        dns_list = packet.GetOption('domain_name_server')
+        dns_list = packet.get_option('domain_name_server')
         while len(dns_list) >= 4:
             dns.append(str(IPv4Address(dns_list[:4])))
             dns_list = dns_list[4:]
 
-        if packet.IsOption('classless_static_route'):
+        if packet.has_option('classless_static_route'):
             static_routes = parse_classless_static_routes(
-                list(packet.GetOption('classless_static_route'))
+                list(packet.get_option('classless_static_route'))
             )
             if static_routes is not None:
                 if 'gateway' in result:
@@ -325,18 +509,18 @@ class DhcpAddressRequest:
             del static_routes
 
         # Calculate lease timeouts (with RFC T1/T2 if not found in packet)
-        lease_delta = int.from_bytes(packet.GetOption('ip_address_lease_time'), "big")
+        lease_delta = int.from_bytes(packet.get_option('ip_address_lease_time'), "big")
         result['lease_timeout'] = self._start_time + lease_delta
-        if packet.IsOption('renewal_time_value'):
+        if packet.has_option('renewal_time_value'):
             renewal_delta = int.from_bytes(
-                packet.GetOption('renewal_time_value'), "big"
+                packet.get_option('renewal_time_value'), "big"
             )
         else:
             renewal_delta = int(lease_delta * 0.5) + random.randint(-5, 5)
         result['renewal_timeout'] = self._start_time + renewal_delta
-        if packet.IsOption('rebinding_time_value'):
+        if packet.has_option('rebinding_time_value'):
             rebinding_delta = int.from_bytes(
-                packet.GetOption('rebinding_time_value'), "big"
+                packet.get_option('rebinding_time_value'), "big"
             )
         else:
             rebinding_delta = int(lease_delta * 0.875) + random.randint(-5, 5)
@@ -361,6 +545,9 @@ class DhcpAddressRequest:
             return
         if self._timeout_obj:
             self._timeout_mgr.del_timeout_object(self._timeout_obj)
+        M_DHCP_NACK_COUNT.labels(
+            self.REQUEST_TYPE, self._realm, packet.source_address[0]
+        ).inc()
         self._requestor.del_request(self)
         self._failure_handler()
 
@@ -375,13 +562,14 @@ class DhcpAddressRequest:
         """
         self._log.debug("handling timeout for %d", self.xid)
         if self._packet_retries >= self._max_retries:
+            M_DHCP_TIMEOUT_COUNT.labels(self.REQUEST_TYPE, self._realm).inc()
             self._requestor.del_request(self)
             self._log.debug("Timeout for reply to packet in state %s", self._state)
             self._failure_handler()
         elif self._last_packet is not None:
             self._resend_packet()
 
-    def _generate_request(self, offer_packet: DhcpPacket) -> DhcpPacket:
+    def _generate_request(self, offer_packet: DhcpPacket) -> bytes:
         """Generates a DHCP REQUEST packet.
         """
         raise NotImplementedError('Method _generate_request not implemented')
@@ -391,6 +579,8 @@ class DhcpAddressInitialRequest(DhcpAddressRequest):
     """
     """
 
+    REQUEST_TYPE = 'initial'
+
     def __init__(self, **kwargs) -> None:
         """Sets up the initial address request.
 
@@ -406,32 +596,29 @@ class DhcpAddressInitialRequest(DhcpAddressRequest):
         self._requestor.add_request(self)
         self._send_packet(self._generate_discover())
 
-    def _generate_discover(self) -> DhcpPacket:
+    def _generate_discover(self) -> bytes:
         """Generates a DHCP DISCOVER packet.
         """
-        packet = self._generate_base_packet()
-        packet.AddLine("dhcp_message_type: DHCP_DISCOVER")
-        self._add_option_list(packet)
-        self._set_lease_time(packet)
-        return packet
+        return self._template.build(self._xid, DHCP_DISCOVER, self._client_identifier)
 
-    def _generate_request(self, offer_packet: DhcpPacket) -> DhcpPacket:
+    def _generate_request(self, offer_packet: DhcpPacket) -> bytes:
         """Generates a DHCP REQUEST packet.
         """
-        packet = self._generate_base_packet()
-        packet.AddLine("dhcp_message_type: DHCP_REQUEST")
-        self._add_option_list(packet)
-        self._set_lease_time(packet)
-        for opt in ["server_identifier"]:
-            packet.SetOption(opt, offer_packet.GetOption(opt))
-        packet.SetOption("request_ip_address", offer_packet.GetOption("yiaddr"))
-        return packet
+        return self._template.build(
+            self._xid,
+            DHCP_REQUEST,
+            self._client_identifier,
+            requested_ip=offer_packet.get_option("yiaddr"),
+            server_identifier=offer_packet.get_option("server_identifier"),
+        )
 
 
 class DhcpAddressRefreshRequest(DhcpAddressRequest):
     """
     """
 
+    REQUEST_TYPE = 'refresh'
+
     def __init__(self, client_ip: str, **kwargs) -> None:
         """Sets up the address request.
 
@@ -447,15 +634,15 @@ class DhcpAddressRefreshRequest(DhcpAddressRequest):
         self._requestor.add_request(self)
         self._send_packet(self._generate_refresh_request())
 
-    def _generate_refresh_request(self) -> DhcpPacket:
+    def _generate_refresh_request(self) -> bytes:
         """Generates a DHCP REQUEST packet.
         """
-        packet = self._generate_base_packet()
-        packet.AddLine("dhcp_message_type: DHCP_REQUEST")
-        self._add_option_list(packet)
-        self._set_lease_time(packet)
-        packet.SetOption("request_ip_address", self._client_ip.packed)
-        return packet
+        return self._template.build(
+            self._xid,
+            DHCP_REQUEST,
+            self._client_identifier,
+            requested_ip=self._client_ip.packed,
+        )
 
 
 class DhcpAddressRequestor(ListeningSocket):
@@ -476,23 +663,50 @@ class DhcpAddressRequestor(ListeningSocket):
 
     # Maps dhcp_message_type to a request's message type handler.
     _DHCP_TYPE_HANDLERS = {
-        2: 'handle_dhcp_offer',
-        5: 'handle_dhcp_ack',
-        6: 'handle_dhcp_nack',
+        DHCP_OFFER: 'handle_dhcp_offer',
+        DHCP_ACK: 'handle_dhcp_ack',
+        DHCP_NACK: 'handle_dhcp_nack',
     }
 
+    # Maximum size of a received DHCP packet.
+    MAX_PACKET_SIZE = 2048
+
     def __init__(
-        self, listen_address: str = '', listen_port: int = 67, listen_device: str = None
+        self,
+        listen_address: str = '',
+        listen_port: int = 67,
+        listen_device: str = None,
+        recv_batch_size: int = 64,
+        timeout_mgr: TimeoutManager = None,
+        server_rate: float = 0,
     ) -> None:
         """\
         :ivar listen_address: IP address as string to listen on.
         :ivar listen_port: Local DHCP listening port. Defaults to 67.
         :ivar listen_device: Device name to bind to.
+        :ivar recv_batch_size: Maximum number of packets to receive and
+                process per socket loop wakeup.  Defaults to 64.
+        :ivar timeout_mgr: Instance of the timeout manager.  Needed for
+                pacing, to send held back packets in time.
+        :ivar server_rate: Maximum number of packets per second sent to each
+                DHCP server.  Defaults to 0, meaning no limit.
         """
         self._log = logging.getLogger('dhcpaddrrequestor')
         self._requests = {}  # type: Dict[int, DhcpAddressRequest]
+        self._receiver = BatchReceiver(recv_batch_size, self.MAX_PACKET_SIZE)
+        self._timeout_mgr = timeout_mgr
+        self._send_queue = (
+            collections.deque()
+        )  # type: Deque[Tuple[bytes, Tuple[str, int]]]
+        self._pacer = None  # type: Optional[_ServerPacer]
+        if server_rate > 0:
+            if timeout_mgr is None:
+                raise ValueError('pacing needs a timeout manager')
+            self._pacer = _ServerPacer(server_rate)
+        self._flush_timeout = None  # type: Optional[TimeoutObject]
 
         super().__init__(listen_address, listen_port, listen_device)
+        self._metrics_label = '{}@{}'.format(self.listen_address, self.listen_device)
 
         self._log.debug(
             'listening on %s:%d@%s for DHCP responses',
@@ -508,6 +722,7 @@ class DhcpAddressRequestor(ListeningSocket):
         """
         self._log.debug("adding xid %d", request.xid)
         self._requests[request.xid] = request
+        M_DHCP_REQUESTS_IN_FLIGHT.labels(self._metrics_label).set(len(self._requests))
 
     def del_request(self, request: DhcpAddressRequest) -> None:
         """Removes a DHCP address request that was previously added.
@@ -516,34 +731,43 @@ class DhcpAddressRequestor(ListeningSocket):
         """
         self._log.debug("deleting xid %d", request.xid)
         del self._requests[request.xid]
+        M_DHCP_REQUESTS_IN_FLIGHT.labels(self._metrics_label).set(len(self._requests))
 
     def handle_socket(self) -> None:
-        """Retrieves the next, waiting DHCP packet, parses it and calls the
-        handler of the associated request.
+        """Retrieves all waiting DHCP packets (up to the receive batch size),
+        parses them and calls the handlers of the associated requests.
+        """
+        try:
+            received = self._receiver.recv(self._socket)
+        except OSError:
+            self._log.exception('receiving DHCP packets failed')
+            return
+        for data, source_address in received:
+            self._handle_packet(data, source_address)
+
+    def _handle_packet(self, data: memoryview, source_address: Tuple[str, int]) -> None:
+        """Parses a single DHCP packet and calls the handler of the associated
+        request.
         """
         try:
-            data, source_address = self._socket.recvfrom(2048)
             if len(data) == 0:
                 self._log.warning("unexpectedly received EOF!")
                 return
-            packet = DhcpPacket()
-            packet.source_address = source_address
-            packet.DecodePacket(data)
+            packet = DhcpPacket.decode(data, source_address)
 
-            if (not packet.IsDhcpPacket()) or (
-                not packet.IsOption("dhcp_message_type")
-            ):
+            dhcp_type = packet.message_type if packet.is_dhcp_packet() else None
+            if dhcp_type is None:
                 self._log.debug("Ignoring invalid packet")
                 return
 
-            dhcp_type = packet.GetOption("dhcp_message_type")[0]
             if dhcp_type not in self._DHCP_TYPE_HANDLERS:
                 self._log.debug("Ignoring packet of unexpected DHCP type %d", dhcp_type)
                 return
 
-            xid = int.from_bytes(packet.GetOption('xid'), "big")
+            xid = packet.xid
             if xid not in self._requests:
                 self._log.debug("Ignoring answer with xid %r", xid)
+                M_DHCP_UNKNOWN_XID_COUNT.labels(self._metrics_label).inc()
                 return
 
             request = self._requests[xid]
@@ -557,9 +781,96 @@ class DhcpAddressRequestor(ListeningSocket):
         except Exception:
             self._log.exception('handling DHCP packet failed')
 
-    def send_packet(self, packet: DhcpPacket, dest_ip: str, dest_port: int) -> None:
-        data = packet.EncodePacket()
-        self.socket.sendto(data, (dest_ip, dest_port))
+    def send_packet(self, data: bytes, dest_ip: str, dest_port: int) -> None:
+        """Queues an encoded DHCP packet for sending.  The packet is sent by
+        the next call of flush_send_queue().
+        """
+        self._send_queue.append((data, (dest_ip, dest_port)))
+
+    def flush_send_queue(self) -> None:
+        """Sends the queued packets, as far as the pacing rate allows.  Should
+        be called once per socket loop iteration, after all handlers that
+        might send packets have run.
+
+        Packets are sent in batches, with a single sendmmsg(2) call where
+        available.
+        """
+        if not self._send_queue:
+            return
+
+        if self._pacer is None:
+            ready = list(self._send_queue)
+            held = collections.deque()  # type: Deque[Tuple[bytes, Tuple[str, int]]]
+        else:
+            ready, held = self._pacer.split(self._send_queue, time.monotonic())
+
+        while ready:
+            try:
+                sent = send_batch(self._socket, ready)
+            except OSError:
+                self._log.exception('sending DHCP packet to %s failed', ready[0][1])
+                sent = 1
+            if sent == 0:
+                # The socket's send buffer is full.  Retry the remaining
+                # packets later.
+                held.extendleft(reversed(ready))
+                break
+            del ready[:sent]
+        self._send_queue = held
+
+        if held and self._timeout_mgr is not None and self._flush_timeout is None:
+            delay = self._pacer.delay if self._pacer is not None else 0.01
+            self._flush_timeout = self._timeout_mgr.add_rel_timeout(
+                delay, self._handle_flush_timeout
+            )
+
+    def _handle_flush_timeout(self) -> None:
+        self._flush_timeout = None
+        self.flush_send_queue()
+
+
+class _ServerPacer:
+    """Limits the number of packets sent to each destination IP address with
+    a token bucket per destination.
+    """
+
+    def __init__(self, rate: float) -> None:
+        """\
+        :ivar rate: Maximum number of packets per second per destination.
+        """
+        self._rate = rate
+        self._burst = max(1.0, rate)
+        # Maps the destination IP address to the number of available tokens
+        # and the time they were last refilled.
+        self._buckets = {}  # type: Dict[str, Tuple[float, float]]
+
+    @property
+    def delay(self) -> float:
+        """:returns: the time it takes to refill a single token.
+        """
+        return 1.0 / self._rate
+
+    def split(
+        self, packets: Iterable[Tuple[bytes, Tuple[str, int]]], now: float
+    ) -> Tuple[
+        List[Tuple[bytes, Tuple[str, int]]], Deque[Tuple[bytes, Tuple[str, int]]]
+    ]:
+        """Splits the packets into those that may be sent now and those that
+        need to be held back.  The order of packets is kept.
+        """
+        ready = []  # type: List[Tuple[bytes, Tuple[str, int]]]
+        held = collections.deque()  # type: Deque[Tuple[bytes, Tuple[str, int]]]
+        for packet in packets:
+            dest_ip = packet[1][0]
+            tokens, last = self._buckets.get(dest_ip, (self._burst, now))
+            tokens = min(self._burst, tokens + (now - last) * self._rate)
+            if tokens >= 1:
+                tokens -= 1
+                ready.append(packet)
+            else:
+                held.append(packet)
+            self._buckets[dest_ip] = (tokens, now)
+        return ready, held
 
 
 class DhcpAddressRequestorManager:
@@ -0,0 +1,372 @@
+"""Runs the DHCP requestors in separate worker processes.
+
+Each worker process owns the requestors of a subset of the local DHCP
+listening addresses.  The main process talks to each worker over a
+SOCK_SEQPACKET socket pair, with one JSON encoded message per packet:
+
+ - The main process sends {"id": ..., "type": "initial" | "refresh",
+   "args": {...}} to start a DHCP request.  "args" are the keyword arguments
+   of the request, including device and local_ip.
+ - The worker answers with {"id": ..., "result": {...}} once the request
+   succeeded or with {"id": ..., "failed": true} once it failed.
+"""
+
+import collections
+import itertools
+import json
+import logging
+import os
+import socket
+
+from functools import partial
+from typing import (
+    Any,
+    Callable,
+    Deque,
+    Dict,
+    Hashable,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+from odr.timeoutmgr import TimeoutManager
+
+
+class DhcpWorkerFailed(Exception):
+    """The worker process responsible for a DHCP request is gone.
+    """
+
+
+MAX_MSG_SIZE = 65536
+
+
+def create_worker_socketpair() -> Tuple[socket.socket, socket.socket]:
+    """@return: Returns a connected pair of sockets for the communication
+        between the main process and a worker process.
+    """
+    return socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+
+
+def assign_shards(keys: Sequence[Hashable], num_workers: int) -> List[List[Any]]:
+    """Distributes the keys round-robin over the workers.  The assignment only
+    depends on the set of keys.
+
+    @param keys: The keys to distribute, e.g. (device, local IP) pairs.
+    @param num_workers: Number of workers.
+    @return: Returns a list of keys for each worker.
+    """
+    shards = [[] for _ in range(num_workers)]  # type: List[List[Any]]
+    for i, key in enumerate(sorted(set(keys), key=repr)):
+        shards[i % num_workers].append(key)
+    return shards
+
+
+def _encode(msg: Dict[str, Any]) -> bytes:
+    # IP address objects are passed on as strings.
+    return json.dumps(msg, default=str).encode("utf-8")
+
+
+class _QueuedSender:
+    """Base class for both ends of the socket pair.  Messages are queued and
+    sent by flush_send_queue(), without ever blocking the socket loop.  If the
+    other end is not keeping up, sending is retried a little later.
+    """
+
+    def __init__(self, sock: socket.socket, timeout_mgr: TimeoutManager) -> None:
+        self._socket = sock
+        self._socket.setblocking(False)
+        self._timeout_mgr = timeout_mgr
+        self._send_queue = collections.deque()  # type: Deque[bytes]
+        self._retry_scheduled = False
+
+    def flush_send_queue(self) -> None:
+        """Sends all queued messages, as far as the other end keeps up.
+        """
+        while self._send_queue:
+            try:
+                self._socket.send(self._send_queue[0])
+            except BlockingIOError:
+                if not self._retry_scheduled:
+                    self._retry_scheduled = True
+                    self._timeout_mgr.add_rel_timeout(0.01, self._handle_retry)
+                return
+            except OSError:
+                self._send_failed()
+                return
+            self._send_queue.popleft()
+
+    def _handle_retry(self) -> None:
+        self._retry_scheduled = False
+        self.flush_send_queue()
+
+    def _send_failed(self) -> None:
+        raise NotImplementedError
+
+
+class DhcpWorkerClient(_QueuedSender):
+    """Represents a worker process within the main process.  Starts DHCP
+    requests in the worker and calls the request's handlers as soon as the
+    worker reports the outcome.
+
+    Provides socket and handle_socket for use by the socket loop and
+    flush_send_queue, which should be registered as idle handler.
+    """
+
+    def __init__(
+        self,
+        sloop,
+        sock: socket.socket,
+        pid: int,
+        timeout_mgr: TimeoutManager,
+        worker_gone_clb: Optional[Callable[["DhcpWorkerClient"], None]] = None,
+    ) -> None:
+        """\
+        @param sloop: Instance of the socket loop.
+        @param sock: The main process' end of the worker's socket pair.
+        @param pid: Process ID of the worker.
+        @param timeout_mgr: Instance of the timeout manager.  Used to retry
+            sending in case the worker is not keeping up.
+        @param worker_gone_clb: Called with the client as soon as the worker
+            has gone away.
+        """
+        _QueuedSender.__init__(self, sock, timeout_mgr)
+        self._log = logging.getLogger('dhcpworkerclient')
+        self._sloop = sloop
+        self.pid = pid
+        self._worker_gone_clb = worker_gone_clb
+        self._ids = itertools.count()
+        # Maps request IDs to the request's success and failure handlers.
+        self._pending = {}  # type: Dict[int, Tuple[Callable, Callable]]
+        self._alive = True
+
+    @property
+    def socket(self) -> socket.socket:
+        """@return: Returns the socket connected to the worker.
+        """
+        return self._socket
+
+    @property
+    def alive(self) -> bool:
+        """@return: Returns False once the worker has gone away.
+        """
+        return self._alive
+
+    def start_request(
+        self,
+        request_type: str,
+        success_handler_clb: Callable[[Dict[str, Any]], None],
+        failure_handler_clb: Callable[[], None],
+        **kwargs
+    ) -> None:
+        """Starts a DHCP request in the worker.  The message is sent by the
+        next call of flush_send_queue().
+
+        @param request_type: "initial" or "refresh".
+        @param success_handler_clb: Called with the request's result in case
+            the request succeeded.
+        @param failure_handler_clb: Called in case the request failed.
+        @raises DhcpWorkerFailed: If the worker has gone away.
+        """
+        if not self._alive:
+            raise DhcpWorkerFailed(self.pid)
+        req_id = next(self._ids)
+        self._pending[req_id] = (success_handler_clb, failure_handler_clb)
+        self._send_queue.append(
+            _encode({'id': req_id, 'type': request_type, 'args': kwargs})
+        )
+
+    def _send_failed(self) -> None:
+        self._log.exception('sending to DHCP worker %d failed', self.pid)
+        self._worker_gone()
+
+    def handle_socket(self) -> None:
+        """Part of the interface expected by the socket loop.  Processes all
+        messages waiting to be read.
+        """
+        while self._alive:
+            try:
+                data = self._socket.recv(MAX_MSG_SIZE)
+            except BlockingIOError:
+                return
+            except OSError:
+                self._log.exception('receiving from DHCP worker %d failed', self.pid)
+                data = b''
+            if data == b'':
+                self._log.error('DHCP worker %d has gone away', self.pid)
+                self._worker_gone()
+                return
+            self._handle_message(data)
+
+    def _handle_message(self, data: bytes) -> None:
+        try:
+            msg = json.loads(data.decode("utf-8"))
+            success_handler, failure_handler = self._pending.pop(msg['id'])
+        except (ValueError, KeyError):
+            self._log.warning('invalid message from DHCP worker: %r', data)
+            return
+        if 'result' in msg:
+            success_handler(msg['result'])
+        else:
+            failure_handler()
+
+    def _worker_gone(self) -> None:
+        """Fails all pending requests.  No new requests are accepted.  The
+        worker is not restarted here: The main process may not fork anymore
+        once its threads are running, nor open raw sockets once it dropped
+        its capabilities.  Instead, the worker gone call-back is notified.
+        """
+        self._alive = False
+        self._sloop.del_socket_handler(self)
+        # In case the worker is still running, closing the socket makes it
+        # exit.
+        self._socket.close()
+        self._send_queue.clear()
+        pending, self._pending = self._pending, {}
+        for _, failure_handler in pending.values():
+            failure_handler()
+        self._reap()
+        if self._worker_gone_clb is not None:
+            self._worker_gone_clb(self)
+
+    def _reap(self) -> None:
+        try:
+            pid, status = os.waitpid(self.pid, os.WNOHANG)
+        except ChildProcessError:
+            # Not our child or already reaped.
+            return
+        if pid == 0:
+            # The worker is still exiting.
+            self._timeout_mgr.add_rel_timeout(1, self._reap)
+            return
+        self._log.critical('DHCP worker %d exited with status %d', self.pid, status)
+
+
+class DhcpWorkerPool:
+    """Maps DHCP listening addresses to the worker processes that own them.
+    """
+
+    def __init__(self) -> None:
+        self._workers = {}  # type: Dict[Tuple[str, str], DhcpWorkerClient]
+        self._log = logging.getLogger('dhcpworkerpool')
+
+    def add_worker(
+        self, worker: DhcpWorkerClient, keys: Sequence[Tuple[str, str]]
+    ) -> None:
+        """\
+        @param worker: The worker.
+        @param keys: The (device, local IP) pairs the worker is responsible
+            for.
+        """
+        for key in keys:
+            self._workers[key] = worker
+
+    @property
+    def alive(self) -> bool:
+        """@return: Returns False once any of the workers has gone away.
+        """
+        return all(worker.alive for worker in self._workers.values())
+
+    def start_request(
+        self, request_type: str, device: str, local_ip: str, **kwargs
+    ) -> bool:
+        """Starts a DHCP request in the worker responsible for device and
+        local_ip.  The keyword arguments are passed on to the request.
+
+        @return: Returns False if no worker is responsible.
+        @raises DhcpWorkerFailed: If the responsible worker has gone away.
+        """
+        worker = self._workers.get((device, local_ip))
+        if worker is None:
+            self._log.error('request for unsupported local IP %s@%s', local_ip, device)
+            return False
+        worker.start_request(request_type, device=device, local_ip=local_ip, **kwargs)
+        return True
+
+
+class DhcpWorkerServer(_QueuedSender):
+    """The worker process' end of the socket pair.  Starts the DHCP requests
+    sent by the main process and reports their outcome.
+
+    Provides socket and handle_socket for use by the socket loop and
+    flush_send_queue, which should be registered as idle handler.
+    """
+
+    def __init__(
+        self,
+        sloop,
+        sock: socket.socket,
+        start_request_clbs: Dict[str, Callable],
+        timeout_mgr: TimeoutManager,
+    ) -> None:
+        """\
+        @param sloop: Instance of the socket loop.  The loop is quit as soon
+            as the main process goes away.
+        @param sock: The worker's end of the socket pair.
+        @param start_request_clbs: Maps the request types to call-backs that
+            start a DHCP request.  The call-backs return False if the request
+            could not be started.
+        @param timeout_mgr: Instance of the timeout manager.  Used to retry
+            sending in case the main process is not keeping up.
+        """
+        _QueuedSender.__init__(self, sock, timeout_mgr)
+        self._log = logging.getLogger('dhcpworkerserver')
+        self._sloop = sloop
+        self._start_request = start_request_clbs
+
+    @property
+    def socket(self) -> socket.socket:
+        """@return: Returns the socket connected to the main process.
+        """
+        return self._socket
+
+    def handle_socket(self) -> None:
+        """Part of the interface expected by the socket loop.  Processes all
+        messages waiting to be read.
+        """
+        while True:
+            try:
+                data = self._socket.recv(MAX_MSG_SIZE)
+            except BlockingIOError:
+                return
+            if data == b'':
+                self._log.info('main process has gone away, exiting')
+                self._sloop.del_socket_handler(self)
+                self._sloop.quit()
+                return
+            self._handle_message(data)
+
+    def _handle_message(self, data: bytes) -> None:
+        try:
+            msg = json.loads(data.decode("utf-8"))
+            req_id = msg['id']
+            start_request = self._start_request[msg['type']]
+            args = msg['args']
+        except (ValueError, KeyError):
+            self._log.warning('invalid message from main process: %r', data)
+            return
+        try:
+            started = start_request(
+                success_handler_clb=partial(self._send_result, req_id),
+                failure_handler_clb=partial(self._send_failure, req_id),
+                **args
+            )
+        except Exception:
+            self._log.exception('Adding a new DHCP request failed')
+            started = False
+        if not started:
+            self._send_failure(req_id)
+
+    def _send(self, msg: Dict[str, Any]) -> None:
+        self._send_queue.append(_encode(msg))
+
+    def _send_failed(self) -> None:
+        self._log.exception('sending to main process failed')
+        self._send_queue.clear()
+
+    def _send_result(self, req_id: int, result: Dict[str, Any]) -> None:
+        self._send({'id': req_id, 'result': result})
+
+    def _send_failure(self, req_id: int) -> None:
+        self._send({'id': req_id, 'failed': True})
@@ -18,41 +18,9 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import os
-import socket
-import json
-import odr.ovpn as ovpn
-
-SCRIPT_NAME = 'odr-ovpn-disconnect'
-CMD_SOCKET = '/var/run/odr/cmd.sock'
-
-
-def main():
-    #
-    # Gather configuration
-    #
-
-    full_username = os.environ['username']
-    daemon_name = ovpn.determine_daemon_name(script_name=SCRIPT_NAME)
-
-    #
-    # Build and submit command
-    #
-
-    params = {'full_username': full_username}
-    if daemon_name is not None:
-        params['daemon_name'] = daemon_name
-
-    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-    sock.connect(CMD_SOCKET)
-    result = {"cmd": "disconnect"}
-    result.update(params)
-    sock.send(json.dumps(result).encode("utf-8"))
-    ret = sock.recv(1024)
-    status = json.loads(ret.decode("utf-8"))["cmd"]
-    if status != 'OK':
-        raise RuntimeError('sending disconnect notification failed (ret: "%s")' % ret)
-
+# The hook's implementation lives in odr.hookclient, which can also be run
+# directly with "python3 -S" to avoid the start-up cost of the site module.
+from odr.hookclient import disconnect_main as main
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,108 @@
+"""Writes and syncs files on a pool of threads.
+
+The files passed to the OpenVPN connect hook need to be synced to disk before
+OpenVPN reads them.  On a busy disk, fsync() may block for a while, which
+would hold up the socket loop and with it all DHCP processing.  The writes
+are therefore done by a small pool of threads and their completion is passed
+back to the socket loop's thread.
+"""
+
+import logging
+import os
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Callable, Optional, Sequence, TextIO, Tuple
+
+from prometheus_client import Histogram
+
+M_FILE_WRITE_LATENCY = Histogram(
+    "ovpn_file_write_seconds",
+    "time taken to write and sync an OpenVPN client file",
+    ("file",),
+)
+
+# File pointer, new contents and kind of file (used as metrics label).
+FileWrite = Tuple[TextIO, str, str]
+
+
+def write_and_sync(fp: TextIO, data: str) -> None:
+    """Replaces the contents of a file and syncs it to disk.
+
+    @param fp: File pointer of the file.
+    @param data: The file's new contents.
+    """
+    fp.seek(0)
+    fp.truncate()
+    fp.write(data)
+    fp.flush()
+    os.fsync(fp.fileno())
+
+
+class FileWriterPool:
+    """Writes files on a pool of threads.  With zero threads, the files are
+    written right away by the calling thread.
+    """
+
+    def __init__(self, sloop, num_threads: int = 2) -> None:
+        """\
+        @param sloop: Socket loop instance, the completions are passed to its
+            thread.
+        @param num_threads: Number of writer threads.
+        """
+        self._log = logging.getLogger('filewriter')
+        self._sloop = sloop
+        if num_threads > 0:
+            self._executor = ThreadPoolExecutor(
+                max_workers=num_threads, thread_name_prefix='filewriter'
+            )  # type: Optional[ThreadPoolExecutor]
+        else:
+            self._executor = None
+
+    def write(
+        self,
+        writes: Sequence[FileWrite],
+        done_clb: Callable[[Optional[Exception]], None],
+    ) -> None:
+        """Writes the files in the given order.  Each file is synced to disk
+        before the next one is written.  The first failure stops the
+        remaining writes.
+
+        @param writes: Sequence of file pointer, contents and kind of file.
+            The files must not be touched by anyone else until the writes
+            have completed.
+        @param done_clb: Called in the socket loop's thread once the writes
+            have completed.  Passed the exception in case of a failure,
+            otherwise None.
+        """
+        if self._executor is None:
+            done_clb(self._write_all(writes))
+            return
+        self._executor.submit(self._run, writes, done_clb)
+
+    def _run(
+        self,
+        writes: Sequence[FileWrite],
+        done_clb: Callable[[Optional[Exception]], None],
+    ) -> None:
+        exc = self._write_all(writes)
+        self._sloop.call_from_thread(partial(done_clb, exc))
+
+    def _write_all(self, writes: Sequence[FileWrite]) -> Optional[Exception]:
+        for fp, data, kind in writes:
+            start = time.monotonic()
+            try:
+                write_and_sync(fp, data)
+            except Exception as exc:
+                self._log.error('writing %s file failed: %s', kind, exc)
+                return exc
+            M_FILE_WRITE_LATENCY.labels(kind).observe(time.monotonic() - start)
+        return None
+
+    def shutdown(self) -> None:
+        """Waits for the pending writes and stops the threads.  Their
+        completions are not delivered anymore.
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
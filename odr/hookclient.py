@@ -0,0 +1,208 @@
+#!/usr/bin/python3 -S
+#
+# hookclient.py -- OpenVPN client-connect / client-disconnect hook for odrd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""OpenVPN hook that forwards client connects and disconnects to odrd.
+
+The hook is started by OpenVPN for every single client connect and
+disconnect, so it is kept free of dependencies: It only imports a few
+standard library modules and nothing from the odr package.  It can therefore be run
+directly from its file with "python3 -S", which skips the site module:
+
+    client-connect "/usr/bin/python3 -S /usr/lib/odr/hookclient.py connect"
+
+The mode (connect / disconnect) is either passed as first argument or
+derived from the name the hook was called by, e.g. via a symlink named
+"odr-ovpn-connect_<daemon name>".
+"""
+
+import array
+import json
+import os
+import socket
+import sys
+
+CC_RET_FAILED = 0
+CC_RET_SUCCEEDED = 1
+CC_RET_DEFERRED = 2
+
+CMD_SOCKET = '/var/run/odr/cmd.sock'
+
+CONNECT_SCRIPT_NAME = 'odr-ovpn-connect'
+DISCONNECT_SCRIPT_NAME = 'odr-ovpn-disconnect'
+
+MAX_RESPONSE_SIZE = 1024
+
+
+def write_deferred_ret_file(fp, val):
+    """Write one of the deferral values to the deferred return value file.
+
+    @param fp: File pointer of the deferred return value file.
+    @param val: One of the CC_RET_* constants.
+    """
+    fp.seek(0)
+    fp.write(str(val))
+    fp.flush()
+    os.fsync(fp.fileno())
+
+
+def determine_daemon_name(script_name):
+    """We identify the OpenVPN server instance calling us by either looking at
+    an environment variable or by trying to deduce the name from the way we
+    were called.
+
+    @param script_name: The regular base filename of this Python script.
+    @return: Returns the OpenVPN server instance name or None.
+    """
+
+    if 'daemon_name' in os.environ:
+        return os.environ['daemon_name']
+
+    b = os.path.basename(sys.argv[0])
+    if b.startswith(script_name + '_'):
+        return b[len(script_name) + 1 :]
+
+    return None
+
+
+def encode_command(cmd, params):
+    """Encodes a command message the way odrd's command connection expects
+    it.
+
+    @param cmd: Name of the command.
+    @param params: Dictionary of string parameters.
+    @return: Returns the encoded message.
+    """
+    msg = {'cmd': cmd}
+    msg.update(params)
+    return json.dumps(msg).encode('utf-8')
+
+
+def response_status(data):
+    """@param data: The response message sent by odrd.
+    @return: Returns the response's command, i.e. "OK" or "FAIL".
+    """
+    return json.loads(data.decode('utf-8'))['cmd']
+
+
+def send_command(cmd, params, fds=(), socket_path=CMD_SOCKET):
+    """Sends a command to odrd and waits for the response.
+
+    @param cmd: Name of the command.
+    @param params: Dictionary of string parameters.
+    @param fds: File descriptors passed along with the command.
+    @param socket_path: Path of odrd's command socket.
+    @return: Returns the response's command.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+        msg = encode_command(cmd, params)
+        if fds:
+            sock.sendmsg(
+                [msg],
+                [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', fds))],
+            )
+        else:
+            sock.send(msg)
+        data = sock.recv(MAX_RESPONSE_SIZE)
+    finally:
+        sock.close()
+    if not data:
+        raise RuntimeError('no response from odr')
+    return response_status(data)
+
+
+def connect_main(socket_path=CMD_SOCKET):
+    """Entry point of the client-connect hook."""
+    #
+    # Gather configuration
+    #
+
+    cfg_f = open(os.environ['client_connect_config_file'], 'w')
+    ret_f = open(os.environ['client_connect_deferred_file'], 'w')
+    full_username = os.environ['username']
+    daemon_name = determine_daemon_name(script_name=CONNECT_SCRIPT_NAME)
+
+    #
+    # Build and submit command
+    #
+
+    params = {
+        'full_username': full_username,
+        'ret_file_idx': '0',
+        'config_file_idx': '1',
+    }
+    if daemon_name is not None:
+        params['daemon_name'] = daemon_name
+
+    write_deferred_ret_file(ret_f, CC_RET_DEFERRED)
+    try:
+        status = send_command(
+            'request',
+            params,
+            fds=[ret_f.fileno(), cfg_f.fileno()],
+            socket_path=socket_path,
+        )
+        if status != 'OK':
+            raise RuntimeError('starting dhcp request failed (ret: "%s")' % status)
+    except Exception:
+        write_deferred_ret_file(ret_f, CC_RET_FAILED)
+        raise
+
+
+def disconnect_main(socket_path=CMD_SOCKET):
+    """Entry point of the client-disconnect hook."""
+    full_username = os.environ['username']
+    daemon_name = determine_daemon_name(script_name=DISCONNECT_SCRIPT_NAME)
+
+    params = {'full_username': full_username}
+    if daemon_name is not None:
+        params['daemon_name'] = daemon_name
+
+    status = send_command('disconnect', params, socket_path=socket_path)
+    if status != 'OK':
+        raise RuntimeError(
+            'sending disconnect notification failed (ret: "%s")' % status
+        )
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+    if len(argv) > 1:
+        mode = argv[1]
+    else:
+        name = os.path.basename(argv[0])
+        if name.startswith(CONNECT_SCRIPT_NAME):
+            mode = 'connect'
+        elif name.startswith(DISCONNECT_SCRIPT_NAME):
+            mode = 'disconnect'
+        else:
+            mode = None
+
+    if mode == 'connect':
+        connect_main()
+    elif mode == 'disconnect':
+        disconnect_main()
+    else:
+        sys.stderr.write('usage: %s connect|disconnect\n' % argv[0])
+        return 2
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,213 @@
+"""Persistent store of the DHCP leases of connected clients.
+
+The leases are kept in memory and logged to an append-only file with one
+JSON object per line.  Each line either records a lease or deletes it, later
+lines override earlier ones.  Once the log has grown to a multiple of the
+number of live leases, it is compacted by rewriting it with only the live
+leases.  The rewritten log is synced to disk on the file writer's threads,
+so that the socket loop isn't held up.
+"""
+
+import json
+import logging
+import os
+import time
+
+from functools import partial
+from typing import Dict, List, NamedTuple, Optional, TextIO, Tuple
+
+from odr.filewriter import FileWriterPool, write_and_sync
+
+
+class Lease(NamedTuple):
+    ip_address: str
+    renewal_timeout: Optional[float]
+    rebinding_timeout: float
+    lease_timeout: float
+    server_ip: Optional[str] = None
+
+
+class LeaseDb:
+    """Maps full username and server name to the client's last known DHCP
+    lease.
+    """
+
+    # Minimum number of log lines before compaction is considered.
+    COMPACT_MIN_LINES = 1024
+
+    def __init__(self, path: str, file_writer: FileWriterPool = None) -> None:
+        """Loads the leases stored in the file at path.  Expired leases are
+        dropped.
+
+        @param path: Path of the log file.  It is created if missing.
+        @param file_writer: FileWriterPool instance used for compacting the
+            log.  Without one, the log is compacted right away.
+        """
+        self._log = logging.getLogger('leasedb')
+        self._path = path
+        self._file_writer = file_writer
+        self._leases = {}  # type: Dict[Tuple[str, str], Lease]
+        self._num_lines = 0
+        # Lines logged while a compaction is in progress, None otherwise.
+        self._backlog = None  # type: Optional[List[str]]
+        self._load()
+        self._compact()
+
+    def _load(self) -> None:
+        try:
+            f = open(self._path, 'r', encoding='utf-8')
+        except FileNotFoundError:
+            return
+        with f:
+            for line_no, line in enumerate(f, 1):
+                try:
+                    entry = json.loads(line)
+                    key = (entry['user'], entry['server'])
+                    if entry.get('deleted'):
+                        self._leases.pop(key, None)
+                    else:
+                        self._leases[key] = Lease(
+                            entry['ip'],
+                            entry['renewal'],
+                            entry['rebinding'],
+                            entry['lease'],
+                            entry.get('server_ip'),
+                        )
+                except (ValueError, KeyError, TypeError):
+                    # Most likely a partially written last line.
+                    self._log.warning(
+                        'ignoring invalid line %d in %s', line_no, self._path
+                    )
+
+        now = time.time()
+        for key, lease in list(self._leases.items()):
+            if lease.lease_timeout <= now:
+                del self._leases[key]
+        self._log.info('loaded %d leases from %s', len(self._leases), self._path)
+
+    @property
+    def _tmp_path(self) -> str:
+        return self._path + '.tmp'
+
+    @staticmethod
+    def _encode(entry: dict) -> str:
+        return json.dumps(entry, separators=(',', ':')) + '\n'
+
+    def _write_line(self, entry: dict) -> None:
+        line = self._encode(entry)
+        self._file.write(line)
+        self._num_lines += 1
+        if self._backlog is not None:
+            self._backlog.append(line)
+
+    def _dump(self) -> str:
+        """@return: Returns the log lines of all live leases.
+        """
+        return ''.join(
+            self._encode(self._lease_entry(full_username, server_name, lease))
+            for (full_username, server_name), lease in self._leases.items()
+        )
+
+    def _compact(self) -> None:
+        """Rewrites the log with only the live leases and reopens it for
+        appending.  The new log atomically replaces the old one.
+        """
+        with open(self._tmp_path, 'w', encoding='utf-8') as f:
+            write_and_sync(f, self._dump())
+        os.replace(self._tmp_path, self._path)
+        self._file = open(self._path, 'a', encoding='utf-8')
+        self._num_lines = len(self._leases)
+
+    def _maybe_compact(self) -> None:
+        if self._backlog is not None or self._num_lines < max(
+            self.COMPACT_MIN_LINES, 4 * len(self._leases)
+        ):
+            return
+        if self._file_writer is None:
+            self._file.close()
+            self._compact()
+            return
+        # Meanwhile, changes are still appended to the old log.  They are
+        # copied to the new log once it replaced the old one.
+        self._backlog = []
+        tmp_f = open(self._tmp_path, 'w', encoding='utf-8')
+        self._file_writer.write(
+            [(tmp_f, self._dump(), 'leasedb')],
+            partial(self._compacted, tmp_f, len(self._leases)),
+        )
+
+    def _compacted(
+        self, tmp_f: TextIO, num_lines: int, exc: Optional[Exception]
+    ) -> None:
+        """Called as soon as the rewritten log has been synced to disk.
+        Replaces the old log with it.
+
+        @param tmp_f: File pointer of the rewritten log.
+        @param num_lines: Number of lines in the rewritten log.
+        @param exc: The exception in case writing failed, otherwise None.
+        """
+        tmp_f.close()
+        backlog, self._backlog = self._backlog, None
+        if self._file.closed:
+            return
+        if exc is not None:
+            # Keep using the old log.  Compaction is retried with the next
+            # change.
+            return
+        os.replace(self._tmp_path, self._path)
+        self._file.close()
+        self._file = open(self._path, 'a', encoding='utf-8')
+        self._file.write(''.join(backlog))
+        self._file.flush()
+        self._num_lines = num_lines + len(backlog)
+
+    @staticmethod
+    def _lease_entry(full_username: str, server_name: str, lease: Lease) -> dict:
+        return {
+            'user': full_username,
+            'server': server_name,
+            'ip': lease.ip_address,
+            'renewal': lease.renewal_timeout,
+            'rebinding': lease.rebinding_timeout,
+            'lease': lease.lease_timeout,
+            'server_ip': lease.server_ip,
+        }
+
+    def get(self, full_username: str, server_name: str) -> Optional[Lease]:
+        """@return: Returns the client's last recorded lease or None.  Leases
+            that have expired are not returned.
+        """
+        lease = self._leases.get((full_username, server_name))
+        if lease is None or lease.lease_timeout <= time.time():
+            return None
+        return lease
+
+    def store(self, full_username: str, server_name: str, lease: Lease) -> None:
+        """Records the client's current lease.
+        """
+        self._leases[(full_username, server_name)] = lease
+        self._write_line(self._lease_entry(full_username, server_name, lease))
+        # The data only needs to survive a restart of the daemon, not of the
+        # machine, so there's no need to sync it to disk.
+        self._file.flush()
+        self._maybe_compact()
+
+    def remove(self, full_username: str, server_name: str) -> None:
+        """Forgets the client's lease.
+        """
+        if self._leases.pop((full_username, server_name), None) is None:
+            return
+        self._write_line(
+            {'user': full_username, 'server': server_name, 'deleted': True}
+        )
+        self._file.flush()
+        self._maybe_compact()
+
+    def __len__(self) -> int:
+        return len(self._leases)
+
+    def close(self) -> None:
+        """Closes the log.  A compaction still in progress is abandoned, the
+        old log remains complete.
+        """
+        self._file.close()
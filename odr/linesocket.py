@@ -21,13 +21,22 @@
 class LineSocket:
     """The LineSocket class wraps around a regular socket object.  Instead of
     byte blobs, the class allows lines to be received.
+
+    Data is received directly into a growable buffer.  Each byte is only
+    searched for line endings once, and only the incomplete last line is
+    kept in the buffer between calls.
     """
 
+    # Number of bytes to read at least per call.
+    RECV_SIZE = 65536
+
     def __init__(self, socket):
         """@param socket: The socket that is used to receive the line data from
         """
         self._socket = socket
-        self._in_buf = b''
+        self._in_buf = bytearray(self.RECV_SIZE)
+        # Number of bytes of _in_buf in use, i.e. the incomplete line.
+        self._in_len = 0
 
     def __del__(self):
         self.close()
@@ -41,25 +50,44 @@ class LineSocket:
     def recvlines(self):
         """Receives data from the socket.  The received data is buffered until
         a complete line can be retrieved.  Each call of this method will return
-        the next completed line(s).
+        the next completed line(s).  CR LF line endings are replaced by LF.
 
         @return: Returns None in case of EOF, otherwise the list of completed
             lines.
         """
-        new_data = self._socket.recv(1024)
-        self._in_buf += new_data.replace(b'\r\n', b'\n')
-        lines = self._in_buf.split(b'\n')
-        # Add back new-line character to all but the last lines.
-        for l in range(len(lines) - 1):
-            lines[l] = lines[l] + b'\n'
-        if new_data == b'':
+        buf = self._in_buf
+        scan_pos = self._in_len
+        if len(buf) - scan_pos < self.RECV_SIZE:
+            # The incomplete line is too long for the buffer.
+            buf.extend(bytes(len(buf)))
+        with memoryview(buf) as view:
+            received = self._socket.recv_into(view[scan_pos:])
+        if received == 0:
             # Received EOF.  Return any incomplete lines.
-            self._in_buf = b''
-            if len(lines) == 1 and lines[0] == b'':
+            self._in_len = 0
+            if scan_pos == 0:
                 return None
-        else:
-            # Store incomplete line-fragment.
-            self._in_buf = lines.pop()
+            return [bytes(buf[:scan_pos])]
+
+        end = scan_pos + received
+        lines = []
+        start = 0
+        with memoryview(buf) as view:
+            while True:
+                pos = buf.find(b'\n', scan_pos, end)
+                if pos < 0:
+                    break
+                if pos > start and buf[pos - 1] == 0x0D:
+                    # Turn "\r\n" into "\n".
+                    buf[pos - 1] = 0x0A
+                    lines.append(view[start:pos].tobytes())
+                else:
+                    lines.append(view[start : pos + 1].tobytes())
+                start = scan_pos = pos + 1
+        # Move the incomplete line to the front.
+        self._in_len = end - start
+        if start > 0 and self._in_len > 0:
+            buf[: self._in_len] = buf[start:end]
         return lines
 
     def send(self, msg):
@@ -68,6 +96,12 @@ class LineSocket:
         """
         return self._socket.send(msg)
 
+    def sendall(self, msg):
+        """Sends all data via the underlying socket.
+        @param msg: The byte string to send via the socket.
+        """
+        self._socket.sendall(msg)
+
     def fileno(self):
         """@return: Returns the file descriptor number of the underlying socket
         """
@@ -0,0 +1,230 @@
+"""Batched datagram I/O for IPv4 UDP sockets.
+
+Uses the recvmmsg(2) and sendmmsg(2) system calls via ctypes where they are
+available and falls back to one recvfrom / sendto call per datagram
+otherwise.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import socket
+
+from typing import List, Sequence, Tuple
+
+Address = Tuple[str, int]
+
+
+class _IoVec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+
+
+class _SockAddrIn(ctypes.Structure):
+    _fields_ = [
+        ('sin_family', ctypes.c_ushort),
+        ('sin_port', ctypes.c_uint16),
+        ('sin_addr', ctypes.c_uint8 * 4),
+        ('sin_zero', ctypes.c_uint8 * 8),
+    ]
+
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [
+        ('msg_name', ctypes.c_void_p),
+        ('msg_namelen', ctypes.c_uint32),
+        ('msg_iov', ctypes.POINTER(_IoVec)),
+        ('msg_iovlen', ctypes.c_size_t),
+        ('msg_control', ctypes.c_void_p),
+        ('msg_controllen', ctypes.c_size_t),
+        ('msg_flags', ctypes.c_int),
+    ]
+
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', _MsgHdr), ('msg_len', ctypes.c_uint)]
+
+
+def _load_libc_func(name: str):
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        func = getattr(libc, name)
+    except (OSError, AttributeError):
+        return None
+    func.restype = ctypes.c_int
+    return func
+
+
+_recvmmsg = _load_libc_func('recvmmsg')
+if _recvmmsg is not None:
+    _recvmmsg.argtypes = [
+        ctypes.c_int,
+        ctypes.POINTER(_MMsgHdr),
+        ctypes.c_uint,
+        ctypes.c_int,
+        ctypes.c_void_p,
+    ]
+
+_sendmmsg = _load_libc_func('sendmmsg')
+if _sendmmsg is not None:
+    _sendmmsg.argtypes = [
+        ctypes.c_int,
+        ctypes.POINTER(_MMsgHdr),
+        ctypes.c_uint,
+        ctypes.c_int,
+    ]
+
+HAVE_RECVMMSG = _recvmmsg is not None
+HAVE_SENDMMSG = _sendmmsg is not None
+
+
+def _raise_errno() -> None:
+    err = ctypes.get_errno()
+    raise OSError(err, errno.errorcode.get(err, 'unknown error'))
+
+
+class BatchReceiver:
+    """Receives up to batch_size waiting datagrams from a socket at once.  The
+    datagrams are received into a buffer pool that is allocated once and
+    reused for every batch.
+
+    Note: The received data is only valid until the next call of recv().
+    """
+
+    def __init__(
+        self, batch_size: int, buffer_size: int = 2048, use_mmsg: bool = True
+    ) -> None:
+        """\
+        @param batch_size: Maximum number of datagrams received per call.
+        @param buffer_size: Maximum size of each datagram.  Longer datagrams
+            are truncated.
+        @param use_mmsg: Use recvmmsg(2) if it is available.
+        """
+        self._batch_size = batch_size
+        self._buffer_size = buffer_size
+        self._pool = bytearray(batch_size * buffer_size)
+        pool_view = memoryview(self._pool)
+        self._buffers = [
+            pool_view[i * buffer_size : (i + 1) * buffer_size]
+            for i in range(batch_size)
+        ]
+        self._use_mmsg = use_mmsg and HAVE_RECVMMSG
+        if self._use_mmsg:
+            self._setup_mmsg()
+
+    def _setup_mmsg(self) -> None:
+        self._c_pool = (ctypes.c_char * len(self._pool)).from_buffer(self._pool)
+        pool_addr = ctypes.addressof(self._c_pool)
+        self._addrs = (_SockAddrIn * self._batch_size)()
+        self._iovecs = (_IoVec * self._batch_size)()
+        self._msgs = (_MMsgHdr * self._batch_size)()
+        for i in range(self._batch_size):
+            self._iovecs[i].iov_base = pool_addr + i * self._buffer_size
+            self._iovecs[i].iov_len = self._buffer_size
+            hdr = self._msgs[i].msg_hdr
+            hdr.msg_name = ctypes.addressof(self._addrs[i])
+            hdr.msg_iov = ctypes.pointer(self._iovecs[i])
+            hdr.msg_iovlen = 1
+
+    def recv(self, sock: socket.socket) -> List[Tuple[memoryview, Address]]:
+        """Receives all waiting datagrams, up to the batch size, without
+        blocking.
+
+        @param sock: The IPv4 datagram socket to receive from.
+        @return: Returns a list of data and source address tuples.  The list
+            is empty if no datagram was waiting.
+        """
+        if self._use_mmsg:
+            return self._recv_mmsg(sock)
+        return self._recv_single(sock)
+
+    def _recv_mmsg(self, sock: socket.socket) -> List[Tuple[memoryview, Address]]:
+        for i in range(self._batch_size):
+            self._msgs[i].msg_hdr.msg_namelen = ctypes.sizeof(_SockAddrIn)
+        num = _recvmmsg(
+            sock.fileno(), self._msgs, self._batch_size, socket.MSG_DONTWAIT, None
+        )
+        if num < 0:
+            if ctypes.get_errno() in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return []
+            _raise_errno()
+        received = []
+        for i in range(num):
+            addr = self._addrs[i]
+            source_address = (
+                socket.inet_ntoa(bytes(addr.sin_addr)),
+                socket.ntohs(addr.sin_port),
+            )
+            length = min(self._msgs[i].msg_len, self._buffer_size)
+            received.append((self._buffers[i][:length], source_address))
+        return received
+
+    def _recv_single(self, sock: socket.socket) -> List[Tuple[memoryview, Address]]:
+        received = []
+        for buf in self._buffers:
+            try:
+                length, source_address = sock.recvfrom_into(
+                    buf, 0, socket.MSG_DONTWAIT
+                )
+            except BlockingIOError:
+                break
+            received.append((buf[:length], source_address))
+        return received
+
+
+def send_batch(
+    sock: socket.socket,
+    datagrams: Sequence[Tuple[bytes, Address]],
+    use_mmsg: bool = True,
+) -> int:
+    """Sends datagrams without blocking, with a single sendmmsg(2) call
+    where available.
+
+    @param sock: The IPv4 datagram socket to send from.
+    @param datagrams: Sequence of data and destination address tuples.
+    @param use_mmsg: Use sendmmsg(2) if it is available.
+    @return: Returns the number of datagrams sent.  Sending stops early if
+        the socket's send buffer is full or at the first datagram that fails.
+    @raises OSError: If sending the first datagram failed.
+    """
+    if not datagrams:
+        return 0
+    if not (use_mmsg and HAVE_SENDMMSG):
+        sent = 0
+        for data, address in datagrams:
+            try:
+                sock.sendto(data, socket.MSG_DONTWAIT, address)
+            except BlockingIOError:
+                break
+            except OSError:
+                # Like sendmmsg(2), only report the error if nothing was sent.
+                if sent == 0:
+                    raise
+                break
+            sent += 1
+        return sent
+
+    num = len(datagrams)
+    addrs = (_SockAddrIn * num)()
+    iovecs = (_IoVec * num)()
+    msgs = (_MMsgHdr * num)()
+    # Keep the data buffers alive until the call returns.
+    bufs = []  # type: List[ctypes.Array]
+    for i, (data, (ip, port)) in enumerate(datagrams):
+        addrs[i].sin_family = socket.AF_INET
+        addrs[i].sin_port = socket.htons(port)
+        addrs[i].sin_addr[:] = socket.inet_aton(ip)
+        buf = ctypes.create_string_buffer(bytes(data), len(data))
+        bufs.append(buf)
+        iovecs[i].iov_base = ctypes.addressof(buf)
+        iovecs[i].iov_len = len(data)
+        hdr = msgs[i].msg_hdr
+        hdr.msg_name = ctypes.addressof(addrs[i])
+        hdr.msg_namelen = ctypes.sizeof(_SockAddrIn)
+        hdr.msg_iov = ctypes.pointer(iovecs[i])
+        hdr.msg_iovlen = 1
+    sent = _sendmmsg(sock.fileno(), msgs, num, socket.MSG_DONTWAIT)
+    if sent < 0:
+        if ctypes.get_errno() in (errno.EAGAIN, errno.EWOULDBLOCK):
+            return 0
+        _raise_errno()
+    return sent
@@ -25,6 +25,7 @@ import os
 import pwd
 import random
 import re
+import selectors
 import signal
 import socket
 import sys
@@ -44,7 +45,19 @@ import odr.dhcprequestor
 import odr.listeningsocket
 import odr.ovpn as ovpn
 
+from .admission import AdmissionController
+from .asyncloop import AsyncioSocketLoop, AsyncioTimeoutManager, new_event_loop
 from .cmdconnection import CommandConnection, CommandConnectionListener
+from .filewriter import FileWriterPool, write_and_sync
+from .leasedb import Lease, LeaseDb
+from .refreshscheduler import RefreshKey, RefreshScheduler
+from .dhcpworker import (
+    DhcpWorkerClient,
+    DhcpWorkerPool,
+    DhcpWorkerServer,
+    assign_shards,
+    create_worker_socketpair,
+)
 from .ovpn_config import OvpnConf
 from .parse import ParseUsername
 from .config import cfg_iterate, split_cfg_list
@@ -64,31 +77,57 @@ CONFIG_FILE = '/etc/odr.conf'
 class OvpnClient:
     """Represents an OpenVPN client connected to a specific OpenVPN server
     instance.
+
+    The client's DHCP lease is refreshed like a DHCP client would (RFC 2131,
+    section 4.4.5): Starting at the renewal time (T1), the refresh requests are
+    only sent to the DHCP server that granted the lease (RENEWING).  Starting
+    at the rebinding time (T2), they are sent to all of the realm's DHCP
+    servers (REBINDING).  Failed refreshes are retried after half of the
+    remaining time until T2 or the lease's expiry, but at most every
+    REFRESH_RETRY_MIN_INTERVAL seconds.  The client is only disconnected once
+    the lease has expired.
+
+    To smooth the load on the DHCP servers, the refresh scheduler may move the
+    refresh at T1 or T2 up to half of the remaining time earlier.
     """
 
+    REFRESH_RETRY_MIN_INTERVAL = 60
+
     def __init__(
         self,
         timeout_mgr: TimeoutManager,
-        refresh_lease_clb,
+        refresh_scheduler: RefreshScheduler,
         full_username: str,
         server: ovpn.OvpnServer,
         realm_data: RealmData,
         leased_ip_address=None,
         rebinding_timeout: int = None,
         lease_timeout: int = None,
+        renewal_timeout: int = None,
+        server_ip: str = None,
+        lease_db: LeaseDb = None,
     ) -> None:
         self._timeout_mgr = timeout_mgr
-        self._refresh_lease = refresh_lease_clb
+        self._refresh_scheduler = refresh_scheduler
         self.full_username = full_username
         self.server = server
         self._realm_data = realm_data
         self._leased_ip_address = leased_ip_address
         self._rebinding_timeout = rebinding_timeout
         self._lease_timeout = lease_timeout
+        self._renewal_timeout = renewal_timeout
+        self._server_ip = server_ip
+        self._lease_db = lease_db
 
         self._timeout_obj = None  # type: Optional[TimeoutObject]
+        # Refresh slot reserved for the next refresh, until it is started.
+        self._reserved_slot = None  # type: Optional[Tuple[RefreshKey, float]]
         self._log = logging.getLogger('ovpnclient')
         self._killed = False
+        # Number of the latest client list sync that knew of the client.
+        self.sync_count = 0
+        # The client's connection ID, if reported by a client notification.
+        self.cid = None  # type: Optional[int]
 
     def __str__(self) -> str:
         return '{} on {}'.format(self.full_username, self.server)
@@ -108,14 +147,75 @@ class OvpnClient:
                 self,
             )
             return
-        self._timeout_obj = TimeoutObject(self._rebinding_timeout, self.handle_timeout)
+        if self._renewal_timeout is not None and self._server_ip is not None:
+            due_time = min(self._renewal_timeout, self._rebinding_timeout)
+            server_ips = [self._server_ip]
+        else:
+            due_time = self._rebinding_timeout
+            server_ips = self._realm_data.dhcp_server_ips
+        now = time.time()
+        self._release_slot()
+        key = self._refresh_key(server_ips)
+        start_time = self._refresh_scheduler.reserve_slot(
+            key,
+            due_time=due_time,
+            earliest_time=now + (due_time - now) / 2,
+            latest_time=self._lease_timeout,
+        )
+        self._reserved_slot = (key, start_time)
+        self._schedule_refresh(start_time)
+
+    def _refresh_key(self, server_ips):
+        return (self._realm_data.name, tuple(server_ips))
+
+    def _release_slot(self) -> None:
+        """Releases the reserved refresh slot, if the refresh has not been
+        started yet.
+        """
+        if self._reserved_slot is not None:
+            self._refresh_scheduler.release_slot(*self._reserved_slot)
+            self._reserved_slot = None
+
+    def _schedule_refresh(self, timeout_time) -> None:
+        self._timeout_obj = TimeoutObject(timeout_time, self.handle_timeout)
         self._timeout_mgr.add_timeout_object(self._timeout_obj)
 
+    @property
+    def _renewing(self) -> bool:
+        """@return: Returns True while the lease should be renewed with the
+            DHCP server that granted it, i.e. before the rebinding time.
+        """
+        return self._server_ip is not None and time.time() < self._rebinding_timeout
+
+    def record_lease(self) -> None:
+        """Store the current lease in the lease database, if there is one.
+        Leases with unknown expiry time are not stored.
+        """
+        if (
+            self._lease_db is None
+            or self._leased_ip_address is None
+            or self._rebinding_timeout is None
+            or self._lease_timeout is None
+        ):
+            return
+        self._lease_db.store(
+            self.full_username,
+            self.server.name,
+            Lease(
+                self._leased_ip_address,
+                self._renewal_timeout,
+                self._rebinding_timeout,
+                self._lease_timeout,
+                self._server_ip,
+            ),
+        )
+
     def kill(self) -> None:
         """Disable the client.  Although any pending activities will continue,
         no new activities will be started.
         """
         self._killed = True
+        self._release_slot()
 
     @property
     def iszombie(self) -> bool:
@@ -125,14 +225,17 @@ class OvpnClient:
         return self._killed
 
     def handle_timeout(self) -> None:
-        """Called as soon as the rebinding timeout occurs.
+        """Called as soon as the lease needs to be refreshed, i.e. at the
+        renewal or rebinding timeout or when a failed refresh is retried.
         """
         if self.iszombie:
             return
+        # The slot is used up, whether the refresh is started or not.
+        self._reserved_slot = None
 
         if self._lease_timeout is not None and self._lease_timeout <= time.time():
             self._log.warning(
-                'Rebinding timeout for %s called too late - '
+                'Lease refresh for %s called too late - '
                 'lease has already expired on %d.  Disconnecting client.',
                 self,
                 self._lease_timeout,
@@ -140,6 +243,13 @@ class OvpnClient:
             self.server.disconnect_client(self.full_username)
             return
 
+        if self._renewing:
+            self._log.debug('renewing lease of %s with %s', self, self._server_ip)
+            server_ips = [self._server_ip]
+        else:
+            self._log.debug('rebinding lease of %s', self)
+            server_ips = self._realm_data.dhcp_server_ips
+
         target_addr: Optional[IPv4Address]
         if self._realm_data.subnet_ipv4:
             target_addr = IPv4Network(self._realm_data.subnet_ipv4).network_address
@@ -147,16 +257,18 @@ class OvpnClient:
             target_addr = None
 
         try:
-            self._refresh_lease(
+            self._refresh_scheduler.start_refresh(
+                self._refresh_key(server_ips),
                 success_handler_clb=self._handle_lease_refresh_succeeded,
                 failure_handler_clb=self._handle_lease_refresh_failed,
                 client_identifier=self.full_username,
                 device=self._realm_data.dhcp_listening_device,
                 local_ip=self._realm_data.dhcp_listening_ip,
-                server_ips=self._realm_data.dhcp_server_ips,
+                server_ips=server_ips,
                 target_addr=target_addr,
                 client_ip=self._leased_ip_address,
                 lease_time=self._realm_data.expected_dhcp_lease_time,
+                realm=self._realm_data.name,
             )
         except Exception:
             self._log.exception('Adding a new DHCP refresh request failed')
@@ -176,18 +288,57 @@ class OvpnClient:
         rebinding_timeout = res['rebinding_timeout']  # type: int
         self._rebinding_timeout = rebinding_timeout
         self._lease_timeout = res['lease_timeout']
-        self._timeout_obj = TimeoutObject(self._rebinding_timeout, self.handle_timeout)
-        self._timeout_mgr.add_timeout_object(self._timeout_obj)
+        self._renewal_timeout = res.get('renewal_timeout')
+        self._server_ip = res.get('server_ip')
+        self.record_lease()
+        self.track_lease()
 
     def _handle_lease_refresh_failed(self) -> None:
         """Called as soon as the DHCP refresh request has completed and
-        failed or has timed out.  Takes care of disconnecting the client, as
-        the lease has obviously no chance of remaining established.
+        failed or has timed out.  Retries the refresh later, as long as the
+        lease has not expired yet.  Otherwise takes care of disconnecting the
+        client, as the lease has obviously no chance of remaining established.
         """
         if self.iszombie:
             return
 
-        self.server.disconnect_client(self.full_username)
+        now = time.time()
+        if self._lease_timeout is None or self._lease_timeout <= now:
+            self._log.warning('Lease refresh for %s failed, disconnecting', self)
+            self.server.disconnect_client(self.full_username)
+            return
+
+        if self._renewing:
+            deadline = self._rebinding_timeout
+        else:
+            deadline = self._lease_timeout
+        # Randomise the interval a bit, so that clients that failed together
+        # don't retry together.
+        interval = max(
+            (deadline - now) / 2 * random.uniform(0.9, 1.1),
+            self.REFRESH_RETRY_MIN_INTERVAL,
+        )
+        retry_time = min(now + interval, deadline)
+        self._log.info(
+            'Lease refresh for %s failed, retrying in %ds', self, retry_time - now
+        )
+        self._release_slot()
+        self._schedule_refresh(retry_time)
+
+
+class _ServerSyncState:
+    """Keeps track of the client list syncs with a single OpenVPN server.
+    """
+
+    def __init__(self, interval) -> None:
+        # Current interval between two syncs.
+        self.interval = interval
+        # Time at which the next sync is due.
+        self.next_sync = 0.0
+        # Management connection the latest sync was started on.
+        self.mgmt_connections = -1
+        # Number of clients the latest sync found to differ.
+        self.differences = 0
 
 
 class OvpnClientManager:
@@ -195,7 +346,11 @@ class OvpnClientManager:
     servers.  Takes care of regularly refreshing the client's DHCP leases.
 
     Periodically polls the OpenVPN servers to sync the list of connected
-    clients.
+    clients.  Servers that report connected and disconnected clients via
+    client notifications are only polled as a consistency check: The polling
+    interval doubles with every poll that matches the tracked clients, up to
+    a maximum, and falls back to the regular interval on any difference or
+    after the management connection was re-established.
 
     Note: Some clients might still be tracked by the manager, but already marked
           as killed.  These zombies should be collected as soon as the client-
@@ -209,8 +364,10 @@ class OvpnClientManager:
         realms_data: Dict[str, RealmData],
         parse_username_clb,
         servers,
-        refresh_lease_clb,
+        refresh_scheduler: RefreshScheduler,
         sync_interval=60,
+        lease_db: LeaseDb = None,
+        max_sync_interval=900,
     ) -> None:
         """\
         @param timeout_mgr: Reference to a timeout manager.
@@ -218,15 +375,21 @@ class OvpnClientManager:
         @param parse_username_clb: Call-back to parse the full_username into
             its components.
         @param servers: List of OpenVPN servers to query.
-        @param refresh_lease_clb: Callback for refreshing a DHCP lease.
+        @param refresh_scheduler: Scheduler for refreshing DHCP leases.
         @param sync_interval: Intervall in which to poll the servers.
+        @param lease_db: Lease database that keeps the client's leases across
+            restarts.  Optional.
+        @param max_sync_interval: Maximum intervall in which to poll servers
+            that send client notifications.
         """
         self._timeout_mgr = timeout_mgr
         self._realms_data = realms_data
         self._parse_username = parse_username_clb
         self._servers = servers
-        self._refresh_lease = refresh_lease_clb
+        self._refresh_scheduler = refresh_scheduler
         self._sync_interval = sync_interval
+        self._max_sync_interval = max(sync_interval, max_sync_interval)
+        self._lease_db = lease_db
 
         self._log = logging.getLogger('ovpnclientmgr')
         self._clients_by_username = {}  # type: Dict[str, OvpnClient]
@@ -234,6 +397,11 @@ class OvpnClientManager:
         self._clients_by_server = {}  # type: Dict[str, Dict[str, OvpnClient]]
         for server in self._servers.values():
             self._clients_by_server[server] = {}
+        # Number of the latest client list sync.
+        self._sync_count = 0
+        self._sync_states = {}  # type: Dict[ovpn.OvpnServer, _ServerSyncState]
+        for server in self._servers.values():
+            self._sync_states[server] = _ServerSyncState(sync_interval)
 
         self._timeout_mgr.add_rel_timeout(0, WeakBoundMethod(self._on_sync_clients))
 
@@ -244,11 +412,13 @@ class OvpnClientManager:
         """
         client = OvpnClient(
             timeout_mgr=self._timeout_mgr,
-            refresh_lease_clb=self._refresh_lease,
+            refresh_scheduler=self._refresh_scheduler,
+            lease_db=self._lease_db,
             **kwargs
         )
         client.track_lease()
         self._add_client(client)
+        client.record_lease()
         return client
 
     def _add_client(self, client) -> None:
@@ -264,10 +434,13 @@ class OvpnClientManager:
         else:
             self._log.debug('adding new client instance: %s', client)
 
+        # Clients added while a sync is in progress might not be part of the
+        # client list.  Make sure they survive the sync.
+        client.sync_count = self._sync_count
         self._clients_by_username[client.full_username] = client
         self._clients_by_server[client.server][client.full_username] = client
 
-    def sync_clients(self) -> None:
+    def sync_clients(self, servers=None) -> None:
         """Syncs the client list with the client lists of each OpenVPN server.
 
         Any client connected to the server but not listed by us needs to be
@@ -276,71 +449,151 @@ class OvpnClientManager:
 
         Any clients that are listed by us but no longer listed by the OpenVPN
         server are removed from our list.  They have been disconnected.
+
+        The servers' client lists are processed while they are received.  Each
+        listed client is marked with the sync's number.  Once a list is
+        complete, the server's clients with an older mark are removed.
+
+        @param servers: The servers to sync with.  Defaults to all servers.
         """
-        for server in self._servers.values():
+        if servers is None:
+            servers = self._servers.values()
+        self._sync_count += 1
+        for server in servers:
+            state = self._sync_states[server]
+            state.mgmt_connections = server.mgmt_connections
+            state.differences = 0
+            # In case the poll never completes.
+            state.next_sync = time.time() + state.interval
             # Asynchronously retrieve the list of clients against which to sync.
-            server.poll_client_list(partial(self._sync_clients_with, server=server))
+            server.poll_client_list(
+                partial(
+                    self._sync_listed_client, server=server, sync_count=self._sync_count
+                ),
+                partial(self._finish_sync, server=server, sync_count=self._sync_count),
+            )
 
     def _on_sync_clients(self) -> None:
         """Timeout event handler to regularly sync clients.  See sync_clients().
         """
-        self.sync_clients()
+        now = time.time()
+        servers = [
+            server for server in self._servers.values() if self._sync_due(server, now)
+        ]
+        if servers:
+            self.sync_clients(servers)
         self._timeout_mgr.add_rel_timeout(
             self._sync_interval, WeakBoundMethod(self._on_sync_clients)
         )
 
-    def _sync_clients_with(self, client_data_list, server) -> None:
-        """Called per-server as soon as the server's client data list has
-        been retrieved.  Performs the actual processing as documented for
-        sync_clients().
+    def _sync_due(self, server, now) -> bool:
+        if not server.uses_client_auth:
+            # Without client notifications, polling is the only source.
+            return True
+        state = self._sync_states[server]
+        if server.mgmt_connections != state.mgmt_connections:
+            # Client notifications might have been missed while the management
+            # connection was down.
+            state.interval = self._sync_interval
+            return True
+        return now >= state.next_sync
+
+    def _sync_listed_client(
+        self, common_name, virtual_address, server, sync_count
+    ) -> None:
+        """Called for each client of a server's client list, while the list is
+        received.  Adds the client if it is unknown so far.
         """
-        if client_data_list is None:
-            self._log.error('syncing the client list with server %s failed', server)
+        self._log.debug('client_data: "%s" with "%s"', common_name, virtual_address)
+        if virtual_address is None:
+            # Connection hasn't been fully established yet.  Skip it.
             return
 
-        client_data_by_username = {}
+        client = self._clients_by_username.get(common_name)
+        if client is not None and client.server == server:
+            client.sync_count = max(client.sync_count, sync_count)
+            return
+        self._sync_states[server].differences += 1
+        self._detect_client(common_name, virtual_address, server)
 
-        for client_data in client_data_list:
-            self._log.debug(
-                'client_data: "%s" with "%s"',
-                client_data.common_name,
-                client_data.virtual_address,
+    def _finish_sync(self, server, sync_count) -> None:
+        """Called per-server as soon as the server's client list has been
+        received completely.  Removes the clients that weren't listed.
+        """
+        stale_clients = [
+            client
+            for client in self._clients_by_server[server].values()
+            if client.sync_count < sync_count
+        ]
+        for client in stale_clients:
+            # The client has been disconnected.
+            if not client.iszombie:
+                self._log.debug(
+                    'cleaning up: client %s was disconnected in the mean-while',
+                    client,
+                )
+            else:
+                self._log.debug('cleaning up: removing zombie client %s', client)
+            self._del_client(client)
+
+        if not server.uses_client_auth:
+            return
+        state = self._sync_states[server]
+        state.differences += len(stale_clients)
+        if state.differences > 0:
+            self._log.info(
+                'client list of server %s differed in %d clients',
+                server,
+                state.differences,
             )
-            if client_data.virtual_address is None:
-                # Connection hasn't been fully established yet.  Skip it.
-                continue
+            state.interval = self._sync_interval
+        else:
+            state.interval = min(2 * state.interval, self._max_sync_interval)
+        state.next_sync = time.time() + state.interval
+
+    def handle_client_event(self, server, event) -> None:
+        """Called for each complete client notification of a server.  Keeps
+        track of established and disconnected clients in real time.
+        @param server: The OpenVPN server the notification came from.
+        @param event: The OvpnClientEvent.
+        """
+        full_username = event.common_name
+        if full_username is None or server not in self._clients_by_server:
+            return
+        if event.event_type == 'ESTABLISHED':
+            client = self._clients_by_username.get(full_username)
+            if client is None or client.server != server:
+                # The client wasn't authorised by us, e.g. before a restart.
+                if event.virtual_address is None:
+                    return
+                self._detect_client(full_username, event.virtual_address, server)
+                client = self._clients_by_server[server].get(full_username)
+            if client is not None:
+                client.cid = event.cid
+        elif event.event_type == 'DISCONNECT':
+            client = self._clients_by_server[server].get(full_username)
+            if client is None or client.cid != event.cid:
+                # Unknown connection or superseded by a newer connection of
+                # the same client.
+                return
+            self._log.debug('disconnected %s', client)
+            self._del_client(client)
 
-            client_data_by_username[client_data.common_name] = client_data
-
-            if client_data.common_name in self._clients_by_username:
-                client = self._clients_by_username[client_data.common_name]
-                if client.server != server:
-                    # The client has jumped servers.  Remove it from the list.
-                    self._log.debug(
-                        'cleaning up: client %s has moved to server "%s"',
-                        client,
-                        server,
-                    )
-                    self._del_client(client)
-
-            if client_data.common_name not in self._clients_by_username:
-                # New client!  Assume pessimistic last lease update time.  We're
-                # probably recovering from a daemon restart.
-                self._create_detected_client(
-                    client_data.common_name, server, client_data.virtual_address
-                )
+    def _detect_client(self, full_username, leased_ip_address, server) -> None:
+        """Adds a client that was found connected to a server, but isn't
+        tracked for that server yet.
+        """
+        client = self._clients_by_username.get(full_username)
+        if client is not None:
+            # The client has jumped servers.  Remove it from the list.
+            self._log.debug(
+                'cleaning up: client %s has moved to server "%s"', client, server
+            )
+            self._del_client(client)
 
-        for client in list(self._clients_by_server[server].values()):
-            if client.full_username not in client_data_by_username:
-                # The client has been disconnected.
-                if not client.iszombie:
-                    self._log.debug(
-                        'cleaning up: client %s was disconnected in the mean-while',
-                        client,
-                    )
-                else:
-                    self._log.debug('cleaning up: removing zombie client %s', client)
-                self._del_client(client)
+        # New client!  Assume pessimistic last lease update time.  We're
+        # probably recovering from a daemon restart.
+        self._create_detected_client(full_username, server, leased_ip_address)
 
     def _del_client(self, client) -> None:
         """Kills a client instance and removes it from the manager's knowledge.
@@ -351,6 +604,8 @@ class OvpnClientManager:
         client.kill()
         del self._clients_by_username[client.full_username]
         del self._clients_by_server[client.server][client.full_username]
+        if self._lease_db is not None:
+            self._lease_db.remove(client.full_username, client.server.name)
 
     def client_disconnected(self, full_username, server) -> None:
         """Called when a client was disconnected.
@@ -397,10 +652,35 @@ class OvpnClientManager:
             return
         realm_data = self._realms_data[realm]
 
-        # We have no idea when the last refresh occured for this client,
-        # but it's unlikely to be needed immediately.  Spread out the
-        # requests a bit.
-        rebinding_timeout = time.time() + random.uniform(0, 10)
+        # Unless we are told otherwise, the next refresh is unlikely to be
+        # needed immediately.  Spread out the requests a bit.
+        now = time.time()
+        rebinding_timeout = now + random.uniform(0, 10)
+        renewal_timeout = None
+        lease_timeout = None
+        server_ip = None
+
+        lease = None
+        if self._lease_db is not None:
+            # Expired leases are not returned.
+            lease = self._lease_db.get(full_username, server.name)
+        if lease is not None and lease.ip_address == leased_ip_address:
+            # We know the lease from before a daemon restart.  Resume its
+            # schedule.
+            self._log.debug('resuming lease of client "%s"', full_username)
+            lease_timeout = lease.lease_timeout
+            if lease.rebinding_timeout > now:
+                rebinding_timeout = lease.rebinding_timeout
+                server_ip = lease.server_ip
+                renewal_timeout = lease.renewal_timeout
+                if renewal_timeout is not None and renewal_timeout < now:
+                    # The renewal time passed while we were gone.  Spread out
+                    # the renewals until the rebinding time.
+                    renewal_timeout = random.uniform(now, rebinding_timeout)
+            else:
+                # The rebinding time passed while we were gone, so rebind
+                # with all servers right away.
+                rebinding_timeout = min(rebinding_timeout, lease_timeout)
 
         self.create_client(
             server=server,
@@ -408,7 +688,9 @@ class OvpnClientManager:
             realm_data=realm_data,
             leased_ip_address=leased_ip_address,
             rebinding_timeout=rebinding_timeout,
-            lease_timeout=None,
+            lease_timeout=lease_timeout,
+            renewal_timeout=renewal_timeout,
+            server_ip=server_ip,
         )
 
 
@@ -417,6 +699,94 @@ M_DHCP_REQUEST_SUCCESS_COUNT = Counter(
 )
 
 
+def build_client_config(
+    realm_data: RealmData, full_username: str, secret: str, res: Dict[str, Any]
+) -> Optional[OvpnConf]:
+    """Builds the OpenVPN client configuration for a successful DHCP request.
+
+    @param realm_data: The client's realm.
+    @param full_username: The full username of the client.
+    @param secret: Secret for deriving the client's IPv6 address.
+    @param res: Dictionary containing all data returned by the DHCP request.
+    @return: Returns the client configuration or None in case the DHCP
+        request's result is unusable.
+    """
+    log = logging.getLogger('ovpnclientconf')
+    if 'ip_address' not in res or 'subnet_mask' not in res:
+        log.error('DHCP request failed to provide a valid IP ' 'address: %r', res)
+        return None
+
+    if 'rebinding_timeout' not in res or 'lease_timeout' not in res:
+        log.error('DHCP request without lease indication: %r', res)
+        return None
+
+    conf = OvpnConf()
+
+    conf.add("ifconfig-push", res["ip_address"], res["subnet_mask"])
+
+    if realm_data.subnet_ipv6 is not None:
+        prefix = realm_data.subnet_ipv6
+
+        today = str(datetime.date.today())
+        hasher = hashlib.sha256()
+        hasher.update((full_username + today + secret).encode('utf-8'))
+        hash_hex = hasher.hexdigest()[:16]
+        ipv6_network = IPv6Network(prefix).network_address
+        ip6_address = str(ipv6_network + int(hash_hex, 16))
+
+        if realm_data.default_gateway_ipv6 is not None:
+            ip6_gateway = realm_data.default_gateway_ipv6
+        else:
+            ip6_gateway = str(ipv6_network + 1)
+
+        conf.add("ifconfig-ipv6-push", ip6_address, ip6_gateway)
+
+    if realm_data.vid is not None:
+        conf.add("vlan-pvid", str(realm_data.vid))
+
+    if realm_data.default_gateway_ipv4 is not None:
+        conf.push("route-gateway", realm_data.default_gateway_ipv4)
+    elif 'gateway' in res:
+        conf.push("route-gateway", res['gateway'])
+    else:
+        log.debug('DHCP request provided no gateway information: %s' % (repr(res)))
+
+    if realm_data.provide_default_route:
+        if realm_data.default_gateway_ipv6 is not None:
+            conf.push("route-ipv6", "2000::/3")
+            conf.push("redirect-gateway", "def1")
+        elif 'gateway' in res or realm_data.default_gateway_ipv4 is not None:
+            conf.push("redirect-gateway", "def1")
+    else:
+        static_routes_ipv4 = []  # type: List[str]
+        if realm_data.static_routes_ipv4 is not None:
+            static_routes_ipv4 += realm_data.static_routes_ipv4
+        if 'static_routes' in res:
+            static_routes_ipv4 += res['static_routes']
+        if len(static_routes_ipv4) > 0:
+            for network, netmask, gateway in static_routes_ipv4:
+                conf.push("route", network, netmask, gateway)
+
+        static_routes_ipv6 = []  # type: List[str]
+        if (
+            realm_data.subnet_ipv6 is not None
+            and realm_data.static_routes_ipv6 is not None
+        ):
+            static_routes_ipv6 += realm_data.static_routes_ipv6
+        for network, gateway in static_routes_ipv6:
+            conf.push("route-ipv6", network, gateway)
+
+    conf.push("redirect-private")
+
+    for dns_ip in res['dns']:
+        conf.push_dhcp_option("DNS", dns_ip)
+
+    if 'domain' in res:
+        conf.push_dhcp_option("DOMAIN", res["domain"])
+
+    return conf
+
+
 class OvpnCmdConn(CommandConnection):
     """Represents an incoming command connection from one of the OpenVPN
     hooks.
@@ -429,10 +799,11 @@ class OvpnCmdConn(CommandConnection):
         realms_data,
         servers,
         secret,
-        add_request_clb,
+        admission_ctrl,
         parse_username_clb,
         create_client_clb,
         remove_client_clb,
+        file_writer,
     ) -> None:
         """\
         @param sloop: Socket loop instance.  (See CommandConnection for
@@ -442,13 +813,16 @@ class OvpnCmdConn(CommandConnection):
         @param realms_data: Dictionary of realms data objects.  Indexed by
             realm name.
         @param servers: Dictionary of servers.  Indexed by server name.
-        @param add_request_clb: Call-back for starting an initial DHCP request.
+        @param admission_ctrl: Admission controller for starting initial DHCP
+            requests.
         @param parse_username_clb: Call-back for parsing a full username into
             the components.
         @param create_client_clb: Call-back for creating and registering a new
             OpenVPN client instance.
         @param remove_client_clb: Call-back for removing an existing OpenVPN
             client instance.
+        @param file_writer: FileWriterPool instance used for writing the
+            client configuration and deferred return value files.
         """
         CommandConnection.__init__(
             self, sloop=sloop, sock=sock, log=logging.getLogger('ovpncmdconn')
@@ -456,10 +830,11 @@ class OvpnCmdConn(CommandConnection):
         self._realms_data = realms_data
         self._servers = servers
         self._secret = secret
-        self._add_request = add_request_clb
+        self._admission_ctrl = admission_ctrl
         self._parse_username = parse_username_clb
         self._create_client = create_client_clb
         self._remove_client = remove_client_clb
+        self._file_writer = file_writer
         self._ret_f = None
         self._wrote_ret = False
         self._config_f = None  # type: Optional[TextIO]
@@ -471,11 +846,18 @@ class OvpnCmdConn(CommandConnection):
         self._log.debug('destructing OvpnCmdConn')
         if self._ret_f is not None:
             if not self._wrote_ret:
-                self._write_ret(ovpn.CC_RET_FAILED)
+                # The file is closed right away, so don't defer the write.
+                write_and_sync(self._ret_f, str(ovpn.CC_RET_FAILED))
+        self._close_files()
+        CommandConnection.__del__(self)
+
+    def _close_files(self) -> None:
+        if self._ret_f is not None:
             self._ret_f.close()
+            self._ret_f = None
         if self._config_f is not None:
             self._config_f.close()
-        CommandConnection.__del__(self)
+            self._config_f = None
 
     def _write_ret(self, val) -> None:
         """Write a specific return value to the deferred return value file.
@@ -483,8 +865,17 @@ class OvpnCmdConn(CommandConnection):
         """
         self._log.debug('writing deferred return value %d', val)
         assert self._ret_f is not None
-        ovpn.write_deferred_ret_file(self._ret_f, val)
         self._wrote_ret = True
+        # The bound call-back keeps the connection, and with it the file,
+        # alive until the write has completed.
+        self._file_writer.write([(self._ret_f, str(val), 'ret')], self._ret_written)
+
+    def _ret_written(self, exc) -> None:
+        """Called once the deferred return value has been written.  The files
+        are no longer needed.
+        @param exc: The exception in case writing failed, otherwise None.
+        """
+        self._close_files()
 
     def _success_handler(self, res) -> None:
         """Called as soon as the DHCP address request has completed and
@@ -494,96 +885,40 @@ class OvpnCmdConn(CommandConnection):
         @param res: Dictionary containing all data returned by the DHCP request.
         """
         self._log.debug('DHCP request succeeded: %s', repr(res))
+        assert self._config_f is not None and self._realm_data is not None
+        assert self._ret_f is not None
 
-        if 'ip_address' not in res or 'subnet_mask' not in res:
-            self._log.error(
-                'DHCP request failed to provide a valid IP ' 'address: %r', res
-            )
-            self._write_ret(ovpn.CC_RET_FAILED)
-            return
-
-        if 'rebinding_timeout' not in res or 'lease_timeout' not in res:
-            self._log.error('DHCP request without lease indication: %r', res)
+        conf = build_client_config(
+            self._realm_data, self._full_username, self._secret, res
+        )
+        if conf is None:
             self._write_ret(ovpn.CC_RET_FAILED)
             return
 
         self._log.debug('writing OpenVPN client configuration')
-        assert self._config_f is not None and self._realm_data is not None
-
         M_DHCP_REQUEST_SUCCESS_COUNT.labels(self._realm_data.name).inc()
 
-        conf = OvpnConf()
-
-        conf.add("ifconfig-push", res["ip_address"], res["subnet_mask"])
-
-        if self._realm_data.subnet_ipv6 is not None:
-            prefix = self._realm_data.subnet_ipv6
-
-            today = str(datetime.date.today())
-            hasher = hashlib.sha256()
-            hasher.update((self._full_username + today + self._secret).encode('utf-8'))
-            hash_hex = hasher.hexdigest()[:16]
-            ipv6_network = IPv6Network(prefix).network_address
-            ip6_address = str(ipv6_network + int(hash_hex, 16))
-
-            if self._realm_data.default_gateway_ipv6 is not None:
-                ip6_gateway = self._realm_data.default_gateway_ipv6
-            else:
-                ip6_gateway = str(ipv6_network + 1)
-
-            conf.add("ifconfig-ipv6-push", ip6_address, ip6_gateway)
-
-        if self._realm_data.vid is not None:
-            conf.add("vlan-pvid", str(self._realm_data.vid))
-
-        if self._realm_data.default_gateway_ipv4 is not None:
-            conf.push("route-gateway", self._realm_data.default_gateway_ipv4)
-        elif 'gateway' in res:
-            conf.push("route-gateway", res['gateway'])
-        else:
-            self._log.debug(
-                'DHCP request provided no gateway information: %s' % (repr(res))
-            )
-
-        if self._realm_data.provide_default_route:
-            if self._realm_data.default_gateway_ipv6 is not None:
-                conf.push("route-ipv6", "2000::/3")
-                conf.push("redirect-gateway", "def1")
-            elif 'gateway' in res or self._realm_data.default_gateway_ipv4 is not None:
-                conf.push("redirect-gateway", "def1")
-        else:
-            static_routes_ipv4 = []  # type: List[str]
-            if self._realm_data.static_routes_ipv4 is not None:
-                static_routes_ipv4 += self._realm_data.static_routes_ipv4
-            if 'static_routes' in res:
-                static_routes_ipv4 += res['static_routes']
-            if len(static_routes_ipv4) > 0:
-                for network, netmask, gateway in static_routes_ipv4:
-                    conf.push("route", network, netmask, gateway)
-
-            static_routes_ipv6 = []  # type: List[str]
-            if (
-                self._realm_data.subnet_ipv6 is not None
-                and self._realm_data.static_routes_ipv6 is not None
-            ):
-                static_routes_ipv6 += self._realm_data.static_routes_ipv6
-            for network, gateway in static_routes_ipv6:
-                conf.push("route-ipv6", network, gateway)
-
-        conf.push("redirect-private")
-
-        for dns_ip in res['dns']:
-            conf.push_dhcp_option("DNS", dns_ip)
-
-        if 'domain' in res:
-            conf.push_dhcp_option("DOMAIN", res["domain"])
+        # The configuration needs to be on disk before OpenVPN is told to
+        # read it.
+        self._wrote_ret = True
+        self._file_writer.write(
+            [
+                (self._config_f, conf.to_text(), 'config'),
+                (self._ret_f, str(ovpn.CC_RET_SUCCEEDED), 'ret'),
+            ],
+            partial(self._config_written, res),
+        )
 
-        self._config_f.seek(0)
-        self._config_f.write(conf.to_text())
-        self._config_f.flush()
-        os.fsync(self._config_f.fileno())
+    def _config_written(self, res, exc) -> None:
+        """Called once the client configuration and the deferred return value
+        have been written.
 
-        self._write_ret(ovpn.CC_RET_SUCCEEDED)
+        @param res: Dictionary containing all data returned by the DHCP request.
+        @param exc: The exception in case writing failed, otherwise None.
+        """
+        if exc is not None:
+            self._write_ret(ovpn.CC_RET_FAILED)
+            return
 
         self._create_client(
             full_username=self._full_username,
@@ -592,7 +927,10 @@ class OvpnCmdConn(CommandConnection):
             leased_ip_address=res['ip_address'],
             rebinding_timeout=res['rebinding_timeout'],
             lease_timeout=res['lease_timeout'],
+            renewal_timeout=res.get('renewal_timeout'),
+            server_ip=res.get('server_ip'),
         )
+        self._close_files()
 
     def _failure_handler(self) -> None:
         """Called as soon as the DHCP address request has failed or timed out.
@@ -660,6 +998,11 @@ class OvpnCmdConn(CommandConnection):
             self._log.error('unknown server "%s"', server_name)
             return
 
+        if not self._admission_ctrl.accepts(realm):
+            # Let the client try again later instead of waiting in vain.
+            self.send_cmd('FAIL')
+            return
+
         realm_data = self._realms_data[realm]
         self._realm_data = realm_data
         self._server = self._servers[server_name]
@@ -675,7 +1018,8 @@ class OvpnCmdConn(CommandConnection):
             target_addr = None
 
         try:
-            self._add_request(
+            self._admission_ctrl.submit(
+                realm,
                 success_handler_clb=self._success_handler,
                 failure_handler_clb=self._failure_handler,
                 client_identifier=self._full_username,
@@ -709,6 +1053,153 @@ class OvpnCmdConn(CommandConnection):
         self._remove_client(full_username, server)
 
 
+class OvpnClientAuthHandler:
+    """Handles the client notifications of OpenVPN servers running with
+    --management-client-auth.  Replaces the connect hook: A DHCP request is
+    started for each connecting client and the client configuration is
+    passed back via the management console.
+    """
+
+    def __init__(
+        self,
+        realms_data,
+        secret,
+        admission_ctrl,
+        parse_username_clb,
+        create_client_clb,
+    ) -> None:
+        """\
+        @param realms_data: Dictionary of realms data objects.  Indexed by
+            realm name.
+        @param secret: Secret for deriving the clients' IPv6 addresses.
+        @param admission_ctrl: Admission controller for starting initial DHCP
+            requests.
+        @param parse_username_clb: Call-back for parsing a full username into
+            the components.
+        @param create_client_clb: Call-back for creating and registering a new
+            OpenVPN client instance.  Returns the client.
+        """
+        self._realms_data = realms_data
+        self._secret = secret
+        self._admission_ctrl = admission_ctrl
+        self._parse_username = parse_username_clb
+        self._create_client = create_client_clb
+        # Maps server and client ID of each CONNECT awaiting its DHCP request
+        # to the server's management connection count at the time.
+        self._pending = {}  # type: Dict[Tuple[Any, int], int]
+        self._log = logging.getLogger('ovpnclientauth')
+
+    def handle_client_event(self, server, event) -> None:
+        """Called for each complete client notification of a server.
+        @param server: The OpenVPN server the notification came from.
+        @param event: The OvpnClientEvent.
+        """
+        if event.event_type == 'CONNECT':
+            self._handle_connect(server, event)
+        elif event.event_type == 'REAUTH':
+            # The client renegotiated its TLS session.  It keeps its address.
+            server.client_auth_nt(event.cid, event.kid)
+        elif event.event_type == 'DISCONNECT':
+            if self._pending.pop((server, event.cid), None) is not None:
+                self._log.debug(
+                    'client %d on %s disconnected before it was authorised',
+                    event.cid,
+                    server,
+                )
+
+    def _take_pending(self, server, event) -> bool:
+        """Forgets the pending CONNECT of a client.
+
+        @return: Returns True if the client is still waiting for our answer,
+            i.e. it has not disconnected and the management connection has not
+            been re-established in the mean-time.
+        """
+        mgmt_connections = self._pending.pop((server, event.cid), None)
+        if mgmt_connections == server.mgmt_connections:
+            return True
+        self._log.debug(
+            'client %d on %s is gone, dropping the DHCP result', event.cid, server
+        )
+        return False
+
+    def _handle_connect(self, server, event) -> None:
+        full_username = event.common_name
+        if full_username is None:
+            self._log.warning('client %d on %s has no username', event.cid, server)
+            server.client_deny(event.cid, event.kid, 'no username')
+            return
+
+        ret = self._parse_username(full_username)
+        if ret is None:
+            self._log.warning('parsing username failed: "%s"', full_username)
+            server.client_deny(event.cid, event.kid, 'invalid username')
+            return
+        realm = ret['realm']
+
+        if realm not in self._realms_data:
+            self._log.error('unknown realm "%s"', realm)
+            server.client_deny(event.cid, event.kid, 'unknown realm')
+            return
+        realm_data = self._realms_data[realm]
+
+        if not self._admission_ctrl.accepts(realm):
+            server.client_deny(event.cid, event.kid, 'overloaded')
+            return
+
+        target_addr: Optional[IPv4Address]
+        if realm_data.subnet_ipv4:
+            target_addr = IPv4Network(realm_data.subnet_ipv4).network_address
+        else:
+            target_addr = None
+
+        self._pending[(server, event.cid)] = server.mgmt_connections
+        self._admission_ctrl.submit(
+            realm,
+            success_handler_clb=partial(
+                self._success_handler, server, event, full_username, realm_data
+            ),
+            failure_handler_clb=partial(self._failure_handler, server, event),
+            client_identifier=full_username,
+            device=realm_data.dhcp_listening_device,
+            local_ip=realm_data.dhcp_listening_ip,
+            server_ips=realm_data.dhcp_server_ips,
+            target_addr=target_addr,
+            lease_time=realm_data.expected_dhcp_lease_time,
+        )
+
+    def _success_handler(self, server, event, full_username, realm_data, res):
+        self._log.debug('DHCP request succeeded: %s', repr(res))
+        if not self._take_pending(server, event):
+            return
+        conf = build_client_config(realm_data, full_username, self._secret, res)
+        if conf is None:
+            server.client_deny(event.cid, event.kid, 'DHCP request failed')
+            return
+
+        M_DHCP_REQUEST_SUCCESS_COUNT.labels(realm_data.name).inc()
+        server.client_auth(event.cid, event.kid, conf.lines)
+
+        client = self._create_client(
+            full_username=full_username,
+            server=server,
+            realm_data=realm_data,
+            leased_ip_address=res['ip_address'],
+            rebinding_timeout=res['rebinding_timeout'],
+            lease_timeout=res['lease_timeout'],
+            renewal_timeout=res.get('renewal_timeout'),
+            server_ip=res.get('server_ip'),
+        )
+        # Allows matching the client's DISCONNECT notification, even if it
+        # arrives before the ESTABLISHED notification.
+        client.cid = event.cid
+
+    def _failure_handler(self, server, event):
+        self._log.debug('DHCP request failed')
+        if not self._take_pending(server, event):
+            return
+        server.client_deny(event.cid, event.kid, 'DHCP request failed')
+
+
 def user_to_uid(user) -> int:
     """Transforms a user to a UID.  In case the user is already a UID, the
     UID is passed through unchanged.
@@ -793,18 +1284,33 @@ def read_servers(cfg: ConfigParser, sloop) -> Dict[str, ovpn.OvpnServer]:
     servers = {}
     for sect, server_name in cfg_iterate(cfg, 'ovpn-server'):
         server = ovpn.OvpnServer(
-            sloop, name=server_name, socket_fn=cfg.get(sect, 'mgmt_socket')
+            sloop,
+            name=server_name,
+            socket_fn=cfg.get(sect, 'mgmt_socket'),
+            client_auth=cfg.getboolean(sect, 'client_auth', fallback=False),
         )
         servers[server_name] = server
     return servers
 
 
-def load_requestors(sloop, requestor_mgr, realms_data) -> bool:
+def load_requestors(
+    sloop,
+    requestor_mgr,
+    realms_data,
+    recv_batch_size=64,
+    timeout_mgr=None,
+    server_rate=0,
+) -> bool:
     """Load all requestors, based on the existing realms.
 
     @param sloop: Socket loop instance.
     @param requestor_mgr: Requestor manager instance.
     @param realms_data: Dictionary of all existing realms.
+    @param recv_batch_size: Maximum number of DHCP packets each requestor
+        processes per socket loop wakeup.
+    @param timeout_mgr: Timeout manager instance.
+    @param server_rate: Maximum number of DHCP packets per second each
+        requestor sends to a single DHCP server.  0 means unlimited.
     @return: Returns False in case an error occured while loading the
         requestors.  Otherwise returns True.
     """
@@ -820,8 +1326,15 @@ def load_requestors(sloop, requestor_mgr, realms_data) -> bool:
                 listen_address=realm_data.dhcp_listening_ip,
                 listen_port=realm_data.dhcp_local_port,
                 listen_device=realm_data.dhcp_listening_device,
+                recv_batch_size=recv_batch_size,
+                timeout_mgr=timeout_mgr,
+                server_rate=server_rate,
             )
             sloop.add_socket_handler(requestor)
+            # Idle handlers are called in the order they were added, so this
+            # runs after the timeout manager's handler and sends the packets
+            # of all requests started or retransmitted in this iteration.
+            sloop.add_idle_handler(requestor.flush_send_queue)
             requestor_mgr.add_requestor(requestor)
     except odr.listeningsocket.SocketLocalAddressBindFailed as ex:
         logging.error(
@@ -834,6 +1347,198 @@ def load_requestors(sloop, requestor_mgr, realms_data) -> bool:
     return True
 
 
+def start_dhcp_request(
+    request_class, timeout_mgr, requestor_mgr, device, local_ip, **kwargs
+) -> bool:
+    """Start a DHCP request via the requestor responsible for device and
+    local_ip.  The keyword arguments are passed on to the request.
+
+    @param request_class: DhcpAddressInitialRequest or
+        DhcpAddressRefreshRequest.
+    @return: Returns False if there is no matching requestor.
+    """
+    requestor = requestor_mgr.get_requestor(device, local_ip)
+    if requestor is None:
+        return False
+    request = request_class(
+        timeout_mgr=weakref.proxy(timeout_mgr),
+        requestor=weakref.proxy(requestor),
+        local_ip=local_ip,
+        **kwargs
+    )
+    requestor.add_request(request)
+    return True
+
+
+def get_requestor_keys(realms_data) -> List[Tuple[str, str]]:
+    """@return: Returns the (device, local IP) pairs of all DHCP listening
+        addresses needed by the realms.
+    """
+    return sorted(
+        {
+            (realm_data.dhcp_listening_device, realm_data.dhcp_listening_ip)
+            for realm_data in realms_data.values()
+        },
+        key=repr,
+    )
+
+
+def run_dhcp_worker(cfg, options, realms_data, sock, index) -> None:
+    """Main function of a DHCP worker process.  Loads the requestors of the
+    realms the worker is responsible for and processes the DHCP requests
+    received from the main process until the main process goes away.
+
+    @param realms_data: Dictionary of the realms the worker is responsible
+        for.
+    @param sock: The worker's end of the socket pair.
+    @param index: Number of the worker.
+    """
+    prctl.set_name('odrd-dhcp{}'.format(index))
+
+    prom_port = cfg.getint("daemon", "prometheus_port", fallback=0)
+    if prom_port:
+        start_http_server(prom_port + 1 + index)
+
+    sloop, timeout_mgr = create_loop(
+        cfg.get('daemon', 'socket_loop', fallback='default'),
+        slow_handler_threshold=cfg.getfloat(
+            'daemon', 'slow_handler_threshold', fallback=0
+        ),
+    )
+    signal.signal(signal.SIGTERM, lambda *args: sloop.quit())
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    # The main process takes care of shutting us down.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    requestor_mgr = odr.dhcprequestor.DhcpAddressRequestorManager()
+    if not load_requestors(
+        sloop,
+        requestor_mgr,
+        realms_data,
+        recv_batch_size=cfg.getint('daemon', 'dhcp_recv_batch_size', fallback=64),
+        timeout_mgr=timeout_mgr,
+        server_rate=cfg.getfloat('daemon', 'dhcp_server_max_rate', fallback=0),
+    ):
+        sys.exit(1)
+
+    if not options.keep_user:
+        drop_caps()
+
+    worker_server = DhcpWorkerServer(
+        weakref.proxy(sloop),
+        sock,
+        start_request_clbs={
+            'initial': partial(
+                start_dhcp_request,
+                odr.dhcprequestor.DhcpAddressInitialRequest,
+                timeout_mgr,
+                requestor_mgr,
+            ),
+            'refresh': partial(
+                start_dhcp_request,
+                odr.dhcprequestor.DhcpAddressRefreshRequest,
+                timeout_mgr,
+                requestor_mgr,
+            ),
+        },
+        timeout_mgr=timeout_mgr,
+    )
+    sloop.add_socket_handler(worker_server)
+    # Called after the socket handlers, so the results of a loop iteration are
+    # sent together.
+    sloop.add_idle_handler(worker_server.flush_send_queue)
+    sloop.run()
+
+
+def fork_dhcp_workers(
+    cfg, options, realms_data, num_workers
+) -> List[Tuple[socket.socket, int, List[Tuple[str, str]]]]:
+    """Fork the DHCP worker processes.  The DHCP listening addresses are
+    distributed over the workers.  Realms sharing a listening address are
+    handled by the same worker.
+
+    @param num_workers: Number of worker processes to start.
+    @return: Returns a tuple of socket, process ID and responsible (device,
+        local IP) pairs for each worker.
+    """
+    workers = []  # type: List[Tuple[socket.socket, int, List[Tuple[str, str]]]]
+    if num_workers <= 0:
+        return workers
+    shards = assign_shards(get_requestor_keys(realms_data), num_workers)
+    for index, keys in enumerate(shards):
+        if not keys:
+            # More workers than listening addresses.
+            continue
+        main_sock, worker_sock = create_worker_socketpair()
+        pid = os.fork()
+        if pid == 0:
+            main_sock.close()
+            for other_sock, _, _ in workers:
+                other_sock.close()
+            exit_code = 0
+            try:
+                run_dhcp_worker(
+                    cfg,
+                    options,
+                    {
+                        name: realm_data
+                        for name, realm_data in realms_data.items()
+                        if (
+                            realm_data.dhcp_listening_device,
+                            realm_data.dhcp_listening_ip,
+                        )
+                        in keys
+                    },
+                    worker_sock,
+                    index,
+                )
+            except SystemExit as exc:
+                exit_code = exc.code if isinstance(exc.code, int) else 1
+            except Exception:
+                logging.exception('DHCP worker %d failed', index)
+                exit_code = 1
+            os._exit(exit_code)
+        worker_sock.close()
+        logging.info('started DHCP worker %d (pid %d) for %s', index, pid, keys)
+        workers.append((main_sock, pid, keys))
+    return workers
+
+
+def create_loop(
+    socket_loop_type: str, slow_handler_threshold: float = 0
+) -> Tuple[Any, Any]:
+    """Create the socket loop and timeout manager of the requested type.
+
+    @param socket_loop_type: One of "default", "select", "asyncio" or
+        "uvloop".
+    @param slow_handler_threshold: Handler calls taking longer than this
+        number of seconds are logged.
+    @return: Returns a tuple of socket loop and timeout manager.
+    """
+    if socket_loop_type in ('asyncio', 'uvloop'):
+        try:
+            loop = new_event_loop(use_uvloop=socket_loop_type == 'uvloop')
+        except ImportError:
+            logging.critical('socket_loop "%s" is not available', socket_loop_type)
+            sys.exit(1)
+        asloop = AsyncioSocketLoop(loop=loop)
+        asloop.slow_handler_threshold = slow_handler_threshold
+        return asloop, AsyncioTimeoutManager(asloop)
+
+    if socket_loop_type == 'select':
+        sloop = SocketLoop(selector=selectors.SelectSelector())
+    elif socket_loop_type == 'default':
+        sloop = SocketLoop()
+    else:
+        logging.critical('unknown socket_loop type "%s"', socket_loop_type)
+        sys.exit(1)
+    sloop.slow_handler_threshold = slow_handler_threshold
+    timeout_mgr = TimeoutManager()
+    sloop.add_idle_handler(timeout_mgr.check_timeouts)
+    sloop.set_deadline_clb(timeout_mgr.next_timeout_time)
+    return sloop, timeout_mgr
+
+
 def setup_logging(loglevel, use_syslog=False) -> None:
     root = logging.getLogger()
     root.setLevel(loglevel)
@@ -888,11 +1593,6 @@ def main() -> None:
         loglevel = logging.DEBUG
     setup_logging(loglevel, cfg.getboolean('daemon', 'syslog', fallback=False))
 
-    prom_port = cfg.getint("daemon", "prometheus_port", fallback=0)
-    if prom_port:
-        logging.debug("starting prometheus exporter on port %s", prom_port)
-        start_http_server(prom_port)
-
     if not options.keep_user:
         # Capability net_raw is needed for binding to network devices.
         # Capability net_bind_service is needed for binding to the DHCP port.
@@ -910,7 +1610,23 @@ def main() -> None:
     if realms_data is None:
         sys.exit(1)
 
-    sloop = SocketLoop()
+    # The workers need to be forked before any threads, sockets or the socket
+    # loop of the main process are created.
+    dhcp_workers = fork_dhcp_workers(
+        cfg, options, realms_data, cfg.getint('daemon', 'dhcp_workers', fallback=0)
+    )
+
+    prom_port = cfg.getint("daemon", "prometheus_port", fallback=0)
+    if prom_port:
+        logging.debug("starting prometheus exporter on port %s", prom_port)
+        start_http_server(prom_port)
+
+    sloop, timeout_mgr = create_loop(
+        cfg.get('daemon', 'socket_loop', fallback='default'),
+        slow_handler_threshold=cfg.getfloat(
+            'daemon', 'slow_handler_threshold', fallback=0
+        ),
+    )
 
     def exit_daemon(*args) -> None:
         """Signal handler performing a soft shutdown of the loop.
@@ -921,9 +1637,6 @@ def main() -> None:
     signal.signal(signal.SIGTERM, exit_daemon)
     signal.signal(signal.SIGHUP, signal.SIG_IGN)
 
-    timeout_mgr = TimeoutManager()
-    sloop.add_idle_handler(timeout_mgr.check_timeouts)
-
     requestor_mgr = odr.dhcprequestor.DhcpAddressRequestorManager()
 
     servers = read_servers(cfg, sloop)
@@ -933,42 +1646,103 @@ def main() -> None:
             timeout_mgr=weakref.proxy(timeout_mgr),
             server=weakref.proxy(server),
             timeout=30,
+            max_timeout=cfg.getint(
+                'daemon', 'mgmt_reconnect_max_interval', fallback=600
+            ),
         )
 
-    def start_dhcp_address_request(device, local_ip, **kwargs) -> None:
-        requestor = requestor_mgr.get_requestor(device, local_ip)
-        if requestor is None:
-            return
-        request = odr.dhcprequestor.DhcpAddressInitialRequest(
-            timeout_mgr=weakref.proxy(timeout_mgr),
-            requestor=weakref.proxy(requestor),
-            local_ip=local_ip,
-            **kwargs
-        )
-        requestor.add_request(request)
+    def handle_worker_gone(worker) -> None:
+        # The worker can't be restarted, so its realms would fail all DHCP
+        # requests.  Leave restarting the whole daemon to the service manager.
+        logging.critical('exiting, as DHCP worker %d is gone', worker.pid)
+        sloop.quit()
 
-    def start_dhcp_refresh_request(device, local_ip, **kwargs) -> None:
-        requestor = requestor_mgr.get_requestor(device, local_ip)
-        if requestor is None:
-            return
-        request = odr.dhcprequestor.DhcpAddressRefreshRequest(
-            timeout_mgr=weakref.proxy(timeout_mgr),
-            requestor=weakref.proxy(requestor),
-            local_ip=local_ip,
-            **kwargs
+    worker_pool = DhcpWorkerPool()
+    if dhcp_workers:
+        for worker_sock, pid, keys in dhcp_workers:
+            worker = DhcpWorkerClient(
+                weakref.proxy(sloop),
+                worker_sock,
+                pid,
+                timeout_mgr=timeout_mgr,
+                worker_gone_clb=handle_worker_gone,
+            )
+            sloop.add_socket_handler(worker)
+            sloop.add_idle_handler(worker.flush_send_queue)
+            worker_pool.add_worker(worker, keys)
+        start_dhcp_address_request = partial(worker_pool.start_request, 'initial')
+        start_dhcp_refresh_request = partial(worker_pool.start_request, 'refresh')
+    else:
+        start_dhcp_address_request = partial(
+            start_dhcp_request,
+            odr.dhcprequestor.DhcpAddressInitialRequest,
+            timeout_mgr,
+            requestor_mgr,
+        )
+        start_dhcp_refresh_request = partial(
+            start_dhcp_request,
+            odr.dhcprequestor.DhcpAddressRefreshRequest,
+            timeout_mgr,
+            requestor_mgr,
         )
-        requestor.add_request(request)
+
+    admission_ctrl = AdmissionController(
+        start_dhcp_address_request,
+        timeout_mgr,
+        max_in_flight_per_realm=cfg.getint(
+            'daemon', 'dhcp_max_in_flight_per_realm', fallback=0
+        ),
+        max_in_flight_per_requestor=cfg.getint(
+            'daemon', 'dhcp_max_in_flight_per_requestor', fallback=0
+        ),
+        max_wait=cfg.getfloat('daemon', 'dhcp_max_admission_wait', fallback=0),
+    )
 
     parse_username = ParseUsername(default_realm=cfg.get('daemon', 'default_realm'))
 
+    file_writer = FileWriterPool(
+        sloop, num_threads=cfg.getint('daemon', 'file_writer_threads', fallback=2)
+    )
+
+    lease_db = None
+    lease_db_path = cfg.get('daemon', 'lease_db', fallback=None)
+    if lease_db_path:
+        try:
+            lease_db = LeaseDb(lease_db_path, file_writer=file_writer)
+        except OSError as exc:
+            logging.critical('could not open lease database: %s', exc)
+            sys.exit(1)
+
+    refresh_scheduler = RefreshScheduler(
+        timeout_mgr,
+        refresh_lease_clb=start_dhcp_refresh_request,
+        max_rate=cfg.getfloat('daemon', 'dhcp_refresh_max_rate', fallback=0),
+    )
+
     client_mgr = OvpnClientManager(
         timeout_mgr=timeout_mgr,
         servers=servers,
-        refresh_lease_clb=start_dhcp_refresh_request,
+        refresh_scheduler=refresh_scheduler,
         realms_data=realms_data,
         parse_username_clb=parse_username.parse_username,
+        lease_db=lease_db,
+        max_sync_interval=cfg.getint(
+            'daemon', 'max_client_sync_interval', fallback=900
+        ),
     )
 
+    client_auth_handler = OvpnClientAuthHandler(
+        realms_data=realms_data,
+        secret=cfg.get('daemon', 'secret', fallback=None),
+        admission_ctrl=admission_ctrl,
+        parse_username_clb=parse_username.parse_username,
+        create_client_clb=client_mgr.create_client,
+    )
+    for server in servers.values():
+        if server.uses_client_auth:
+            server.add_client_event_handler(client_auth_handler.handle_client_event)
+            server.add_client_event_handler(client_mgr.handle_client_event)
+
     def create_vpn_cmd_conn(sloop, sock) -> OvpnCmdConn:
         return OvpnCmdConn(
             sloop,
@@ -978,8 +1752,9 @@ def main() -> None:
             secret=cfg.get('daemon', 'secret', fallback=None),
             create_client_clb=client_mgr.create_client,
             remove_client_clb=client_mgr.client_disconnected,
-            add_request_clb=start_dhcp_address_request,
+            admission_ctrl=admission_ctrl,
             parse_username_clb=parse_username.parse_username,
+            file_writer=file_writer,
         )
 
     cmd_socket_uids = [
@@ -1009,7 +1784,14 @@ def main() -> None:
         )
         sloop.add_socket_handler(cmd_listener)
 
-    if not load_requestors(sloop, requestor_mgr, realms_data):
+    if not dhcp_workers and not load_requestors(
+        sloop,
+        requestor_mgr,
+        realms_data,
+        recv_batch_size=cfg.getint('daemon', 'dhcp_recv_batch_size', fallback=64),
+        timeout_mgr=timeout_mgr,
+        server_rate=cfg.getfloat('daemon', 'dhcp_server_max_rate', fallback=0),
+    ):
         sys.exit(1)
 
     if not options.keep_user:
@@ -1018,9 +1800,23 @@ def main() -> None:
 
     try:
         sloop.run()
+        if not worker_pool.alive:
+            sys.exit(1)
     except Exception:
         logging.exception('Caught exception in main loop, exiting.')
         sys.exit(1)
+    finally:
+        file_writer.shutdown()
+        if lease_db is not None:
+            lease_db.close()
+        # The workers exit as soon as their socket is closed.
+        for worker_sock, pid, _ in dhcp_workers:
+            worker_sock.close()
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                # The worker died and was reaped before.
+                pass
 
 
 if __name__ == '__main__':
@@ -17,89 +17,135 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import collections
 import logging
-import os
+import random
 import socket
 import time
-import sys
-from typing import Optional, TextIO
-
+from typing import Callable, Deque, Dict, List, Optional, Set
+
+from prometheus_client import Counter, Gauge
+
+# The hook helpers live in the dependency-free hook client module.
+from odr.hookclient import (  # noqa: F401
+    CC_RET_DEFERRED,
+    CC_RET_FAILED,
+    CC_RET_SUCCEEDED,
+    determine_daemon_name,
+    write_deferred_ret_file,
+)
 from odr.linesocket import LineSocket
 from odr.queue import StateQueue
 from odr.socketloop import SocketLoop
 from odr.timeoutmgr import TimeoutManager
 
-CC_RET_FAILED = 0
-CC_RET_SUCCEEDED = 1
-CC_RET_DEFERRED = 2
-
-
-def write_deferred_ret_file(fp: TextIO, val: object) -> None:
-    """Write one of the deferral values to the deferred return value file.
-
-    @param fp: File pointer of the deferred return value file.
-    @param val: One of the CC_RET_* constants.
-    """
-    fp.seek(0)
-    fp.write(str(val))
-    fp.flush()
-    os.fsync(fp.fileno())
-
-
-def determine_daemon_name(script_name: str) -> Optional[str]:
-    """We identify the OpenVPN server instance calling us by either looking at
-    an environment variable or by trying to deduce the name from the way we
-    were called.
-
-    @param script_name: The regular base filename of this Python script.
-    @return: Returns the OpenVPN server instance name or None.
+M_MGMT_CONNECTED = Gauge(
+    "ovpn_mgmt_connected",
+    "whether the management console of the OpenVPN server is connected",
+    ("server",),
+)
+M_MGMT_CONNECT_COUNT = Counter(
+    "ovpn_mgmt_connect_count",
+    "number of connection attempts to the management console",
+    ("server", "result"),
+)
+M_MGMT_DISCONNECT_COUNT = Counter(
+    "ovpn_mgmt_disconnect_count",
+    "number of established management connections that were lost",
+    ("server",),
+)
+
+
+class OvpnClientEvent:
+    """Represents a client notification of the management console, as sent
+    with --management-client-auth.
     """
 
-    if 'daemon_name' in os.environ:
-        return os.environ['daemon_name']
-
-    b = os.path.basename(sys.argv[0])
-    if b.startswith(script_name + '_'):
-        return b[len(script_name) + 1 :]
-
-    return None
-
-
-class OvpnClientConnData:
-    """Represents a single client connection within an OpenVPN server's client
-    list.
-    """
+    def __init__(self, event_type: str, cid: int, kid: Optional[int]) -> None:
+        """\
+        @param event_type: Type of the event, e.g. "CONNECT" or "REAUTH".
+        @param cid: The client's connection ID.
+        @param kid: The client's key ID, if the event has one.
+        """
+        self.event_type = event_type
+        self.cid = cid
+        self.kid = kid
+        self.env = {}  # type: Dict[str, str]
 
-    def __init__(self, **kwargs):
-        self.common_name = kwargs.get('common_name', None)
-        self.virtual_address = kwargs.get('virtual_address', None)
-        self.server = kwargs.get('server', None)
+    @property
+    def common_name(self) -> Optional[str]:
+        """@return: Returns the username the client authenticated with or its
+            certificate's common name.
+        """
+        return self.env.get('username') or self.env.get('common_name')
 
-    def __str__(self):
-        return '{} on {}'.format(self.common_name, self.server)
+    @property
+    def virtual_address(self) -> Optional[str]:
+        """@return: Returns the client's virtual IPv4 address.  Only known
+            once the connection has been established.
+        """
+        return self.env.get('ifconfig_pool_remote_ip') or None
 
     def __repr__(self):
-        return "<OvpnClientConnData common_name=%s, ...>" % self.common_name
+        return "<OvpnClientEvent %s cid=%d kid=%s>" % (
+            self.event_type,
+            self.cid,
+            self.kid,
+        )
 
 
 class OvpnServer:
     """Represents a single OpenVPN server and allows communication with the
     server (via the management console).
+
+    If the server runs with --management-client-auth, the client notifications
+    are passed on to the client event handlers.  "CONNECT" and "REAUTH"
+    notifications need to be answered via client_auth() or client_deny().
+    "ESTABLISHED" and "DISCONNECT" notifications report the client's
+    connection state in real time.
+
+    Several commands may be sent before their responses arrive.  The responses
+    are matched to the commands in order.
     """
 
-    def __init__(self, sloop: SocketLoop, name: str, socket_fn: str) -> None:
+    # Maximum number of commands waiting for their response.  Further commands
+    # are held back until responses arrive.
+    MAX_CMDS_IN_FLIGHT = 16
+
+    def __init__(
+        self, sloop: SocketLoop, name: str, socket_fn: str, client_auth: bool = False
+    ) -> None:
         """\
         @param sloop: Instance of the socket loop.
         @param name: Freely choosable, unique identifier of the server.
         @param socket_fn: Path to the management console's UNIX socket.
+        @param client_auth: Whether the server authorises clients via the
+            management console instead of the connect hook.
         """
         self._sloop = sloop
         self._name = name
         self._socket_fn = socket_fn
+        self.uses_client_auth = client_auth
 
         self.log = logging.getLogger('ovpnsrv')
         self._socket = None  # type: Optional[LineSocket]
         self._cmd_state = StateQueue(idle_state=_OvpnIdleState())
+        # Commands held back, see MAX_CMDS_IN_FLIGHT.
+        self._waiting_cmds = collections.deque()  # type: Deque
+        # Common names of the clients with a pending kill command.
+        self._pending_kills = set()  # type: Set[str]
+        self._client_event_clbs = (
+            []
+        )  # type: List[Callable[[OvpnServer, OvpnClientEvent], None]]
+        # Number of connections established to the management console so far.
+        # Client notifications may have been missed between two connections.
+        self.mgmt_connections = 0
+        # The client event currently being received.
+        self._client_event = None  # type: Optional[OvpnClientEvent]
+        # Whether the management console has greeted us on the current
+        # connection.
+        self._established = False
+        M_MGMT_CONNECTED.labels(name).set(0)
 
         self.connect_to_mgmt()
 
@@ -107,16 +153,33 @@ class OvpnServer:
     def connected(self):
         return self._socket is not None
 
+    @property
+    def established(self):
+        """@return: Returns whether the management console is connected and
+            has greeted us.
+        """
+        return self._established
+
     def connect_to_mgmt(self):
+        """Connects to the management console without blocking.  The
+        connection is only established once the console's greeting has been
+        received by the socket loop.
+        """
         if self.connected:
             self.log.debug('replacing connection to management console')
             self.close_mgmt()
 
         sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.setblocking(False)
         try:
+            # Connecting to a UNIX socket never is in progress: It either
+            # completes right away or fails.  If the console's backlog is full,
+            # it fails with EAGAIN instead of blocking.  Like any other
+            # failure, that is retried by the supervisor with backoff.
             sock.connect(self._socket_fn)
         except OSError as e:
             self.log.error('connection to OpenVPN server "%s" failed: %s', self.name, e)
+            M_MGMT_CONNECT_COUNT.labels(self.name, 'failure').inc()
             sock.close()
             return
 
@@ -124,15 +187,35 @@ class OvpnServer:
             'connected to OpenVPN server "%s" at "%s"', self.name, self._socket_fn
         )
         self._socket = LineSocket(sock)
+        self.mgmt_connections += 1
         self._sloop.add_socket_handler(self)
 
-        self._cmd_state.add(_OvpnWaitConnectState(self._on_connected))
+        self._add_cmd(_OvpnWaitConnectState(self._on_connected))
 
     def close_mgmt(self):
+        if self._established:
+            M_MGMT_DISCONNECT_COUNT.labels(self.name).inc()
+            M_MGMT_CONNECTED.labels(self.name).set(0)
+            self._established = False
+        else:
+            # The connection attempt failed.
+            M_MGMT_CONNECT_COUNT.labels(self.name, 'failure').inc()
         self._sloop.del_socket_handler(self)
         self._socket.close()
         self._socket = None
         self._cmd_state.clear()
+        self._waiting_cmds.clear()
+        self._pending_kills.clear()
+        self._client_event = None
+
+    def add_client_event_handler(
+        self, client_event_clb: Callable[["OvpnServer", OvpnClientEvent], None]
+    ) -> None:
+        """\
+        @param client_event_clb: Called with the server and the event for each
+            complete client notification.
+        """
+        self._client_event_clbs.append(client_event_clb)
 
     def _on_connected(self, hello_msg):
         if not hello_msg.startswith(b'>INFO:'):
@@ -142,6 +225,9 @@ class OvpnServer:
             self.close_mgmt()
             return
         self.log.debug('connected to OpenVPN server "%s"', self.name)
+        self._established = True
+        M_MGMT_CONNECTED.labels(self.name).set(1)
+        M_MGMT_CONNECT_COUNT.labels(self.name, 'success').inc()
 
     def __del__(self):
         if self.connected:
@@ -171,7 +257,16 @@ class OvpnServer:
         return self._socket
 
     def handle_socket(self):
-        lines = self._socket.recvlines()
+        try:
+            lines = self._socket.recvlines()
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self.log.error(
+                'receiving from OpenVPN server "%s" failed: %s', self.name, e
+            )
+            self.close_mgmt()
+            return
         if lines is None:
             # EOF - clean-up.
             self.log.error('received EOF on socket for OpenVPN server "%s"', self.name)
@@ -179,21 +274,109 @@ class OvpnServer:
             return
 
         for line in lines:
-            # Feed each line to the current state.  If the state indicates
-            # completion, move to next state.
-            if not self._cmd_state.current.handle_line(line):
+            if line.startswith(b'>CLIENT:'):
+                # Client notifications may arrive at any time, even in the
+                # middle of a command's response.
+                self._handle_client_line(line)
+            elif not self._cmd_state.current.handle_line(line):
+                # Feed each line to the current state.  If the state indicates
+                # completion, move to next state.
                 self._cmd_state.current_done()
+                self._start_waiting_cmds()
+            if not self.connected:
+                # The connection was closed while handling the line.
+                return
+
+    def _handle_client_line(self, line):
+        """Collects the lines of a client notification.  Notifications start
+        with a header line, e.g. ">CLIENT:CONNECT,{CID},{KID}", followed by
+        the client's environment in ">CLIENT:ENV,{NAME}={VALUE}" lines and a
+        final ">CLIENT:ENV,END" line.
+        """
+        body = line[len(b'>CLIENT:') :].rstrip(b'\n').decode('utf-8', 'replace')
+        if body.startswith('ENV,'):
+            if self._client_event is None:
+                self.log.debug('ignoring client environment without header')
+                return
+            if body == 'ENV,END':
+                event, self._client_event = self._client_event, None
+                self._handle_client_event(event)
+            else:
+                name, _, value = body[len('ENV,') :].partition('=')
+                self._client_event.env[name] = value
+            return
+
+        event_type, _, args = body.partition(',')
+        if event_type == 'ADDRESS':
+            # Single line notification without environment.
+            return
+        try:
+            ids = [int(arg) for arg in args.split(',')[:2]]
+        except ValueError:
+            self.log.warning('failed to parse client notification "%s"', body)
+            return
+        self._client_event = OvpnClientEvent(
+            event_type, ids[0], ids[1] if len(ids) > 1 else None
+        )
 
-    def _send_cmd(self, cmd):
+    def _handle_client_event(self, event):
+        if not self._client_event_clbs:
+            self.log.debug('ignoring client event %r', event)
+            return
+        for client_event_clb in self._client_event_clbs:
+            try:
+                client_event_clb(self, event)
+            except Exception:
+                self.log.exception('handling client event %r failed', event)
+                if event.event_type in ('CONNECT', 'REAUTH'):
+                    self.client_deny(event.cid, event.kid, 'internal error')
+                    return
+
+    def _add_cmd(self, state) -> None:
+        """Starts a command's state, i.e. sends the command, unless too many
+        commands are already waiting for their response.
+        """
+        if self._waiting_cmds or len(self._cmd_state) >= self.MAX_CMDS_IN_FLIGHT:
+            self._waiting_cmds.append(state)
+            return
+        self._cmd_state.add(state)
+        state.start()
+
+    def _start_waiting_cmds(self) -> None:
+        while (
+            self.connected
+            and self._waiting_cmds
+            and len(self._cmd_state) < self.MAX_CMDS_IN_FLIGHT
+        ):
+            state = self._waiting_cmds.popleft()
+            self._cmd_state.add(state)
+            state.start()
+
+    def _send_cmd(self, cmd) -> bool:
+        """Sends a command line.  Closes the connection in case of an error.
+        @return: Returns whether the line was sent.
+        """
+        if not self.connected:
+            return False
         try:
-            self._socket.send(cmd.replace(b'\n', b'\\n') + b'\n')
-        except BrokenPipeError as ex:
+            self._socket.sendall(cmd.replace(b'\n', b'\\n') + b'\n')
+        except BlockingIOError:
+            # The socket buffer is full, the management console isn't reading
+            # our commands anymore.
+            self.log.error(
+                'OpenVPN server "%s" does not accept further commands', self.name
+            )
+            self.close_mgmt()
+        except OSError as ex:
             self.log.error(
                 'socket for OpenVPN server "%s" was unexpectedly closed: %s',
                 self.name,
                 ex,
             )
             self.close_mgmt()
+        else:
+            return True
+        return False
 
     def disconnect_client(self, common_name):
         """Disconnects the specified client from this OpenVPN server instance.
@@ -208,20 +391,88 @@ class OvpnServer:
                 self.name,
             )
             return
+        if common_name in self._pending_kills:
+            self.log.debug(
+                'client %s is already being disconnected from OpenVPN server "%s"',
+                common_name,
+                self.name,
+            )
+            return
         self.log.debug(
             'disconnecting client %s from OpenVPN server "%s"', common_name, self.name
         )
-        self._cmd_state.add(
-            _OvpnDisconnectClientsState(self, common_name, lambda res: None)
+        self._pending_kills.add(common_name)
+        self._add_cmd(
+            _OvpnDisconnectClientsState(
+                self, common_name, lambda res: self._pending_kills.discard(common_name)
+            )
+        )
+
+    def client_auth(self, cid: int, kid: int, config_lines: List[str]) -> None:
+        """Authorises a client and passes it its client-specific
+        configuration.
+
+        @param cid: The client's connection ID.
+        @param kid: The client's key ID.
+        @param config_lines: Lines of the client's configuration, as they
+            would appear in a client-connect config file.
+        """
+        if not self.connected:
+            self.log.error(
+                'cannot authorise client %d, as "%s" has no active management '
+                'connection.',
+                cid,
+                self.name,
+            )
+            return
+        self._add_cmd(
+            _OvpnClientAuthState(
+                self,
+                [b'client-auth %d %d' % (cid, kid)]
+                + [line.encode('utf-8') for line in config_lines]
+                + [b'END'],
+            )
+        )
+
+    def client_auth_nt(self, cid: int, kid: int) -> None:
+        """Authorises a client without changing its configuration.
+        """
+        if not self.connected:
+            return
+        self._add_cmd(
+            _OvpnClientAuthState(self, [b'client-auth-nt %d %d' % (cid, kid)])
         )
 
-    def poll_client_list(self, list_done_clb):
-        """Polls the list of clients connected to this server.  On completion,
-        the callback is called with the complete list as parameter.  In case
-        of an error, the callback is called with None instead of the list.
+    def client_deny(self, cid: int, kid: int, reason: str) -> None:
+        """Refuses a client's connection.
+
+        @param reason: Reason that is logged by the OpenVPN server.
+        """
+        if not self.connected:
+            return
+        self._add_cmd(
+            _OvpnClientAuthState(
+                self,
+                [
+                    b'client-deny %d %d "%s"'
+                    % (cid, kid, reason.replace('"', "'").encode('utf-8'))
+                ],
+            )
+        )
 
-        @param: list_done_clb The callback function to call on completion or
-                error.
+    def poll_client_list(
+        self,
+        client_clb: Callable[[str, Optional[str]], None],
+        list_done_clb: Callable[[], None],
+    ) -> None:
+        """Polls the list of clients connected to this server.  The clients
+        are passed to the client callback one by one, while the list is
+        received.  The complete list is never held in memory.
+
+        @param client_clb: Called with the common name and the virtual address
+            of each listed client.  The virtual address is None in case the
+            client's connection hasn't been fully established yet.
+        @param list_done_clb: Called once all clients have been listed.
         """
         if not self.connected:
             self.log.debug(
@@ -231,7 +482,7 @@ class OvpnServer:
             )
             return
         self.log.debug('polling user list from OpenVPN server "%s"', self.name)
-        self._cmd_state.add(_OvpnListClientsState(self, list_done_clb))
+        self._add_cmd(_OvpnListClientsState(self, client_clb, list_done_clb))
 
 
 class _OvpnIdleState:
@@ -250,6 +501,9 @@ class _OvpnWaitConnectState:
     def __init__(self, done_clb):
         self._done = done_clb
 
+    def start(self):
+        pass
+
     def handle_line(self, line):
         self._done(line)
         return False
@@ -260,28 +514,32 @@ class _OvpnListClientsState:
     list.
     """
 
-    def __init__(self, ovpn, list_done_clb):
+    def __init__(self, ovpn, client_clb, list_done_clb):
         self._ovpn = ovpn
+        self._client = client_clb
         self._list_done = list_done_clb
 
-        self._clients = []
+    def start(self):
         self._ovpn._send_cmd(b'status 2')
 
     def _parse_client_line(self, line):
-        cl = OvpnClientConnData(server=self._ovpn)
-        d = line.decode("utf-8").split(',')
-        cl.common_name = d[1]
-        if d[3] != '':
-            cl.virtual_address = d[3]
-        else:
-            cl.virtual_address = None
-        self._clients.append(cl)
+        # Only the common name and the virtual address are of interest:
+        # "CLIENT_LIST,{common name},{real address},{virtual address},..."
+        try:
+            _, common_name, _, virtual_address, _ = line.split(b',', 4)
+        except ValueError:
+            self._ovpn.log.warning('failed to parse client list line %r', line)
+            return
+        self._client(
+            common_name.decode('utf-8'),
+            virtual_address.decode('ascii') if virtual_address else None,
+        )
 
     def handle_line(self, line):
         if line.startswith(b'CLIENT_LIST,'):
             self._parse_client_line(line)
         elif line == b'END\n':
-            self._list_done(self._clients)
+            self._list_done()
             return False
         return True
 
@@ -291,8 +549,12 @@ class _OvpnDisconnectClientsState:
     """
 
     def __init__(self, ovpn, common_name, done_clb) -> None:
+        self._ovpn = ovpn
+        self._common_name = common_name
         self._done = done_clb
-        ovpn._send_cmd(b'kill "%s"' % common_name.encode("ascii"))
+
+    def start(self) -> None:
+        self._ovpn._send_cmd(b'kill "%s"' % self._common_name.encode("ascii"))
 
     def handle_line(self, line) -> bool:
         if line.startswith(b'SUCCESS:'):
@@ -304,25 +566,77 @@ class _OvpnDisconnectClientsState:
         return True
 
 
+class _OvpnClientAuthState:
+    """Uses an OpenVPN management socket to answer a client notification.
+    """
+
+    def __init__(self, ovpn, cmd_lines) -> None:
+        self._ovpn = ovpn
+        self._cmd_lines = cmd_lines
+
+    def start(self) -> None:
+        for cmd_line in self._cmd_lines:
+            if not self._ovpn._send_cmd(cmd_line):
+                # The connection was closed.
+                return
+
+    def handle_line(self, line) -> bool:
+        if line.startswith(b'SUCCESS:'):
+            return False
+        elif line.startswith(b'ERROR:'):
+            self._ovpn.log.error(
+                'OpenVPN server "%s" rejected client command: %s',
+                self._ovpn.name,
+                line.rstrip(b'\n'),
+            )
+            return False
+        return True
+
+
 class OvpnServerSupervisor:
     """Makes sure the associated OpenVPN server has an active management
     connection.
+
+    The connection is checked every timeout seconds.  Failed connection
+    attempts are retried with exponential backoff, up to max_timeout seconds.
+    A connection counts as failed until the management console has greeted
+    us.  Connections that are still waiting for the greeting at the next
+    check are given up.  The retry delays are randomly shortened by up to
+    half, so that servers that failed together don't retry in lockstep.
     """
 
     def __init__(
-        self, timeout_mgr: TimeoutManager, server: OvpnServer, timeout: float
+        self,
+        timeout_mgr: TimeoutManager,
+        server: OvpnServer,
+        timeout: float,
+        max_timeout: float = 600,
     ) -> None:
+        """\
+        @param timeout_mgr: Reference to a timeout manager.
+        @param server: The OpenVPN server to supervise.
+        @param timeout: Interval in which the connection is checked.  Also the
+            delay of the first retry.
+        @param max_timeout: Maximum delay between two connection attempts.
+        """
         self._timeout_mgr = timeout_mgr
         self._server = server
         self._timeout = timeout
+        self._max_timeout = max(timeout, max_timeout)
 
+        # Number of consecutive failed connection attempts.
+        self._failures = 0
         self._timeout_time = None
         self.log = logging.getLogger('ovpnserversup')
         self.log.debug('watching server connection %s', self._server)
         self._add_myself()
 
     def _add_myself(self):
-        self._timeout_time = time.time() + self._timeout
+        delay = self._timeout
+        if self._failures > 0:
+            delay = min(self._timeout * 2 ** (self._failures - 1), self._max_timeout)
+            delay *= random.uniform(0.5, 1)
+        self._timeout_time = time.time() + delay
         self._timeout_mgr.add_timeout_object(self)
 
     def __del__(self) -> None:
@@ -333,6 +647,14 @@ class OvpnServerSupervisor:
         return self._timeout_time
 
     def handle_timeout(self) -> None:
-        if not self._server.connected:
+        if self._server.established:
+            self._failures = 0
+        else:
+            if self._server.connected:
+                self.log.error(
+                    'OpenVPN server "%s" did not greet us in time', self._server
+                )
+                self._server.close_mgmt()
+            self._failures += 1
             self._server.connect_to_mgmt()
         self._add_myself()
@@ -17,6 +17,8 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import collections
+
 
 class StateQueue:
     """Manages a simple FIFO state queue with an idle state in case the queue is
@@ -28,7 +30,7 @@ class StateQueue:
         @param idle_state: The state to use while the queue is otherwise empty.
         """
         self._idle = idle_state
-        self._queue = []
+        self._queue = collections.deque()
         self._current = self._idle
 
     @property
@@ -38,12 +40,19 @@ class StateQueue:
         """
         return self._current
 
+    def __len__(self):
+        """@return: Returns the number of states, not counting the idle state.
+        """
+        if self._current is self._idle:
+            return 0
+        return 1 + len(self._queue)
+
     def add(self, new_state):
         """Add a new state to the FIFO queue.  Might be turned into the active
-        state in case the queue is currently empty.
+        state in case the queue is currently idle.
         @param new_state: The new state to add.
         """
-        if len(self._queue) == 0:
+        if self._current is self._idle:
             self._current = new_state
         else:
             self._queue.append(new_state)
@@ -56,10 +65,10 @@ class StateQueue:
         if len(self._queue) == 0:
             self._current = self._idle
         else:
-            self._current = self._queue.pop(0)
+            self._current = self._queue.popleft()
 
     def clear(self):
         """Clears the queue without waiting for any states to finish.
         """
-        self._queue = []
+        self._queue.clear()
         self._current = self._idle
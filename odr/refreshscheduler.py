@@ -0,0 +1,295 @@
+"""Spreads DHCP lease refreshes over time.
+
+Clients that connected at the same time get the same lease times and would
+refresh their leases in the same second ever after.  The scheduler plans
+each refresh into a one second slot of which only a limited number exist per
+realm and DHCP server.  In case the slot at the due time is taken, the
+refresh is moved to the latest free slot before it, within the time the
+client allows.  Only if there is none, the refresh is moved after the due
+time, but never past the lease's expiry.  Refreshes are additionally rate
+limited when they are started, so that unplanned refreshes (retries,
+detected clients) and refreshes that found no free slot are queued instead
+of exceeding the rate.
+"""
+
+import bisect
+import collections
+import logging
+import math
+import time
+
+from functools import partial
+from typing import Callable, Deque, Dict, Hashable, List, Optional, Set, Tuple
+
+from prometheus_client import Gauge
+
+from odr.timeoutmgr import TimeoutManager
+
+M_REFRESH_QUEUE_LENGTH = Gauge(
+    "dhcp_refresh_queue_length",
+    "number of lease refreshes waiting for the refresh rate limit",
+    ("realm", "servers"),
+)
+
+RefreshKey = Tuple[str, Hashable]
+
+
+class _FullSlotRuns:
+    """Keeps track of the full slots of a key as sorted runs of consecutive
+    slots.  The runs are maximal, so the slots right before and after a run
+    are free.  This allows finding the nearest free slot with a binary search,
+    no matter how many slots in a row are full.
+    """
+
+    def __init__(self) -> None:
+        # First and last slot of each run, both sorted.
+        self._starts = []  # type: List[int]
+        self._ends = []  # type: List[int]
+
+    def __bool__(self) -> bool:
+        return bool(self._starts)
+
+    def find(self, slot: int) -> Optional[Tuple[int, int]]:
+        """@return: Returns the first and last slot of the run containing the
+            slot or None in case the slot is free.
+        """
+        i = bisect.bisect_right(self._starts, slot) - 1
+        if i >= 0 and self._ends[i] >= slot:
+            return self._starts[i], self._ends[i]
+        return None
+
+    def add(self, slot: int) -> None:
+        """Marks a free slot as full.
+        """
+        i = bisect.bisect_right(self._starts, slot)
+        joins_prev = i > 0 and self._ends[i - 1] == slot - 1
+        joins_next = i < len(self._starts) and self._starts[i] == slot + 1
+        if joins_prev and joins_next:
+            self._ends[i - 1] = self._ends[i]
+            del self._starts[i]
+            del self._ends[i]
+        elif joins_prev:
+            self._ends[i - 1] = slot
+        elif joins_next:
+            self._starts[i] = slot
+        else:
+            self._starts.insert(i, slot)
+            self._ends.insert(i, slot)
+
+    def remove(self, slot: int) -> None:
+        """Marks a full slot as free.
+        """
+        i = bisect.bisect_right(self._starts, slot) - 1
+        start, end = self._starts[i], self._ends[i]
+        if start == end:
+            del self._starts[i]
+            del self._ends[i]
+        elif slot == start:
+            self._starts[i] = slot + 1
+        elif slot == end:
+            self._ends[i] = slot - 1
+        else:
+            self._ends[i] = slot - 1
+            self._starts.insert(i + 1, slot + 1)
+            self._ends.insert(i + 1, end)
+
+    def prune(self, before: int) -> None:
+        """Forgets all slots before the given one.
+        """
+        i = bisect.bisect_left(self._ends, before)
+        del self._starts[:i]
+        del self._ends[:i]
+        if self._starts and self._starts[0] < before:
+            self._starts[0] = before
+
+
+class RefreshScheduler:
+    """Plans and starts lease refreshes with at most max_rate refreshes per
+    second per key.  The key is made up of the realm name and the DHCP servers
+    the refresh is sent to.
+
+    With a max_rate of 0, refreshes are neither moved nor queued.
+    """
+
+    # How often to forget about reservations in the past, in seconds.
+    PRUNE_INTERVAL = 60
+
+    def __init__(
+        self,
+        timeout_mgr: TimeoutManager,
+        refresh_lease_clb: Callable[..., None],
+        max_rate: float = 0,
+    ) -> None:
+        """\
+        @param timeout_mgr: Instance of the timeout manager.
+        @param refresh_lease_clb: Call-back that starts a DHCP refresh request.
+        @param max_rate: Maximum number of refreshes per second and key.
+        """
+        self._log = logging.getLogger('refreshscheduler')
+        self._timeout_mgr = timeout_mgr
+        self._refresh_lease = refresh_lease_clb
+        self._max_rate = max_rate
+        # Maps keys to the number of reserved refreshes per second.
+        self._reservations = {}  # type: Dict[RefreshKey, Dict[int, int]]
+        # Maps keys to their full slots.
+        self._full_slots = {}  # type: Dict[RefreshKey, _FullSlotRuns]
+        self._next_prune = time.time() + self.PRUNE_INTERVAL
+        # Maps keys to the number of available tokens and the time they were
+        # last refilled.
+        self._buckets = {}  # type: Dict[RefreshKey, Tuple[float, float]]
+        self._queues = {}  # type: Dict[RefreshKey, Deque[Dict]]
+        self._drain_scheduled = set()  # type: Set[RefreshKey]
+
+    def reserve_slot(
+        self,
+        key: RefreshKey,
+        due_time: float,
+        earliest_time: float,
+        latest_time: Optional[float] = None,
+    ) -> float:
+        """Reserves a slot for a refresh.
+
+        @param key: Realm name and DHCP servers of the refresh.
+        @param due_time: When the refresh should happen.
+        @param earliest_time: When the refresh may happen at the earliest.
+        @param latest_time: When the refresh needs to have happened at the
+            latest, i.e. the lease's expiry.  None for no limit.
+        @return: Returns the time at which the refresh should be started.
+            That is the due time, if its slot is still free, otherwise the
+            latest free slot between earliest_time and due_time.  Only if all
+            of them are taken, the refresh is moved after the due time, to a
+            slot that ends before latest_time.  If that's not possible
+            either, the due slot is overbooked and the refresh is
+            left to the rate limit when it is started.
+        """
+        if self._max_rate <= 0:
+            return due_time
+        self._prune()
+        slots = self._reservations.setdefault(key, {})
+        full_slots = self._full_slots.setdefault(key, _FullSlotRuns())
+        due_slot = math.floor(due_time)
+        slot = due_slot
+        run = full_slots.find(due_slot)
+        if run is not None:
+            first, last = run
+            if first - 1 >= math.ceil(min(earliest_time, due_time)):
+                slot = first - 1
+            elif latest_time is None or last + 2 <= latest_time:
+                slot = last + 1
+            else:
+                self._log.debug('no free slot before lease expiry for %s', key)
+        slots[slot] = slots.get(slot, 0) + 1
+        if slots[slot] >= self._max_rate and full_slots.find(slot) is None:
+            full_slots.add(slot)
+        if slot == due_slot:
+            return due_time
+        self._log.debug('moved refresh by %ds for %s', slot - due_time, key)
+        return float(slot)
+
+    def release_slot(self, key: RefreshKey, start_time: float) -> None:
+        """Releases a slot reserved with reserve_slot, e.g. because the client
+        went away before its refresh was started.
+
+        @param key: Realm name and DHCP servers of the refresh.
+        @param start_time: The start time returned by reserve_slot.
+        """
+        if self._max_rate <= 0:
+            return
+        slots = self._reservations.get(key)
+        slot = math.floor(start_time)
+        if not slots or slot not in slots:
+            # Already pruned.
+            return
+        slots[slot] -= 1
+        full_slots = self._full_slots[key]
+        if slots[slot] < self._max_rate and full_slots.find(slot) is not None:
+            full_slots.remove(slot)
+        if slots[slot] <= 0:
+            del slots[slot]
+        if not slots:
+            del self._reservations[key]
+            del self._full_slots[key]
+
+    def _prune(self) -> None:
+        now = time.time()
+        if now < self._next_prune:
+            return
+        self._next_prune = now + self.PRUNE_INTERVAL
+        for key, slots in list(self._reservations.items()):
+            for slot in [slot for slot in slots if slot < now - 1]:
+                del slots[slot]
+            self._full_slots[key].prune(math.ceil(now - 1))
+            if not slots:
+                del self._reservations[key]
+                del self._full_slots[key]
+
+    def start_refresh(self, key: RefreshKey, **kwargs) -> None:
+        """Starts a refresh by calling the refresh call-back with the keyword
+        arguments.  In case the rate limit for the key is exceeded, the
+        refresh is queued and started later.
+        """
+        if self._max_rate <= 0:
+            self._refresh_lease(**kwargs)
+            return
+        queue = self._queues.get(key)
+        if queue:
+            # Keep the order.
+            self._enqueue(key, kwargs)
+        elif self._take_token(key):
+            self._refresh_lease(**kwargs)
+        else:
+            self._enqueue(key, kwargs)
+
+    def _take_token(self, key: RefreshKey) -> bool:
+        now = time.time()
+        # Rates below one per second still need to accumulate a whole token.
+        burst = max(self._max_rate, 1)
+        tokens, last = self._buckets.get(key, (burst, now))
+        tokens = min(burst, tokens + (now - last) * self._max_rate)
+        if tokens < 1:
+            self._buckets[key] = (tokens, now)
+            return False
+        self._buckets[key] = (tokens - 1, now)
+        return True
+
+    def _enqueue(self, key: RefreshKey, kwargs: Dict) -> None:
+        self._queues.setdefault(key, collections.deque()).append(kwargs)
+        _queue_length_metric(key).inc()
+        self._schedule_drain(key)
+
+    def _schedule_drain(self, key: RefreshKey) -> None:
+        if key in self._drain_scheduled:
+            return
+        self._drain_scheduled.add(key)
+        self._timeout_mgr.add_rel_timeout(
+            1.0 / self._max_rate, partial(self._drain, key)
+        )
+
+    def _drain(self, key: RefreshKey) -> None:
+        """Starts as many queued refreshes as the rate allows.
+        """
+        self._drain_scheduled.discard(key)
+        queue = self._queues.get(key)
+        while queue and self._take_token(key):
+            kwargs = queue.popleft()
+            _queue_length_metric(key).dec()
+            try:
+                self._refresh_lease(**kwargs)
+            except Exception:
+                self._log.exception('starting a queued lease refresh failed')
+                kwargs['failure_handler_clb']()
+        if queue:
+            self._schedule_drain(key)
+        else:
+            self._queues.pop(key, None)
+
+    def queue_length(self, key: RefreshKey) -> int:
+        """@return: Returns the number of queued refreshes for the key.
+        """
+        queue = self._queues.get(key)
+        return len(queue) if queue else 0
+
+
+def _queue_length_metric(key: RefreshKey):
+    realm, server_ips = key
+    return M_REFRESH_QUEUE_LENGTH.labels(realm, ','.join(map(str, server_ips)))
@@ -1,6 +1,6 @@
 # vim:set fileencoding=utf-8 ft=python ts=8 sw=4 sts=4 et cindent:
 
-# socketloop.py - Provides a socket/select-based event loop.
+# socketloop.py - Provides a socket/selector-based event loop.
 #
 # Copyright © 2010 Fabian Knittel <fabian.knittel@lettink.de>
 #
@@ -17,8 +17,25 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import select
+import collections
+import selectors
+import socket
 import logging
+import time
+
+from prometheus_client import Histogram
+
+M_LOOP_LAG = Histogram(
+    "socketloop_lag_seconds",
+    "how late the socket loop woke up compared to its deadline",
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1),
+)
+M_HANDLER_DURATION = Histogram(
+    "socketloop_handler_seconds",
+    "time spent in a single call of a socket or idle handler",
+    ("handler",),
+    buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.1, 1),
+)
 
 
 class SocketLoop:
@@ -26,67 +43,162 @@ class SocketLoop:
     socket.  Waits for activity on all known sockets and in case of activity for
     a certain socket, calls the socket's handler.
 
+    Sockets are registered with the selector once, when their handler is
+    added, and unregistered when the handler is removed.  Activity is mapped
+    back to the handler through a table indexed by file descriptor, so the
+    cost of each loop cycle depends on the number of ready sockets, not on the
+    number of known sockets.
+
     Additionally, there are idle handlers that get called after socket activity
     processing or once after every timeout (if there was no activity at all).
+
+    Other threads may hand call-backs to the loop's thread via
+    call_from_thread.
+
+    If a deadline call-back is set, the loop sleeps until the returned deadline
+    (or indefinitely if there is none) instead of waking up every "timeout"
+    seconds.
+
+    The time spent in each handler call is recorded per handler class (or
+    function, for idle handlers), as well as how late the loop woke up after
+    its deadline.  Handler calls taking longer than slow_handler_threshold
+    seconds are logged.
     """
 
-    def __init__(self):
+    def __init__(self, selector: selectors.BaseSelector = None) -> None:
+        """\
+        @param selector: The selector instance used to wait for socket
+            activity.  Defaults to the most efficient selector available on
+            the platform (epoll on Linux).  Pass a selectors.SelectSelector
+            instance to fall back to select().
+        """
+        if selector is None:
+            selector = selectors.DefaultSelector()
+        self._selector = selector
+        # Maps file descriptors to socket handlers.
         self._socket_handlers = {}
+        # Maps id(socket handler) to the file descriptor it was registered
+        # with, as the handler's socket might already be closed on removal.
+        self._handler_fds = {}
         self._idle_handlers = []
+        # Call-backs handed over by other threads.
+        self._pending_calls = collections.deque()
+        self._deadline = None
         self._run = True
         self.timeout = 0.5
+        # Handler calls taking longer are logged.  0 disables the logging.
+        self.slow_handler_threshold = 0.0
+        # Maps handler names to their duration metric.
+        self._handler_metrics = {}
         self.log = logging.getLogger('socketloop')
 
-    def _handle_ready_input_sockets(self, ready_input_sockets):
-        for ready_input_socket in ready_input_sockets:
-            socket_handler = self._socket_handlers[ready_input_socket]
+        self._waker = _LoopWaker()
+        self.add_socket_handler(self._waker)
+
+    def _handle_ready_input_fds(self, ready_input_fds):
+        for ready_input_fd in ready_input_fds:
+            # A previous handler might have removed this one in the mean-time.
+            socket_handler = self._socket_handlers.get(ready_input_fd)
+            if socket_handler is None:
+                continue
+            start = time.monotonic()
             try:
                 socket_handler.handle_socket()
             except Exception:
                 self.log.exception('socket handler failed, removing')
                 self.del_socket_handler(socket_handler)
+            self._record_duration(type(socket_handler).__name__, start)
 
     def _handle_idle_handlers(self):
         for idle_handler in self._idle_handlers[:]:
+            start = time.monotonic()
             try:
                 idle_handler()
             except Exception:
                 self.log.exception('idle handler failed, removing')
                 self.del_idle_handler(idle_handler)
+            self._record_duration(_handler_name(idle_handler), start)
+
+    def _record_duration(self, name, start):
+        duration = time.monotonic() - start
+        metric = self._handler_metrics.get(name)
+        if metric is None:
+            metric = self._handler_metrics[name] = M_HANDLER_DURATION.labels(name)
+        metric.observe(duration)
+        if 0 < self.slow_handler_threshold <= duration:
+            self.log.warning('slow handler %s took %.3fs', name, duration)
+
+    def _handle_pending_calls(self):
+        while self._pending_calls:
+            clb = self._pending_calls.popleft()
+            try:
+                clb()
+            except Exception:
+                self.log.exception('call-back from thread failed')
 
     def run(self):
         """Runs the socket select loop until the quit method is called.  Calls
         the idle handlers after each loop cycle.
         """
         while self._run:
+            deadline = self._wait_deadline()
+            if deadline is None:
+                wait_time = None
+            else:
+                wait_time = max(0, deadline - time.time())
             # We currently only care about read events. (Read events also cover
             # connect events on listening sockets.)
             try:
-                ready_input_sockets, _, _ = select.select(
-                    self.sockets, [], [], self.timeout
-                )
+                events = self._selector.select(wait_time)
             except InterruptedError:
                 continue
-            self._handle_ready_input_sockets(ready_input_sockets)
+            if deadline is not None:
+                lag = time.time() - deadline
+                if lag >= 0:
+                    M_LOOP_LAG.observe(lag)
+            self._handle_ready_input_fds([key.fd for key, _ in events])
+            self._handle_pending_calls()
             self._handle_idle_handlers()
 
+    def _wait_deadline(self):
+        """@return: Returns the time until which to wait for socket activity
+            or None to wait indefinitely.
+        """
+        if self._deadline is None:
+            return time.time() + self.timeout
+        return self._deadline()
+
+    def set_deadline_clb(self, deadline_clb):
+        """Set the call-back that is used to determine how long to wait for
+        socket activity.  The idle handlers are responsible for the work
+        that is due at the deadline.
+        @param deadline_clb: Function returning the absolute time (in seconds
+            since the epoch) at which the loop needs to wake up, or None if
+            there is no such time.
+        """
+        self._deadline = deadline_clb
+
     def add_socket_handler(self, socket_handler):
         """Add an additional socket handler.
         @param socket_handler: The socket handler instance to add.
         """
-        self.log.debug(
-            'adding socket_handler for socket %d', socket_handler.socket.fileno()
-        )
-        self._socket_handlers[socket_handler.socket] = socket_handler
+        fd = socket_handler.socket.fileno()
+        self.log.debug('adding socket_handler for socket %d', fd)
+        self._selector.register(fd, selectors.EVENT_READ)
+        self._socket_handlers[fd] = socket_handler
+        self._handler_fds[id(socket_handler)] = fd
 
     def del_socket_handler(self, socket_handler):
         """Remove a previously added socket handler.
-        @param socket_handler: The socket handler instance to remove.
+        @param socket_handler: The socket handler instance to remove.  Removing
+            a handler that is not registered (anymore) is a no-op.
         """
-        self.log.debug(
-            'removing socket_handler for socket %d', socket_handler.socket.fileno()
-        )
-        del self._socket_handlers[socket_handler.socket]
+        fd = self._handler_fds.pop(id(socket_handler), None)
+        if fd is None:
+            return
+        self.log.debug('removing socket_handler for socket %d', fd)
+        self._selector.unregister(fd)
+        del self._socket_handlers[fd]
 
     def add_idle_handler(self, idle_handler):
         """Add an idle handler.
@@ -102,14 +214,67 @@ class SocketLoop:
         self.log.debug('removing idle_handler')
         self._idle_handlers.remove(idle_handler)
 
+    def call_from_thread(self, clb):
+        """Have a call-back called by the loop's thread, before the next call
+        of the idle handlers.  May be called from any thread.
+        @param clb: The call-back, called without arguments.
+        """
+        self._pending_calls.append(clb)
+        self._waker.wake()
+
     @property
     def sockets(self):
         """@return: Returns the list of sockets that we have handlers for.
         """
-        return list(self._socket_handlers.keys())
+        return [
+            handler.socket
+            for handler in self._socket_handlers.values()
+            if handler is not self._waker
+        ]
 
     def quit(self):
         """Request that the select loop be exited soon.  Sets a flag that will
-        be checked for in the select loop.
+        be checked for in the select loop.  May be called from a signal
+        handler.
         """
         self._run = False
+        self._waker.wake()
+
+
+def _handler_name(handler):
+    """@return: Returns a name for the idle handler, e.g.
+        "TimeoutManager.check_timeouts".
+    """
+    # Unwrap functools.partial and WeakBoundMethod instances.
+    func = getattr(handler, 'func', handler)
+    func = getattr(func, '_free_method', func)
+    return getattr(func, '__qualname__', type(func).__name__)
+
+
+class _LoopWaker:
+    """Socket handler that allows the loop's wait for socket activity to be
+    interrupted, e.g. from a signal handler.
+    """
+
+    def __init__(self):
+        self._wake_socket, self._socket = socket.socketpair()
+        self._wake_socket.setblocking(False)
+        self._socket.setblocking(False)
+
+    @property
+    def socket(self):
+        return self._socket
+
+    def wake(self):
+        try:
+            self._wake_socket.send(b'\0')
+        except BlockingIOError:
+            # The loop will be woken up anyway.
+            pass
+
+    def handle_socket(self):
+        try:
+            while self._socket.recv(1024):
+                pass
+        except BlockingIOError:
+            pass
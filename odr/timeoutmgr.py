@@ -17,9 +17,11 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import heapq
+import itertools
 import time
 
-from typing import Callable, List
+from typing import Callable, Dict, List, Optional
 
 
 class TimeoutObject:
@@ -34,16 +36,45 @@ class TimeoutObject:
         return "<{} wrapping {!r}>".format(self.__class__, self._timeout_func)
 
 
+class _TimeoutEntry:
+    """Heap entry of the TimeoutManager.  Entries are ordered by their timeout
+    time and, for equal timeout times, by their insertion order.
+    """
+
+    __slots__ = ('timeout_time', 'seq', 'timeout_object', 'cancelled')
+
+    def __init__(self, timeout_time: float, seq: int, timeout_object) -> None:
+        self.timeout_time = timeout_time
+        self.seq = seq
+        self.timeout_object = timeout_object
+        self.cancelled = False
+
+    def __lt__(self, other: "_TimeoutEntry") -> bool:
+        return (self.timeout_time, self.seq) < (other.timeout_time, other.seq)
+
+
 class TimeoutManager:
     """The TimeoutManager keeps track of objects that have a timeout time set.
     As soon as a timeout occurs, the affected objects are notified.
 
     Objects that have timed out are removed from the timeout managers list of
     objects.
+
+    The objects are kept in a min-heap ordered by timeout time.  Removing an
+    object only marks its heap entry as cancelled.  Cancelled entries are
+    dropped when they reach the top of the heap or when they make up the
+    majority of the heap, whichever happens first.
     """
 
+    # Don't bother compacting heaps smaller than this.
+    COMPACT_MIN_SIZE = 64
+
     def __init__(self) -> None:
-        self._timeout_objects = []  # type: List[TimeoutObject]
+        self._heap = []  # type: List[_TimeoutEntry]
+        # Maps id(timeout object) to its active heap entry.
+        self._entries = {}  # type: Dict[int, _TimeoutEntry]
+        self._num_cancelled = 0
+        self._seq = itertools.count()
 
     def add_rel_timeout(
         self, timeout_secs: float, timeout_func: Callable[[], None]
@@ -81,30 +112,77 @@ class TimeoutManager:
         time as attribute "timeout_time" and an event handler method
         "handle_timeout".
 
+        The timeout time is read once, when the object is added.
+
         @param timeout_object: Object that should be added.
         """
-        self._timeout_objects.append(timeout_object)
+        entry = _TimeoutEntry(
+            timeout_object.timeout_time, next(self._seq), timeout_object
+        )
+        self._entries[id(timeout_object)] = entry
+        heapq.heappush(self._heap, entry)
 
     def del_timeout_object(self, timeout_object: TimeoutObject) -> None:
         """Removes a timeout object.  The method may be used if an object should
         be removed before it times out.
 
         @param timeout_object: Object that is to be removed.
+        @raises ValueError: If the object is not known to the manager.
+        """
+        try:
+            entry = self._entries.pop(id(timeout_object))
+        except KeyError:
+            raise ValueError('unknown timeout object {!r}'.format(timeout_object))
+        entry.cancelled = True
+        self._num_cancelled += 1
+        if (
+            len(self._heap) >= self.COMPACT_MIN_SIZE
+            and self._num_cancelled * 2 > len(self._heap)
+        ):
+            self._compact()
+
+    def _compact(self) -> None:
+        """Drops all cancelled entries from the heap.
         """
-        self._timeout_objects.remove(timeout_object)
+        self._heap = [entry for entry in self._heap if not entry.cancelled]
+        heapq.heapify(self._heap)
+        self._num_cancelled = 0
+
+    def next_timeout_time(self) -> Optional[float]:
+        """@return: Returns the absolute time of the earliest pending timeout
+            or None in case there are no pending timeouts.
+        """
+        while self._heap and self._heap[0].cancelled:
+            heapq.heappop(self._heap)
+            self._num_cancelled -= 1
+        if not self._heap:
+            return None
+        return self._heap[0].timeout_time
 
     def check_timeouts(self) -> None:
         """This method should be periodically called to check whether any
         timeouts have occured in the mean-time.
 
         Objects that have timed out are removed from the list of timeout objects
-        and get notified by invoking their "handle_timeout" method.
+        and get notified by invoking their "handle_timeout" method.  Objects
+        added by these handlers are not notified before the next call, even if
+        they have already timed out.
         """
-        old_tos = self._timeout_objects
-        self._timeout_objects = []
         t = time.time()
-        for timeout_object in old_tos:
-            if timeout_object.timeout_time > t:
-                self._timeout_objects.append(timeout_object)
-            else:
-                timeout_object.handle_timeout()
+        # Entries added from here on are left for the next call.
+        last_seq = next(self._seq)
+        deferred = []
+        while self._heap and self._heap[0].timeout_time <= t:
+            entry = heapq.heappop(self._heap)
+            if entry.cancelled:
+                self._num_cancelled -= 1
+                continue
+            if entry.seq > last_seq:
+                deferred.append(entry)
+                continue
+            if self._entries.get(id(entry.timeout_object)) is entry:
+                del self._entries[id(entry.timeout_object)]
+            entry.timeout_object.handle_timeout()
+        for entry in deferred:
+            heapq.heappush(self._heap, entry)
+
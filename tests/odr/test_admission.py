@@ -0,0 +1,118 @@
+from unittest.mock import Mock
+
+import pytest
+
+from odr.admission import AdmissionController
+
+
+def _submit(ctrl, realm="realm", local_ip="192.0.2.1", **kwargs):
+    success, failure = Mock(), Mock()
+    ctrl.submit(
+        realm,
+        success_handler_clb=success,
+        failure_handler_clb=failure,
+        device=None,
+        local_ip=local_ip,
+        **kwargs
+    )
+    return success, failure
+
+
+@pytest.fixture()
+def start_request():
+    return Mock(return_value=True)
+
+
+def test_unlimited(start_request, timeout_mgr):
+    ctrl = AdmissionController(start_request, timeout_mgr)
+    for _ in range(5):
+        _submit(ctrl)
+    assert start_request.call_count == 5
+    assert ctrl.queue_length("realm") == 0
+    assert ctrl.accepts("realm")
+
+
+def test_limit_per_realm(start_request, timeout_mgr):
+    ctrl = AdmissionController(start_request, timeout_mgr, max_in_flight_per_realm=2)
+    handlers = [_submit(ctrl, client_identifier=str(i)) for i in range(4)]
+    _submit(ctrl, realm="other")
+    assert start_request.call_count == 3
+    assert ctrl.queue_length("realm") == 2
+
+    # Finishing a request admits the next one, in order.
+    start_request.call_args_list[0][1]["success_handler_clb"]({"ip_address": "x"})
+    handlers[0][0].assert_called_once_with({"ip_address": "x"})
+    assert start_request.call_args[1]["client_identifier"] == "2"
+    start_request.call_args_list[1][1]["failure_handler_clb"]()
+    handlers[1][1].assert_called_once_with()
+    assert start_request.call_args[1]["client_identifier"] == "3"
+    assert ctrl.queue_length("realm") == 0
+
+
+def test_limit_per_requestor_and_priority(start_request, timeout_mgr):
+    ctrl = AdmissionController(
+        start_request, timeout_mgr, max_in_flight_per_requestor=1
+    )
+    _submit(ctrl, realm="a", client_identifier="first")
+    _submit(ctrl, realm="b", client_identifier="low", priority=1)
+    _submit(ctrl, realm="b", client_identifier="high", priority=0)
+    _submit(ctrl, realm="c", local_ip="192.0.2.2", client_identifier="other")
+    assert [c[1]["client_identifier"] for c in start_request.call_args_list] == [
+        "first",
+        "other",
+    ]
+    start_request.call_args_list[0][1]["success_handler_clb"]({})
+    assert start_request.call_args[1]["client_identifier"] == "high"
+
+
+def test_not_started_releases_slot(start_request, timeout_mgr):
+    start_request.return_value = False
+    ctrl = AdmissionController(start_request, timeout_mgr, max_in_flight_per_realm=1)
+    failures = [_submit(ctrl)[1] for _ in range(3)]
+    assert start_request.call_count == 3
+    for failure in failures:
+        failure.assert_called_once_with()
+
+
+def test_reject_and_expire(start_request, timeout_mgr, mocker):
+    now = mocker.patch("odr.admission.time.time", return_value=1000.0)
+    ctrl = AdmissionController(
+        start_request, timeout_mgr, max_in_flight_per_realm=1, max_wait=2
+    )
+    assert ctrl.accepts("realm")
+    _submit(ctrl)
+    assert ctrl.accepts("realm")
+    _, failure = _submit(ctrl)
+    _submit(ctrl)
+    assert not ctrl.accepts("realm")
+
+    now.return_value = 1003.0
+    start_request.call_args[1]["failure_handler_clb"]()
+    # The waiting requests have waited too long.
+    failure.assert_called_once_with()
+    assert start_request.call_count == 1
+
+
+def test_expire_while_waiting(start_request, timeout_mgr, mocker):
+    now = mocker.patch("odr.admission.time.time", return_value=1000.0)
+    ctrl = AdmissionController(
+        start_request, timeout_mgr, max_in_flight_per_realm=1, max_wait=2
+    )
+    _submit(ctrl)
+    _, first = _submit(ctrl, priority=1)
+    now.return_value = 1001.0
+    _, second = _submit(ctrl, priority=0)
+    assert ctrl.queue_length("realm") == 2
+
+    # The first request expires, although it is not at the head of the queue.
+    now.return_value = 1002.5
+    timeout_mgr.check_timeouts()
+    first.assert_called_once_with()
+    second.assert_not_called()
+    assert ctrl.queue_length("realm") == 1
+
+    # Admitted requests no longer expire.
+    start_request.call_args[1]["failure_handler_clb"]()
+    assert start_request.call_count == 2
+    assert timeout_mgr.next_timeout_time() is None
+    second.assert_not_called()
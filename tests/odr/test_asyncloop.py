@@ -0,0 +1,97 @@
+import threading
+import time
+from socket import socketpair
+from unittest.mock import Mock
+
+import pytest
+from prometheus_client import REGISTRY
+
+from odr.asyncloop import AsyncioSocketLoop, AsyncioTimeoutManager
+
+
+@pytest.fixture()
+def asloop():
+    sloop = AsyncioSocketLoop()
+    yield sloop
+    sloop.loop.close()
+
+
+def test_timeouts_and_idle_handlers(asloop):
+    timeout_mgr = AsyncioTimeoutManager(asloop)
+    fired = []
+    idle = Mock()
+    asloop.add_idle_handler(idle)
+
+    timeout_mgr.add_rel_timeout(0.02, lambda: fired.append(2))
+    timeout_mgr.add_rel_timeout(0.01, lambda: fired.append(1))
+    cancelled = timeout_mgr.add_rel_timeout(0.01, lambda: fired.append(0))
+    timeout_mgr.del_timeout_object(cancelled)
+    with pytest.raises(ValueError):
+        timeout_mgr.del_timeout_object(cancelled)
+    timeout_mgr.add_rel_timeout(0.03, asloop.quit)
+
+    asloop.run()
+    assert fired == [1, 2]
+    assert idle.call_count >= 2
+
+
+def test_socket_handler(asloop):
+    sock_in, sock_out = socketpair()
+    handler = Mock(socket=sock_out)
+
+    def handle_socket():
+        handler.data = sock_out.recv(1024)
+        asloop.del_socket_handler(handler)
+        asloop.quit()
+
+    handler.handle_socket = handle_socket
+    asloop.add_socket_handler(handler)
+    sock_in.send(b"ping")
+    asloop.run()
+    assert handler.data == b"ping"
+    assert asloop.sockets == []
+    asloop.del_socket_handler(handler)
+
+
+def test_call_from_thread(asloop):
+    called = []
+
+    def clb():
+        called.append(threading.current_thread())
+        asloop.quit()
+
+    threading.Thread(target=asloop.call_from_thread, args=(clb,)).start()
+    asloop.run()
+    assert called == [threading.main_thread()]
+
+
+def test_timeout_handler_exception_propagates(asloop):
+    timeout_mgr = AsyncioTimeoutManager(asloop)
+    errors = []
+    asloop.loop.set_exception_handler(lambda loop, ctx: errors.append(ctx))
+
+    def fail():
+        raise RuntimeError("boom")
+
+    timeout_mgr.add_rel_timeout(0, fail)
+    timeout_mgr.add_rel_timeout(0.01, asloop.quit)
+    asloop.run()
+    assert [type(ctx["exception"]) for ctx in errors] == [RuntimeError]
+
+
+def test_handler_metrics(asloop, caplog):
+    timeout_mgr = AsyncioTimeoutManager(asloop)
+    label = {"handler": "AsyncioTimeoutManager._handle_timeout"}
+    before = REGISTRY.get_sample_value("socketloop_handler_seconds_count", label)
+    lag_before = REGISTRY.get_sample_value("socketloop_lag_seconds_count")
+
+    asloop.slow_handler_threshold = 0.01
+    timeout_mgr.add_rel_timeout(0, lambda: time.sleep(0.02))
+    timeout_mgr.add_rel_timeout(0.03, asloop.quit)
+    asloop.run()
+
+    after = REGISTRY.get_sample_value("socketloop_handler_seconds_count", label)
+    lag_after = REGISTRY.get_sample_value("socketloop_lag_seconds_count")
+    assert after - (before or 0) == 2
+    assert lag_after - (lag_before or 0) == 2
+    assert "slow handler AsyncioTimeoutManager._handle_timeout" in caplog.text
@@ -0,0 +1,105 @@
+import pytest
+
+from odr.dhcppacket import (
+    DHCP_ACK,
+    MAGIC_COOKIE,
+    OPTIONS_OFFSET,
+    DhcpPacket,
+)
+
+
+def _header(**fields):
+    header = bytearray(236)
+    header[0] = fields.get("op", 0)
+    header[4:8] = fields.get("xid", 0).to_bytes(4, "big")
+    header[16:20] = fields.get("yiaddr", bytes(4))
+    return bytes(header)
+
+
+def test_encode_sorts_options():
+    packet = DhcpPacket()
+    packet.set_option("op", b"\x01")
+    packet.set_option("xid", (0x12345678).to_bytes(4, "big"))
+    packet.set_option("client_identifier", b"abc")
+    packet.set_option("dhcp_message_type", b"\x01")
+    packet.set_option("subnet_mask", bytes([255, 255, 255, 0]))
+
+    expected = (
+        _header(op=1, xid=0x12345678)
+        + MAGIC_COOKIE
+        + bytes([1, 4, 255, 255, 255, 0])
+        + bytes([53, 1, 1])
+        + bytes([61, 3]) + b"abc"
+        + bytes([255])
+    )
+    assert packet.encode() == expected
+
+
+def test_decode():
+    data = (
+        _header(op=2, xid=42, yiaddr=bytes([10, 0, 0, 1]))
+        + MAGIC_COOKIE
+        + bytes([0, 0])  # padding
+        + bytes([53, 1, DHCP_ACK])
+        + bytes([15, 3]) + b"foo"
+        + bytes([255])
+        + bytes([6, 4, 1, 1, 1, 1])  # after end option, ignored
+    )
+    packet = DhcpPacket.decode(bytearray(data), ("1.2.3.4", 67))
+    assert packet.is_dhcp_packet()
+    assert packet.source_address == ("1.2.3.4", 67)
+    assert packet.xid == 42
+    assert packet.message_type == DHCP_ACK
+    assert packet.get_option("op") == b"\x02"
+    assert packet.get_option("yiaddr") == bytes([10, 0, 0, 1])
+    assert packet.get_option("domain_name") == b"foo"
+    assert packet.has_option("domain_name")
+    assert not packet.has_option("domain_name_server")
+    assert packet.get_option("domain_name_server") == b""
+    assert packet.has_option("yiaddr")
+
+
+def test_decode_invalid():
+    assert not DhcpPacket.decode(b"\x02" * 100).is_dhcp_packet()
+
+    packet = DhcpPacket.decode(_header() + b"\0\0\0\0" + bytes([53, 1, 5, 255]))
+    assert not packet.is_dhcp_packet()
+
+    # Options after a misplaced magic cookie are ignored.
+    packet = DhcpPacket.decode(_header() + b"\0" + MAGIC_COOKIE + bytes([53, 1, 5]))
+    assert not packet.is_dhcp_packet()
+    assert not packet.has_option("dhcp_message_type")
+
+    # Truncated option.
+    packet = DhcpPacket.decode(_header() + MAGIC_COOKIE + bytes([15, 10]) + b"abc")
+    assert packet.is_dhcp_packet()
+    assert packet.message_type is None
+    assert not packet.has_option("domain_name")
+
+
+def test_roundtrip():
+    packet = DhcpPacket()
+    packet.set_option("giaddr", bytes([127, 0, 0, 1]))
+    packet.set_option("relay_agent", bytes([5, 4, 10, 0, 0, 0]))
+    packet.set_option("parameter_request_list", bytes([1, 121, 3]))
+    data = packet.encode()
+
+    decoded = DhcpPacket.decode(data)
+    assert decoded.encode() == data
+    assert decoded.get_option("giaddr") == bytes([127, 0, 0, 1])
+    assert decoded.get_option("relay_agent") == bytes([5, 4, 10, 0, 0, 0])
+
+    decoded.set_option("hops", b"\x01")
+    decoded.set_option("relay_agent", b"")
+    assert decoded.get_option("hops") == b"\x01"
+    assert decoded.encode()[OPTIONS_OFFSET:] == bytes([55, 3, 1, 121, 3, 82, 0, 255])
+
+
+def test_set_option_errors():
+    packet = DhcpPacket()
+    with pytest.raises(ValueError):
+        packet.set_option("xid", b"\x01")
+    with pytest.raises(ValueError):
+        packet.set_option("domain_name", b"x" * 256)
+    with pytest.raises(KeyError):
+        packet.set_option("no_such_option", b"")
@@ -1,15 +1,19 @@
+from ipaddress import IPv4Address
 from unittest.mock import Mock
 import logging
+import socket
 
 import pytest
+from prometheus_client import REGISTRY
 
 from odr.dhcprequestor import (
     DhcpAddressRequest,
     parse_classless_static_routes,
     DhcpAddressInitialRequest,
     DhcpAddressRefreshRequest,
+    DhcpAddressRequestor,
 )
-from pydhcplib.dhcp_packet import DhcpPacket
+from odr.dhcppacket import DhcpPacket
 
 
 @pytest.fixture()
@@ -81,23 +85,20 @@ def test_handle_dhcp_handshake(dhcprequest) -> None:
     req.handle_dhcp_offer(offer)
 
     packet = DhcpPacket()
-    packet.AddLine("op: 2")
-    packet.AddLine("domain_name: scc.kit.edu")
-    packet.AddLine("yiaddr: 1.2.3.4")
-    packet.AddLine("router: 2.3.4.5")
-    packet.AddLine("subnet_mask: 255.255.255.0")
-    packet.AddLine("domain_name_server: 1.0.0.0,2.0.0.0,3.0.0.0")
-    packet.SetOption(
+    packet.set_option("op", bytes([2]))
+    packet.set_option("domain_name", b"scc.kit.edu")
+    packet.set_option("yiaddr", bytes([1, 2, 3, 4]))
+    packet.set_option("router", bytes([2, 3, 4, 5]))
+    packet.set_option("subnet_mask", bytes([255, 255, 255, 0]))
+    packet.set_option("domain_name_server", bytes([1, 0, 0, 0, 2, 0, 0, 0, 3, 0, 0, 0]))
+    packet.set_option(
         "classless_static_route", bytes([0, 4, 0, 0, 0, 16, 10, 12, 5, 0, 0, 0])
     )
-    packet.AddLine("ip_address_lease_time: 9000")
-    packet.AddLine("renewal_time_value: 300")
-    packet.AddLine("ip_address_lease_time: 9000")
-    packet.AddLine("rebinding_time_value: 7000")
+    packet.set_option("ip_address_lease_time", (9000).to_bytes(4, "big"))
+    packet.set_option("renewal_time_value", (300).to_bytes(4, "big"))
+    packet.set_option("rebinding_time_value", (7000).to_bytes(4, "big"))
     packet.source_address = ("123.123.123.123", 67)
 
-    print(packet.str())
-
     expected_res = {
         "dns": ["1.0.0.0", "2.0.0.0", "3.0.0.0"],
         "domain": "scc.kit.edu",
@@ -108,13 +109,263 @@ def test_handle_dhcp_handshake(dhcprequest) -> None:
         "lease_timeout": 1580009000,
         "renewal_timeout": 1580000300,
         "rebinding_timeout": 1580007000,
+        "server_ip": "123.123.123.123",
     }
 
     req.handle_dhcp_ack(packet)
     success_mock.assert_called_once_with(expected_res)
 
 
+def _sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+def test_latency_metrics(dhcprequest) -> None:
+    server = {"realm": "metrics", "server": "123.123.123.123"}
+    offers = _sample("dhcp_offer_latency_seconds_count", **server)
+    acks = _sample("dhcp_ack_latency_seconds_count", request="initial", **server)
+    req = dhcprequest(
+        cls=DhcpAddressInitialRequest,
+        success_clb=Mock(),
+        requestor=Mock(),
+        realm="metrics",
+    )
+
+    packet = DhcpPacket()
+    packet.source_address = ("123.123.123.123", 67)
+    req.handle_dhcp_offer(packet)
+    assert _sample("dhcp_offer_latency_seconds_count", **server) == offers + 1
+
+    packet.set_option("domain_name", b"scc.kit.edu")
+    packet.set_option("domain_name_server", b"")
+    packet.set_option("ip_address_lease_time", (9000).to_bytes(4, "big"))
+    req.handle_dhcp_ack(packet)
+    assert (
+        _sample("dhcp_ack_latency_seconds_count", request="initial", **server)
+        == acks + 1
+    )
+
+
+def test_failure_metrics(dhcprequest) -> None:
+    labels = {"request": "refresh", "realm": "metrics"}
+    nacks = _sample("dhcp_nack_count_total", server="123.123.123.123", **labels)
+    retransmits = _sample("dhcp_retransmit_count_total", **labels)
+    timeouts = _sample("dhcp_timeout_count_total", **labels)
+
+    req = dhcprequest(
+        cls=DhcpAddressRefreshRequest,
+        requestor=Mock(),
+        failure_clb=Mock(),
+        client_ip="1.2.3.4",
+        realm="metrics",
+        max_retries=1,
+    )
+    req.handle_timeout()
+    req.handle_timeout()
+    assert _sample("dhcp_retransmit_count_total", **labels) == retransmits + 1
+    assert _sample("dhcp_timeout_count_total", **labels) == timeouts + 1
+
+    req = dhcprequest(
+        cls=DhcpAddressRefreshRequest,
+        requestor=Mock(),
+        failure_clb=Mock(),
+        client_ip="1.2.3.4",
+        realm="metrics",
+    )
+    packet = DhcpPacket()
+    packet.source_address = ("123.123.123.123", 67)
+    req.handle_dhcp_nack(packet)
+    assert (
+        _sample("dhcp_nack_count_total", server="123.123.123.123", **labels)
+        == nacks + 1
+    )
+
+
 def test_dhcp_refresh(dhcprequest) -> None:
     req = dhcprequest(
         cls=DhcpAddressRefreshRequest, requestor=Mock(), client_ip="1.2.3.4"
     )
+
+
+def _generic_request(xid, message_type, lease_time=None, target_addr=None, **options):
+    packet = DhcpPacket()
+    packet.set_option("op", b"\x01")
+    packet.set_option("htype", b"\x01")
+    packet.set_option("hops", b"\x01")
+    packet.set_option("xid", xid.to_bytes(4, "big"))
+    packet.set_option("giaddr", bytes([127, 1, 2, 3]))
+    if target_addr:
+        packet.set_option(
+            "relay_agent", bytes([5, 4]) + IPv4Address(target_addr).packed
+        )
+    packet.set_option("client_identifier", b"test123")
+    packet.set_option("dhcp_message_type", bytes([message_type]))
+    packet.set_option("parameter_request_list", bytes([1, 121, 3, 6, 15, 58, 59]))
+    if lease_time is not None:
+        packet.set_option("ip_address_lease_time", lease_time.to_bytes(4, "big"))
+    for name, value in options.items():
+        packet.set_option(name, value)
+    return packet.encode()
+
+
+@pytest.mark.parametrize("lease_time", [None, 3600])
+@pytest.mark.parametrize("target_addr", [None, "10.0.0.0"])
+def test_request_packets(dhcprequest, lease_time, target_addr) -> None:
+    requestor = Mock()
+    req = dhcprequest(
+        cls=DhcpAddressInitialRequest,
+        requestor=requestor,
+        lease_time=lease_time,
+        target_addr=target_addr,
+    )
+    discover = _generic_request(
+        req.xid, 1, lease_time=lease_time, target_addr=target_addr
+    )
+    requestor.send_packet.assert_called_once_with(discover, "123.123.123.123", 67)
+
+    offer = DhcpPacket(source_address=("123.123.123.123", 67))
+    offer.set_option("yiaddr", bytes([1, 2, 3, 4]))
+    offer.set_option("server_identifier", bytes([123, 123, 123, 123]))
+    requestor.reset_mock()
+    req.handle_dhcp_offer(offer)
+    request = _generic_request(
+        req.xid,
+        3,
+        lease_time=lease_time,
+        target_addr=target_addr,
+        request_ip_address=bytes([1, 2, 3, 4]),
+        server_identifier=bytes([123, 123, 123, 123]),
+    )
+    requestor.send_packet.assert_called_once_with(request, "123.123.123.123", 67)
+
+    # Retransmits reuse the encoded packet.
+    requestor.reset_mock()
+    req.handle_timeout()
+    requestor.send_packet.assert_called_once_with(request, "123.123.123.123", 67)
+
+    # Without server identifier in the offer, the request has none either.
+    req = dhcprequest(
+        cls=DhcpAddressInitialRequest,
+        requestor=requestor,
+        lease_time=lease_time,
+        target_addr=target_addr,
+    )
+    offer = DhcpPacket(source_address=("123.123.123.123", 67))
+    offer.set_option("yiaddr", bytes([1, 2, 3, 4]))
+    requestor.reset_mock()
+    req.handle_dhcp_offer(offer)
+    request = _generic_request(
+        req.xid,
+        3,
+        lease_time=lease_time,
+        target_addr=target_addr,
+        request_ip_address=bytes([1, 2, 3, 4]),
+    )
+    requestor.send_packet.assert_called_once_with(request, "123.123.123.123", 67)
+
+    refresh_requestor = Mock()
+    refresh = dhcprequest(
+        cls=DhcpAddressRefreshRequest,
+        requestor=refresh_requestor,
+        client_ip="1.2.3.4",
+        lease_time=lease_time,
+        target_addr=target_addr,
+    )
+    expected = _generic_request(
+        refresh.xid,
+        3,
+        lease_time=lease_time,
+        target_addr=target_addr,
+        request_ip_address=bytes([1, 2, 3, 4]),
+    )
+    refresh_requestor.send_packet.assert_called_once_with(
+        expected, "123.123.123.123", 67
+    )
+
+
+def test_requestor_handles_batch() -> None:
+    requestor = DhcpAddressRequestor(listen_address="127.0.0.1", listen_port=0)
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    requests = {}
+    for xid in (1, 2, 3):
+        requests[xid] = Mock(xid=xid)
+        if xid != 3:
+            requestor.add_request(requests[xid])
+        packet = DhcpPacket()
+        packet.set_option("xid", xid.to_bytes(4, "big"))
+        packet.set_option("dhcp_message_type", bytes([5]))
+        sender.sendto(packet.encode(), requestor.socket.getsockname())
+    sender.sendto(b"garbage", requestor.socket.getsockname())
+
+    label = {"requestor": "127.0.0.1@None"}
+    unknown_before = REGISTRY.get_sample_value("dhcp_unknown_xid_count_total", label)
+    requestor.handle_socket()
+    assert (
+        REGISTRY.get_sample_value("dhcp_unknown_xid_count_total", label)
+        == (unknown_before or 0) + 1
+    )
+    assert REGISTRY.get_sample_value("dhcp_requests_in_flight", label) == 2
+    for xid in (1, 2):
+        requests[xid].handle_dhcp_ack.assert_called_once()
+        packet = requests[xid].handle_dhcp_ack.call_args[0][0]
+        assert packet.source_address[1] == sender.getsockname()[1]
+    requests[3].handle_dhcp_ack.assert_not_called()
+    sender.close()
+    requestor.socket.close()
+
+
+def test_requestor_send_queue() -> None:
+    requestor = DhcpAddressRequestor(listen_address="127.0.0.1", listen_port=0)
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.bind(("127.0.0.1", 0))
+    receiver.settimeout(1)
+    port = receiver.getsockname()[1]
+
+    requestor.send_packet(b"first", "127.0.0.1", port)
+    requestor.send_packet(b"second", "127.0.0.1", port)
+    receiver.setblocking(False)
+    with pytest.raises(BlockingIOError):
+        receiver.recv(16)
+    receiver.setblocking(True)
+
+    requestor.flush_send_queue()
+    assert receiver.recv(16) == b"first"
+    assert receiver.recv(16) == b"second"
+    receiver.close()
+    requestor.socket.close()
+
+
+def test_requestor_paces_per_server(timeout_mgr, mocker) -> None:
+    monotonic = mocker.patch("odr.dhcprequestor.time.monotonic", return_value=100.0)
+    requestor = DhcpAddressRequestor(
+        listen_address="127.0.0.1",
+        listen_port=0,
+        timeout_mgr=timeout_mgr,
+        server_rate=2,
+    )
+    sent = []
+
+    def send_batch(sock, datagrams):
+        sent.append(list(datagrams))
+        return len(datagrams)
+
+    mocker.patch("odr.dhcprequestor.send_batch", side_effect=send_batch)
+
+    for i in range(3):
+        requestor.send_packet(bytes([i]), "192.0.2.1", 67)
+    requestor.send_packet(b"other", "192.0.2.2", 67)
+    requestor.flush_send_queue()
+    assert sent == [
+        [
+            (b"\x00", ("192.0.2.1", 67)),
+            (b"\x01", ("192.0.2.1", 67)),
+            (b"other", ("192.0.2.2", 67)),
+        ]
+    ]
+    assert timeout_mgr.next_timeout_time() is not None
+
+    sent.clear()
+    monotonic.return_value = 100.5
+    requestor._handle_flush_timeout()
+    assert sent == [[(b"\x02", ("192.0.2.1", 67))]]
+    requestor.socket.close()
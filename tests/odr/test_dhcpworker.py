@@ -0,0 +1,168 @@
+import logging
+from ipaddress import IPv4Address
+from unittest.mock import Mock
+
+import pytest
+
+from odr.dhcpworker import (
+    DhcpWorkerClient,
+    DhcpWorkerFailed,
+    DhcpWorkerPool,
+    DhcpWorkerServer,
+    assign_shards,
+    create_worker_socketpair,
+)
+
+
+@pytest.fixture()
+def worker(timeout_mgr):
+    main_sock, worker_sock = create_worker_socketpair()
+    start_initial = Mock(return_value=True)
+    client = DhcpWorkerClient(Mock(), main_sock, 1234, timeout_mgr=timeout_mgr)
+    server = DhcpWorkerServer(
+        Mock(),
+        worker_sock,
+        start_request_clbs={"initial": start_initial},
+        timeout_mgr=timeout_mgr,
+    )
+    pool = DhcpWorkerPool()
+    pool.add_worker(client, [("eth0", "192.0.2.1")])
+    yield pool, client, server, start_initial
+    main_sock.close()
+    worker_sock.close()
+
+
+def test_assign_shards():
+    keys = [("eth0", "192.0.2.1"), ("eth1", "192.0.2.2"), ("eth0", "192.0.2.3")]
+    shards = assign_shards(keys + keys[:1], 2)
+    assert shards == [
+        [("eth0", "192.0.2.1"), ("eth1", "192.0.2.2")],
+        [("eth0", "192.0.2.3")],
+    ]
+    assert assign_shards(list(reversed(keys)), 2) == shards
+
+
+def test_request_roundtrip(worker):
+    pool, client, server, start_initial = worker
+    success, failure = Mock(), Mock()
+
+    assert pool.start_request(
+        "initial",
+        device="eth0",
+        local_ip="192.0.2.1",
+        success_handler_clb=success,
+        failure_handler_clb=failure,
+        target_addr=IPv4Address("10.0.0.0"),
+    )
+    assert not pool.start_request("initial", device="eth0", local_ip="192.0.2.9")
+    client.flush_send_queue()
+    server.handle_socket()
+
+    kwargs = start_initial.call_args[1]
+    assert kwargs["device"] == "eth0"
+    assert kwargs["local_ip"] == "192.0.2.1"
+    assert kwargs["target_addr"] == "10.0.0.0"
+
+    kwargs["success_handler_clb"]({"ip_address": "10.0.0.5"})
+    server.flush_send_queue()
+    client.handle_socket()
+    success.assert_called_once_with({"ip_address": "10.0.0.5"})
+    failure.assert_not_called()
+
+
+def test_request_not_started(worker):
+    pool, client, server, start_initial = worker
+    start_initial.return_value = False
+    failure = Mock()
+    pool.start_request(
+        "initial",
+        device="eth0",
+        local_ip="192.0.2.1",
+        success_handler_clb=Mock(),
+        failure_handler_clb=failure,
+    )
+    client.flush_send_queue()
+    server.handle_socket()
+    server.flush_send_queue()
+    client.handle_socket()
+    failure.assert_called_once_with()
+
+
+def test_worker_gone(worker):
+    pool, client, server, _ = worker
+    failure = Mock()
+    pool.start_request(
+        "initial",
+        device="eth0",
+        local_ip="192.0.2.1",
+        success_handler_clb=Mock(),
+        failure_handler_clb=failure,
+    )
+    client.flush_send_queue()
+    client._worker_gone_clb = Mock()
+    assert pool.alive
+    server.socket.close()
+
+    client.handle_socket()
+    failure.assert_called_once_with()
+    client._worker_gone_clb.assert_called_once_with(client)
+    assert not client.alive
+    assert not pool.alive
+    with pytest.raises(DhcpWorkerFailed):
+        pool.start_request(
+            "initial",
+            device="eth0",
+            local_ip="192.0.2.1",
+            success_handler_clb=Mock(),
+            failure_handler_clb=Mock(),
+        )
+
+
+def test_results_queued(worker):
+    pool, client, server, start_initial = worker
+    success = Mock()
+    pool.start_request(
+        "initial",
+        device="eth0",
+        local_ip="192.0.2.1",
+        success_handler_clb=success,
+        failure_handler_clb=Mock(),
+    )
+    client.flush_send_queue()
+    server.handle_socket()
+    success_handler = start_initial.call_args[1]["success_handler_clb"]
+
+    # The main process is not reading, so the worker's results pile up in the
+    # queue instead of blocking the worker.
+    count = 0
+    while not server._retry_scheduled:
+        success_handler({"ip_address": "10.0.0.5"})
+        server.flush_send_queue()
+        count += 1
+    assert server._send_queue
+
+    while server._send_queue:
+        client.handle_socket()
+        server.flush_send_queue()
+    client.handle_socket()
+    success.assert_called_once_with({"ip_address": "10.0.0.5"})
+    assert count > 1
+
+
+def test_worker_gone_reaped(worker, monkeypatch, caplog):
+    _, client, server, _ = worker
+    waitpid = Mock(side_effect=[(0, 0), (1234, 256)])
+    monkeypatch.setattr("odr.dhcpworker.os.waitpid", waitpid)
+    client._timeout_mgr = Mock()
+    server.socket.close()
+
+    with caplog.at_level(logging.CRITICAL):
+        client.handle_socket()
+        assert not caplog.records
+        # Still exiting, so reaping is retried later.
+        client._timeout_mgr.add_rel_timeout.assert_called_once_with(
+            1, client._reap
+        )
+        client._reap()
+    assert waitpid.call_count == 2
+    assert "DHCP worker 1234 exited" in caplog.records[0].getMessage()
@@ -0,0 +1,51 @@
+import threading
+
+import pytest
+
+from odr.filewriter import FileWriterPool
+from odr.socketloop import SocketLoop
+
+
+@pytest.fixture(params=[0, 2])
+def pool(request):
+    sloop = SocketLoop()
+    pool = FileWriterPool(sloop, num_threads=request.param)
+    pool.sloop = sloop
+    yield pool
+    pool.shutdown()
+
+
+def _write(pool, writes):
+    results = []
+
+    def done(exc):
+        results.append((exc, threading.current_thread()))
+        pool.sloop.quit()
+
+    pool.write(writes, done)
+    if not results:
+        pool.sloop.run()
+    assert len(results) == 1
+    assert results[0][1] is threading.main_thread()
+    return results[0][0]
+
+
+def test_write_in_order(pool, tmp_path):
+    config_f = open(str(tmp_path / "config"), "w")
+    ret_f = open(str(tmp_path / "ret"), "w")
+    ret_f.write("2")
+
+    exc = _write(pool, [(config_f, "push foo\n", "config"), (ret_f, "1", "ret")])
+    assert exc is None
+    assert (tmp_path / "config").read_text() == "push foo\n"
+    assert (tmp_path / "ret").read_text() == "1"
+
+
+def test_failure_stops_later_writes(pool, tmp_path):
+    config_f = open(str(tmp_path / "config"), "w")
+    config_f.close()
+    ret_f = open(str(tmp_path / "ret"), "w")
+
+    exc = _write(pool, [(config_f, "push foo\n", "config"), (ret_f, "1", "ret")])
+    assert isinstance(exc, ValueError)
+    assert (tmp_path / "ret").read_text() == ""
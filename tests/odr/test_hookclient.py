@@ -0,0 +1,116 @@
+import json
+import os
+import socket
+import subprocess
+import sys
+
+import pytest
+
+import odr.hookclient
+from odr.fdsend import recv_fds
+from odr.hookclient import (
+    CC_RET_DEFERRED,
+    connect_main,
+    disconnect_main,
+    encode_command,
+    response_status,
+)
+
+
+@pytest.mark.parametrize(
+    "params",
+    [
+        {},
+        {"full_username": "user@realm", "daemon_name": "vpn1"},
+        {"full_username": 'quote"back\\slash\ttab\n\x01\x7fümlaut\U0001f600'},
+        # Undecodable bytes in the environment end up as lone surrogates.
+        {"full_username": "user\udcff@realm"},
+    ],
+)
+def test_encode_command_roundtrip(params):
+    expected = {"cmd": "request"}
+    expected.update(params)
+    assert json.loads(encode_command("request", params)) == expected
+
+
+def test_response_status():
+    assert response_status(json.dumps({"cmd": "OK"}).encode()) == "OK"
+    assert response_status(json.dumps({"cmd": "FAIL"}).encode()) == "FAIL"
+    assert response_status(b'{"cmd":"OK"}') == "OK"
+
+
+def test_runs_without_site_and_odr_imports():
+    code = (
+        "import sys; sys.argv = ['x', 'unknown']; import hookclient; "
+        "assert hookclient.main() == 2; "
+        "assert not [m for m in sys.modules if m.startswith('odr')]"
+    )
+    subprocess.run(
+        [sys.executable, "-S", "-c", code],
+        cwd=os.path.dirname(odr.hookclient.__file__),
+        check=True,
+        stderr=subprocess.DEVNULL,
+    )
+
+
+@pytest.fixture()
+def cmd_socket(tmp_path):
+    path = str(tmp_path / "cmd.sock")
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(1)
+    yield path, listener
+    listener.close()
+
+
+def _serve_one(listener, response):
+    pid = os.fork()
+    if pid == 0:
+        conn, _ = listener.accept()
+        msg, fds, _, _ = recv_fds(conn, 1024, maxfds=2)
+        with open(os.environ["result_file"], "w") as f:
+            json.dump({"msg": msg.decode(), "num_fds": len(fds)}, f)
+        conn.send(json.dumps({"cmd": response}).encode())
+        os._exit(0)
+    return pid
+
+
+def test_connect(cmd_socket, tmp_path, monkeypatch):
+    path, listener = cmd_socket
+    monkeypatch.setenv("client_connect_config_file", str(tmp_path / "config"))
+    monkeypatch.setenv("client_connect_deferred_file", str(tmp_path / "deferred"))
+    monkeypatch.setenv("result_file", str(tmp_path / "result"))
+    monkeypatch.setenv("username", "user@realm")
+    monkeypatch.setenv("daemon_name", "vpn1")
+
+    pid = _serve_one(listener, "OK")
+    connect_main(socket_path=path)
+    os.waitpid(pid, 0)
+
+    result = json.loads((tmp_path / "result").read_text())
+    assert json.loads(result["msg"]) == {
+        "cmd": "request",
+        "full_username": "user@realm",
+        "ret_file_idx": "0",
+        "config_file_idx": "1",
+        "daemon_name": "vpn1",
+    }
+    assert result["num_fds"] == 2
+    assert (tmp_path / "deferred").read_text() == str(CC_RET_DEFERRED)
+
+
+def test_disconnect_failed(cmd_socket, tmp_path, monkeypatch):
+    path, listener = cmd_socket
+    monkeypatch.setenv("result_file", str(tmp_path / "result"))
+    monkeypatch.setenv("username", "user@realm")
+    monkeypatch.delenv("daemon_name", raising=False)
+
+    pid = _serve_one(listener, "FAIL")
+    with pytest.raises(RuntimeError):
+        disconnect_main(socket_path=path)
+    os.waitpid(pid, 0)
+    result = json.loads((tmp_path / "result").read_text())
+    assert json.loads(result["msg"]) == {
+        "cmd": "disconnect",
+        "full_username": "user@realm",
+    }
@@ -0,0 +1,100 @@
+import time
+from unittest.mock import Mock
+
+from odr.filewriter import write_and_sync
+from odr.leasedb import Lease, LeaseDb
+
+
+def _lease(ip, delta=3600):
+    now = time.time()
+    return Lease(ip, now + delta / 2, now + delta * 7 / 8, now + delta)
+
+
+def test_store_and_reload(tmp_path):
+    path = str(tmp_path / "leases.db")
+    db = LeaseDb(path)
+    assert db.get("user@realm", "vpn1") is None
+
+    db.store("user@realm", "vpn1", _lease("10.0.0.1"))
+    db.store("other@realm", "vpn1", _lease("10.0.0.2"))
+    updated = _lease("10.0.0.3")
+    db.store("user@realm", "vpn1", updated)
+    db.store("gone@realm", "vpn2", _lease("10.0.0.4"))
+    db.remove("gone@realm", "vpn2")
+    db.store("expired@realm", "vpn1", _lease("10.0.0.5", delta=-1))
+    db.close()
+
+    db = LeaseDb(path)
+    assert db.get("user@realm", "vpn1") == updated
+    assert db.get("user@realm", "vpn2") is None
+    assert db.get("other@realm", "vpn1").ip_address == "10.0.0.2"
+    assert db.get("gone@realm", "vpn2") is None
+    assert db.get("expired@realm", "vpn1") is None
+    assert len(db) == 2
+    db.close()
+
+    # Reloading compacts the log.
+    with open(path) as f:
+        assert len(f.readlines()) == 2
+
+
+def test_get_ignores_expired(tmp_path, monkeypatch):
+    db = LeaseDb(str(tmp_path / "leases.db"))
+    lease = _lease("10.0.0.1", delta=10)
+    db.store("user@realm", "vpn1", lease)
+    assert db.get("user@realm", "vpn1") == lease
+    monkeypatch.setattr(time, "time", lambda: lease.lease_timeout)
+    assert db.get("user@realm", "vpn1") is None
+    db.close()
+
+
+def test_ignores_truncated_line(tmp_path):
+    path = str(tmp_path / "leases.db")
+    db = LeaseDb(path)
+    db.store("user@realm", "vpn1", _lease("10.0.0.1"))
+    db.close()
+    with open(path, "a") as f:
+        f.write('{"user": "other@realm", "ser')
+
+    db = LeaseDb(path)
+    assert len(db) == 1
+    db.close()
+
+
+def test_compaction(tmp_path, monkeypatch):
+    monkeypatch.setattr(LeaseDb, "COMPACT_MIN_LINES", 8)
+    path = str(tmp_path / "leases.db")
+    db = LeaseDb(path)
+    for i in range(20):
+        db.store("user@realm", "vpn1", _lease("10.0.0.{}".format(i)))
+    with open(path) as f:
+        assert len(f.readlines()) < 8
+    db.close()
+    assert LeaseDb(path).get("user@realm", "vpn1").ip_address == "10.0.0.19"
+
+
+def test_compaction_with_file_writer(tmp_path, monkeypatch):
+    monkeypatch.setattr(LeaseDb, "COMPACT_MIN_LINES", 8)
+    path = str(tmp_path / "leases.db")
+    file_writer = Mock()
+    db = LeaseDb(path, file_writer=file_writer)
+    for i in range(8):
+        db.store("user@realm", "vpn1", _lease("10.0.0.{}".format(i)))
+    file_writer.write.assert_called_once()
+    writes, done_clb = file_writer.write.call_args[0]
+
+    # Changes made while the compacted log is written end up in the new log.
+    db.store("other@realm", "vpn1", _lease("10.0.1.1"))
+    db.remove("user@realm", "vpn1")
+    assert file_writer.write.call_count == 1
+    for fp, data, _ in writes:
+        write_and_sync(fp, data)
+    done_clb(None)
+    with open(path) as f:
+        assert len(f.readlines()) == 3
+    db.close()
+
+    db = LeaseDb(path)
+    assert db.get("user@realm", "vpn1") is None
+    assert db.get("other@realm", "vpn1").ip_address == "10.0.1.1"
+    db.close()
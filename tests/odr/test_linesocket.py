@@ -0,0 +1,51 @@
+import socket
+
+import pytest
+
+from odr.linesocket import LineSocket
+
+
+@pytest.fixture
+def linesock():
+    ours, theirs = socket.socketpair()
+    linesock = LineSocket(ours)
+    yield linesock, theirs
+    theirs.close()
+
+
+def test_recvlines(linesock):
+    linesock, peer = linesock
+    peer.sendall(b'first\r\nsecond\nthi')
+    assert linesock.recvlines() == [b'first\n', b'second\n']
+    peer.sendall(b'rd\r\n')
+    assert linesock.recvlines() == [b'third\n']
+
+
+def test_recvlines_crlf_split(linesock):
+    linesock, peer = linesock
+    peer.sendall(b'line\r')
+    assert linesock.recvlines() == []
+    peer.sendall(b'\nnext\r\n')
+    assert linesock.recvlines() == [b'line\n', b'next\n']
+
+
+def test_recvlines_long_line(linesock):
+    linesock, peer = linesock
+    chunk = b'x' * LineSocket.RECV_SIZE
+    for _ in range(3):
+        peer.sendall(chunk)
+        assert linesock.recvlines() == []
+    peer.sendall(b'\r\nend\n')
+    lines = []
+    while len(lines) < 2:
+        lines += linesock.recvlines()
+    assert lines == [3 * chunk + b'\n', b'end\n']
+
+
+def test_recvlines_eof(linesock):
+    linesock, peer = linesock
+    peer.sendall(b'complete\npartial')
+    peer.shutdown(socket.SHUT_WR)
+    assert linesock.recvlines() == [b'complete\n']
+    assert linesock.recvlines() == [b'partial']
+    assert linesock.recvlines() is None
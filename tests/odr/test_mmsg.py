@@ -0,0 +1,48 @@
+import socket
+
+import pytest
+
+from odr.mmsg import BatchReceiver, send_batch
+
+
+@pytest.fixture()
+def udp_pair():
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.bind(("127.0.0.1", 0))
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sender.bind(("127.0.0.1", 0))
+    yield sender, receiver
+    sender.close()
+    receiver.close()
+
+
+@pytest.mark.parametrize("use_mmsg", [True, False])
+def test_batch_receive(udp_pair, use_mmsg):
+    sender, receiver = udp_pair
+    batch = BatchReceiver(batch_size=4, buffer_size=16, use_mmsg=use_mmsg)
+    assert batch.recv(receiver) == []
+
+    for i in range(6):
+        sender.sendto(bytes([i]) * (i + 1), receiver.getsockname())
+
+    received = batch.recv(receiver)
+    assert [bytes(data) for data, _ in received] == [
+        bytes([i]) * (i + 1) for i in range(4)
+    ]
+    assert all(addr == sender.getsockname() for _, addr in received)
+
+    received = batch.recv(receiver)
+    assert [bytes(data) for data, _ in received] == [b"\x04" * 5, b"\x05" * 6]
+    assert batch.recv(receiver) == []
+
+
+@pytest.mark.parametrize("use_mmsg", [True, False])
+def test_send_batch(udp_pair, use_mmsg):
+    sender, receiver = udp_pair
+    dest = receiver.getsockname()
+    assert send_batch(sender, [], use_mmsg=use_mmsg) == 0
+
+    datagrams = [(bytes([i]) * (i + 1), dest) for i in range(3)]
+    assert send_batch(sender, datagrams, use_mmsg=use_mmsg) == 3
+    for data, _ in datagrams:
+        assert receiver.recvfrom(16) == (data, sender.getsockname())
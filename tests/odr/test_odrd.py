@@ -0,0 +1,278 @@
+import gc
+import socket
+import time
+from unittest.mock import Mock
+
+import pytest
+
+import odr.filewriter
+from odr.filewriter import FileWriterPool
+from odr.leasedb import Lease, LeaseDb
+from odr.ovpn import OvpnClientEvent
+from odr.refreshscheduler import RefreshScheduler
+from odr.socketloop import SocketLoop
+
+pytest.importorskip("prctl")
+
+from odr.hookclient import CC_RET_DEFERRED, CC_RET_FAILED  # noqa: E402
+import odr.odrd  # noqa: E402
+from odr.odrd import (  # noqa: E402
+    OvpnClient,
+    OvpnClientAuthHandler,
+    OvpnClientManager,
+    OvpnCmdConn,
+)
+
+
+def test_ret_file_outlives_deleted_connection(tmp_path, monkeypatch):
+    write_and_sync = odr.filewriter.write_and_sync
+
+    def slow_write_and_sync(fp, data):
+        time.sleep(0.1)
+        write_and_sync(fp, data)
+
+    monkeypatch.setattr(odr.filewriter, "write_and_sync", slow_write_and_sync)
+    sloop = SocketLoop()
+    pool = FileWriterPool(sloop, num_threads=1)
+    ours, theirs = socket.socketpair()
+    conn = OvpnCmdConn(
+        Mock(),
+        ours,
+        realms_data={},
+        servers={},
+        secret=None,
+        admission_ctrl=None,
+        parse_username_clb=None,
+        create_client_clb=None,
+        remove_client_clb=None,
+        file_writer=pool,
+    )
+    ret_path = tmp_path / "ret"
+    ret_path.write_text(str(CC_RET_DEFERRED))
+    ret_f = open(str(ret_path), "r+")
+    conn._ret_f = ret_f
+
+    conn._failure_handler()
+    del conn
+    gc.collect()
+    assert not ret_f.closed
+
+    pool.shutdown()
+    sloop.call_from_thread(sloop.quit)
+    sloop.run()
+    assert ret_path.read_text() == str(CC_RET_FAILED)
+    assert ret_f.closed
+    theirs.close()
+
+
+@pytest.fixture()
+def auth_handler(monkeypatch):
+    monkeypatch.setattr(odr.odrd, "build_client_config", Mock())
+    admission_ctrl = Mock()
+    create_client = Mock(return_value=Mock(cid=None))
+    handler = OvpnClientAuthHandler(
+        realms_data={"realm": Mock(subnet_ipv4=None)},
+        secret=None,
+        admission_ctrl=admission_ctrl,
+        parse_username_clb=lambda username: {"realm": "realm"},
+        create_client_clb=create_client,
+    )
+    return handler, admission_ctrl, create_client
+
+
+def _client_event(event_type, cid):
+    event = OvpnClientEvent(event_type, cid, 1)
+    event.env["username"] = "user@realm"
+    return event
+
+
+_RES = {"ip_address": "10.0.0.5", "rebinding_timeout": 10, "lease_timeout": 20}
+
+
+def test_auth_success_sets_cid(auth_handler):
+    handler, admission_ctrl, create_client = auth_handler
+    server = Mock(mgmt_connections=1)
+    handler.handle_client_event(server, _client_event("CONNECT", 7))
+
+    admission_ctrl.submit.call_args[1]["success_handler_clb"](_RES)
+    server.client_auth.assert_called_once()
+    create_client.assert_called_once()
+    assert create_client.return_value.cid == 7
+
+
+def test_auth_client_gone(auth_handler):
+    handler, admission_ctrl, create_client = auth_handler
+    server = Mock(mgmt_connections=1)
+    handler.handle_client_event(server, _client_event("CONNECT", 7))
+    handler.handle_client_event(server, _client_event("CONNECT", 8))
+    handler.handle_client_event(server, _client_event("CONNECT", 9))
+    handlers = [c[1] for c in admission_ctrl.submit.call_args_list]
+
+    # Client 7 disconnected before its DHCP request completed.
+    handler.handle_client_event(server, _client_event("DISCONNECT", 7))
+    handlers[0]["success_handler_clb"](_RES)
+    # The management connection was re-established.
+    server.mgmt_connections = 2
+    handlers[1]["success_handler_clb"](_RES)
+    handlers[2]["failure_handler_clb"]()
+
+    server.client_auth.assert_not_called()
+    server.client_deny.assert_not_called()
+    create_client.assert_not_called()
+    assert handler._pending == {}
+
+
+def test_client_releases_refresh_slot(timeout_mgr, mocker):
+    mocker.patch("odr.refreshscheduler.time.time", return_value=1000.0)
+    mocker.patch("odr.odrd.time.time", return_value=1000.0)
+    scheduler = RefreshScheduler(timeout_mgr, refresh_lease_clb=Mock(), max_rate=1)
+    realm_data = Mock(dhcp_server_ips=["192.0.2.1"])
+    realm_data.name = "realm"
+    clients = [
+        OvpnClient(
+            timeout_mgr,
+            scheduler,
+            "user{}@realm".format(i),
+            Mock(),
+            realm_data,
+            leased_ip_address="10.0.0.5",
+            rebinding_timeout=2000,
+            lease_timeout=3000,
+        )
+        for i in range(3)
+    ]
+    for client in clients[:2]:
+        client.track_lease()
+    assert [c._timeout_obj.timeout_time for c in clients[:2]] == [2000, 1999.0]
+
+    # The killed client's slot is given to the next client.
+    clients[0].kill()
+    clients[2].track_lease()
+    assert clients[2]._timeout_obj.timeout_time == 2000
+
+
+@pytest.fixture()
+def lease_client(timeout_mgr, mocker):
+    now = mocker.patch("odr.odrd.time.time", return_value=1000.0)
+    mocker.patch("odr.odrd.random.uniform", return_value=0.9)
+    refresh = Mock()
+    scheduler = RefreshScheduler(timeout_mgr, refresh_lease_clb=refresh)
+    realm_data = Mock(dhcp_server_ips=["192.0.2.1", "192.0.2.2"], subnet_ipv4=None)
+    client = OvpnClient(
+        timeout_mgr,
+        scheduler,
+        "user@realm",
+        Mock(),
+        realm_data,
+        leased_ip_address="10.0.0.5",
+        renewal_timeout=1500,
+        rebinding_timeout=1875,
+        lease_timeout=2000,
+        server_ip="192.0.2.9",
+    )
+    client.track_lease()
+    return client, now, refresh
+
+
+def _next_refresh(client, now, when):
+    assert client._timeout_obj.timeout_time == when
+    now.return_value = when
+    client.handle_timeout()
+
+
+def test_refresh_renewing_then_rebinding(lease_client):
+    client, now, refresh = lease_client
+    _next_refresh(client, now, 1500)
+    assert refresh.call_args[1]["server_ips"] == ["192.0.2.9"]
+
+    # Half of the time until T2 is left.
+    refresh.call_args[1]["failure_handler_clb"]()
+    _next_refresh(client, now, 1500 + 375 / 2 * 0.9)
+    assert refresh.call_args[1]["server_ips"] == ["192.0.2.9"]
+
+    # The retry is capped at T2, after which all servers are asked.
+    now.return_value = 1850
+    refresh.call_args[1]["failure_handler_clb"]()
+    _next_refresh(client, now, 1875)
+    assert refresh.call_args[1]["server_ips"] == ["192.0.2.1", "192.0.2.2"]
+    client.server.disconnect_client.assert_not_called()
+
+
+def test_refresh_retry_interval(lease_client):
+    client, now, refresh = lease_client
+    now.return_value = 1880
+    client.handle_timeout()
+    assert refresh.call_args[1]["server_ips"] == ["192.0.2.1", "192.0.2.2"]
+
+    # At least REFRESH_RETRY_MIN_INTERVAL apart.
+    now.return_value = 1900
+    refresh.call_args[1]["failure_handler_clb"]()
+    _next_refresh(client, now, 1960)
+    # Capped at the lease's expiry.
+    now.return_value = 1990
+    refresh.call_args[1]["failure_handler_clb"]()
+    assert client._timeout_obj.timeout_time == 2000
+    client.server.disconnect_client.assert_not_called()
+
+    # Only disconnected once the lease has expired.
+    now.return_value = 2000
+    client.handle_timeout()
+    client.server.disconnect_client.assert_called_once_with("user@realm")
+
+
+def test_refresh_success_tracks_new_lease(lease_client):
+    client, now, refresh = lease_client
+    _next_refresh(client, now, 1500)
+    refresh.call_args[1]["success_handler_clb"](
+        {
+            "ip_address": "10.0.0.5",
+            "renewal_timeout": 2000,
+            "rebinding_timeout": 2375,
+            "lease_timeout": 2500,
+            "server_ip": "192.0.2.9",
+        }
+    )
+    assert client._timeout_obj.timeout_time == 2000
+
+
+@pytest.mark.parametrize(
+    "lease, expected",
+    [
+        # Renewal time passed, renewals are spread until the rebinding time.
+        (
+            Lease("10.0.0.5", 900, 1500, 2000, "192.0.2.9"),
+            (1000, 1500, 2000, "192.0.2.9"),
+        ),
+        # Rebinding time passed, rebind right away.
+        (Lease("10.0.0.5", 800, 950, 2000, "192.0.2.9"), (None, 1000, 2000, None)),
+        # Expired leases are ignored.
+        (Lease("10.0.0.5", 800, 950, 990, "192.0.2.9"), (None, 1000, None, None)),
+        # Lease of a different address.
+        (Lease("10.0.0.6", 1200, 1500, 2000, "192.0.2.9"), (None, 1000, None, None)),
+    ],
+)
+def test_resume_detected_client(tmp_path, timeout_mgr, mocker, lease, expected):
+    mocker.patch("odr.odrd.time.time", return_value=1000.0)
+    mocker.patch("odr.odrd.random.uniform", side_effect=lambda a, b: a)
+    server = Mock()
+    server.name = "vpn1"
+    lease_db = LeaseDb(str(tmp_path / "leases.db"))
+    lease_db.store("user@realm", "vpn1", lease)
+    manager = OvpnClientManager(
+        timeout_mgr,
+        realms_data={"realm": Mock(dhcp_server_ips=["192.0.2.1"])},
+        parse_username_clb=lambda username: {"realm": "realm"},
+        servers={"vpn1": server},
+        refresh_scheduler=RefreshScheduler(timeout_mgr, refresh_lease_clb=Mock()),
+        lease_db=lease_db,
+    )
+
+    manager._create_detected_client("user@realm", server, "10.0.0.5")
+    client = manager._clients_by_username["user@realm"]
+    assert (
+        client._renewal_timeout,
+        client._rebinding_timeout,
+        client._lease_timeout,
+        client._server_ip,
+    ) == expected
+    lease_db.close()
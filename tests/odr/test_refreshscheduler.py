@@ -0,0 +1,100 @@
+from unittest.mock import Mock
+
+import pytest
+
+from prometheus_client import REGISTRY
+
+from odr.refreshscheduler import RefreshScheduler
+
+KEY = ("realm", ("192.0.2.1",))
+
+
+@pytest.fixture()
+def scheduler(timeout_mgr, mocker):
+    mocker.patch("odr.refreshscheduler.time.time", return_value=1000.0)
+    return RefreshScheduler(timeout_mgr, refresh_lease_clb=Mock(), max_rate=2)
+
+
+def test_unlimited(timeout_mgr):
+    refresh = Mock()
+    scheduler = RefreshScheduler(timeout_mgr, refresh_lease_clb=refresh)
+    for _ in range(10):
+        assert scheduler.reserve_slot(KEY, 2000.5, 1500) == 2000.5
+        scheduler.start_refresh(KEY, client_identifier="user")
+    assert refresh.call_count == 10
+
+
+def test_reserve_moves_earlier(scheduler):
+    times = [scheduler.reserve_slot(KEY, 2000.5, 1998) for _ in range(7)]
+    assert times == [2000.5, 2000.5, 1999, 1999, 1998, 1998, 2001]
+    # Other keys are independent.
+    assert scheduler.reserve_slot(("realm", ("192.0.2.2",)), 2000.5, 1998) == 2000.5
+
+
+def test_reserve_capped_at_lease_expiry(scheduler):
+    times = [scheduler.reserve_slot(KEY, 2000.5, 2000, 2002.5) for _ in range(5)]
+    assert times == [2000.5, 2000.5, 2001, 2001, 2000.5]
+    # The overbooked refreshes only get their slot back once all of them are
+    # released.
+    scheduler.release_slot(KEY, times[-1])
+    assert scheduler.reserve_slot(KEY, 2000.5, 2000, 2002.5) == 2000.5
+    scheduler.release_slot(KEY, times[0])
+    scheduler.release_slot(KEY, times[1])
+    assert scheduler.reserve_slot(KEY, 2000.5, 2000, 2002.5) == 2000.5
+
+
+def test_reserve_long_runs(scheduler):
+    # Slots are found without walking through the full ones.
+    for _ in range(2 * 1800):
+        scheduler.reserve_slot(KEY, 3800.5, 2001)
+    assert scheduler.reserve_slot(KEY, 3800.5, 2001) == 3801
+    assert scheduler.reserve_slot(KEY, 2500.5, 2001) == 3801
+    assert scheduler.reserve_slot(KEY, 1900.5, 1800) == 1900.5
+    scheduler.release_slot(KEY, 2500)
+    assert scheduler._full_slots[KEY]._starts == [2001, 2501]
+    assert scheduler.reserve_slot(KEY, 3000.5, 2001) == 2500
+    assert scheduler._full_slots[KEY]._starts == [2001]
+    assert scheduler._full_slots[KEY]._ends == [3801]
+
+
+def test_release_slot(scheduler):
+    times = [scheduler.reserve_slot(KEY, 2000.5, 1998) for _ in range(3)]
+    assert times == [2000.5, 2000.5, 1999]
+    scheduler.release_slot(KEY, times[0])
+    assert scheduler.reserve_slot(KEY, 2000.5, 1998) == 2000.5
+    scheduler.release_slot(KEY, times[2])
+    scheduler.release_slot(KEY, times[2])
+    assert scheduler.reserve_slot(KEY, 1999.5, 1998) == 1999.5
+    assert scheduler._reservations[KEY] == {2000: 2, 1999: 1}
+
+
+def test_fractional_rate(timeout_mgr, mocker):
+    mocker.patch("odr.refreshscheduler.time.time", return_value=1000.0)
+    refresh = Mock()
+    scheduler = RefreshScheduler(timeout_mgr, refresh_lease_clb=refresh, max_rate=0.5)
+    for i in range(3):
+        scheduler.start_refresh(KEY, client_identifier=str(i))
+    assert refresh.call_count == 1
+    assert timeout_mgr.next_timeout_time() == 1002.0
+
+
+def test_start_refresh_queues(scheduler, timeout_mgr, mocker):
+    refresh = scheduler._refresh_lease
+    labels = {"realm": "realm", "servers": "192.0.2.1"}
+    before = REGISTRY.get_sample_value("dhcp_refresh_queue_length", labels) or 0
+    for i in range(5):
+        scheduler.start_refresh(KEY, client_identifier=str(i))
+    assert [c[1]["client_identifier"] for c in refresh.call_args_list] == ["0", "1"]
+    assert scheduler.queue_length(KEY) == 3
+    after = REGISTRY.get_sample_value("dhcp_refresh_queue_length", labels)
+    assert after - before == 3
+
+    mocker.patch("odr.refreshscheduler.time.time", return_value=1001.0)
+    scheduler._drain(KEY)
+    assert [c[1]["client_identifier"] for c in refresh.call_args_list] == [
+        "0",
+        "1",
+        "2",
+        "3",
+    ]
+    assert scheduler.queue_length(KEY) == 1
@@ -0,0 +1,151 @@
+import selectors
+import threading
+import time
+from socket import socketpair
+
+import pytest
+from prometheus_client import REGISTRY
+
+from odr.socketloop import SocketLoop
+
+
+class _Handler:
+    def __init__(self, sloop, sock, on_data=None):
+        self._sloop = sloop
+        self.socket = sock
+        self.received = []
+        self._on_data = on_data
+
+    def handle_socket(self):
+        self.received.append(self.socket.recv(1024))
+        if self._on_data is not None:
+            self._on_data(self)
+
+
+@pytest.fixture(params=["default", "select"])
+def sloop(request):
+    if request.param == "select":
+        return SocketLoop(selector=selectors.SelectSelector())
+    return SocketLoop()
+
+
+def _run_once(sloop):
+    sloop.add_idle_handler(sloop.quit)
+    sloop.run()
+    sloop.del_idle_handler(sloop.quit)
+    sloop._run = True
+
+
+def test_dispatch_to_ready_handler(sloop):
+    a_in, a_out = socketpair()
+    b_in, b_out = socketpair()
+    a = _Handler(sloop, a_out)
+    b = _Handler(sloop, b_out)
+    sloop.add_socket_handler(a)
+    sloop.add_socket_handler(b)
+    assert set(sloop.sockets) == {a_out, b_out}
+
+    b_in.send(b"hello")
+    _run_once(sloop)
+    assert a.received == []
+    assert b.received == [b"hello"]
+
+
+def test_del_handler_during_dispatch(sloop):
+    a_in, a_out = socketpair()
+    b_in, b_out = socketpair()
+    handlers = []
+
+    def remove_all(handler):
+        for h in handlers:
+            sloop.del_socket_handler(h)
+
+    handlers.append(_Handler(sloop, a_out, on_data=remove_all))
+    handlers.append(_Handler(sloop, b_out, on_data=remove_all))
+    for h in handlers:
+        sloop.add_socket_handler(h)
+
+    a_in.send(b"a")
+    b_in.send(b"b")
+    _run_once(sloop)
+    # Only the first handler got called, it removed the other one.
+    assert len(handlers[0].received + handlers[1].received) == 1
+    assert sloop.sockets == []
+
+
+def test_failing_handler_is_removed(sloop):
+    a_in, a_out = socketpair()
+
+    def fail(handler):
+        raise RuntimeError("boom")
+
+    sloop.add_socket_handler(_Handler(sloop, a_out, on_data=fail))
+    a_in.send(b"a")
+    _run_once(sloop)
+    assert sloop.sockets == []
+
+
+def test_del_handler_twice(sloop):
+    a_in, a_out = socketpair()
+
+    def remove_and_fail(handler):
+        sloop.del_socket_handler(handler)
+        raise RuntimeError("boom")
+
+    handler = _Handler(sloop, a_out, on_data=remove_and_fail)
+    sloop.add_socket_handler(handler)
+    a_in.send(b"a")
+    # The loop removes the failed handler again.
+    _run_once(sloop)
+    assert sloop.sockets == []
+    sloop.del_socket_handler(handler)
+
+
+def test_wait_until_deadline(sloop):
+    deadline = time.time() + 0.05
+    sloop.set_deadline_clb(lambda: deadline)
+    sloop.add_idle_handler(lambda: time.time() >= deadline and sloop.quit())
+    sloop.run()
+    assert time.time() >= deadline
+
+
+def test_quit_interrupts_indefinite_wait(sloop):
+    sloop.set_deadline_clb(lambda: None)
+    timer = threading.Timer(0.05, sloop.quit)
+    timer.start()
+    start = time.time()
+    sloop.run()
+    assert time.time() - start < 5
+
+
+def test_call_from_thread(sloop):
+    called = []
+
+    def clb():
+        called.append(threading.current_thread())
+        sloop.quit()
+
+    sloop.set_deadline_clb(lambda: None)
+    threading.Thread(target=sloop.call_from_thread, args=(clb,)).start()
+    sloop.run()
+    assert called == [threading.main_thread()]
+
+
+def test_handler_metrics(sloop, caplog):
+    a_in, a_out = socketpair()
+    label = {"handler": "_Handler"}
+    before = REGISTRY.get_sample_value("socketloop_handler_seconds_count", label)
+
+    sloop.slow_handler_threshold = 0.01
+    sloop.add_socket_handler(
+        _Handler(sloop, a_out, on_data=lambda handler: time.sleep(0.02))
+    )
+    a_in.send(b"a")
+    _run_once(sloop)
+
+    after = REGISTRY.get_sample_value("socketloop_handler_seconds_count", label)
+    assert after == (before or 0) + 1
+    assert "slow handler _Handler" in caplog.text
+    assert REGISTRY.get_sample_value(
+        "socketloop_handler_seconds_count", {"handler": "SocketLoop.quit"}
+    )
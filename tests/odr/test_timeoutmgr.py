@@ -0,0 +1,91 @@
+from unittest.mock import Mock
+
+import pytest
+
+from odr.timeoutmgr import TimeoutObject
+
+
+def test_timeouts_fire_in_order(timeout_mgr, mocker):
+    mocker.patch("time.time", return_value=1000.0)
+    fired = []
+    for t in [1003, 1001, 1002, 1001]:
+        timeout_mgr.add_abs_timeout(t, lambda t=t: fired.append(t))
+
+    timeout_mgr.check_timeouts()
+    assert fired == []
+
+    mocker.patch("time.time", return_value=1002.0)
+    timeout_mgr.check_timeouts()
+    assert fired == [1001, 1001, 1002]
+
+    mocker.patch("time.time", return_value=1010.0)
+    timeout_mgr.check_timeouts()
+    assert fired == [1001, 1001, 1002, 1003]
+
+
+def test_del_timeout_object(timeout_mgr, mocker):
+    mocker.patch("time.time", return_value=1000.0)
+    clb = Mock()
+    obj = timeout_mgr.add_rel_timeout(1, clb)
+    timeout_mgr.del_timeout_object(obj)
+    with pytest.raises(ValueError):
+        timeout_mgr.del_timeout_object(obj)
+
+    mocker.patch("time.time", return_value=1005.0)
+    timeout_mgr.check_timeouts()
+    clb.assert_not_called()
+
+
+def test_del_from_handler(timeout_mgr, mocker):
+    mocker.patch("time.time", return_value=1000.0)
+    second = Mock()
+    second_obj = TimeoutObject(1001, second)
+    timeout_mgr.add_abs_timeout(
+        1000.5, lambda: timeout_mgr.del_timeout_object(second_obj)
+    )
+    timeout_mgr.add_timeout_object(second_obj)
+
+    mocker.patch("time.time", return_value=1002.0)
+    timeout_mgr.check_timeouts()
+    second.assert_not_called()
+
+
+def test_added_from_handler_waits_for_next_check(timeout_mgr, mocker):
+    mocker.patch("time.time", return_value=1000.0)
+    fired = []
+
+    def readd():
+        fired.append(1)
+        timeout_mgr.add_rel_timeout(0, readd)
+
+    timeout_mgr.add_rel_timeout(0, readd)
+    timeout_mgr.check_timeouts()
+    assert fired == [1]
+    timeout_mgr.check_timeouts()
+    assert fired == [1, 1]
+
+
+def test_compaction(timeout_mgr, mocker):
+    mocker.patch("time.time", return_value=1000.0)
+    objs = [timeout_mgr.add_rel_timeout(i, Mock()) for i in range(200)]
+    for obj in objs[:150]:
+        timeout_mgr.del_timeout_object(obj)
+    assert len(timeout_mgr._heap) < 200
+
+    mocker.patch("time.time", return_value=2000.0)
+    timeout_mgr.check_timeouts()
+    for obj in objs[:150]:
+        obj._timeout_func.assert_not_called()
+    for obj in objs[150:]:
+        obj._timeout_func.assert_called_once_with()
+    assert timeout_mgr._heap == []
+    assert timeout_mgr._num_cancelled == 0
+
+
+def test_next_timeout_time(timeout_mgr):
+    assert timeout_mgr.next_timeout_time() is None
+    first = timeout_mgr.add_abs_timeout(1001, Mock())
+    timeout_mgr.add_abs_timeout(1002, Mock())
+    assert timeout_mgr.next_timeout_time() == 1001
+    timeout_mgr.del_timeout_object(first)
+    assert timeout_mgr.next_timeout_time() == 1002
@@ -1,4 +1,12 @@
-from odr.ovpn import determine_daemon_name
+import socket
+import time
+from unittest.mock import Mock
+
+import pytest
+from prometheus_client import REGISTRY
+
+from odr.linesocket import LineSocket
+from odr.ovpn import OvpnServer, OvpnServerSupervisor, determine_daemon_name
 
 
 def test_daemon_name_env(mocker):
@@ -16,3 +24,318 @@ def test_daemon_name_argv(mocker):
     # no underscores
     mocker.patch("sys.argv", ["/test/testdaemonname"])
     assert determine_daemon_name("test") is None
+
+
+@pytest.fixture()
+def server(mocker):
+    mocker.patch.object(OvpnServer, "connect_to_mgmt")
+    server = OvpnServer(Mock(), name="vpn1", socket_fn="/nonexistent", client_auth=True)
+    mgmt, peer = socket.socketpair()
+    server._socket = LineSocket(mgmt)
+    yield server, peer
+    peer.close()
+
+
+def test_client_events(server):
+    server, peer = server
+    events = []
+    server.add_client_event_handler(lambda srv, event: events.append(event))
+    peer.sendall(
+        b">CLIENT:CONNECT,5,1\r\n"
+        b">CLIENT:ENV,common_name=user@realm\r\n"
+        b">CLIENT:ENV,untrusted_ip=192.0.2.1\r\n"
+        b">CLIENT:ADDRESS,4,10.0.0.2,1\r\n"
+        b">CLIENT:ENV,END\r\n"
+        b">CLIENT:REAUTH,6,2\r\n"
+    )
+    server.handle_socket()
+    assert len(events) == 1
+    assert (events[0].event_type, events[0].cid, events[0].kid) == ("CONNECT", 5, 1)
+    assert events[0].common_name == "user@realm"
+    assert events[0].env["untrusted_ip"] == "192.0.2.1"
+
+    peer.sendall(b">CLIENT:ENV,END\r\n")
+    server.handle_socket()
+    assert events[1].event_type == "REAUTH"
+
+
+def test_client_auth_commands(server):
+    server, peer = server
+    server.client_auth(5, 1, ["ifconfig-push 10.0.0.2 255.255.255.0", 'push "a b"'])
+    server.client_deny(6, 2, 'DHCP "failed"')
+    assert peer.recv(1024) == (
+        b"client-auth 5 1\n"
+        b"ifconfig-push 10.0.0.2 255.255.255.0\n"
+        b'push "a b"\n'
+        b"END\n"
+        b"client-deny 6 2 \"DHCP 'failed'\"\n"
+    )
+
+
+def test_poll_client_list(server):
+    server, peer = server
+    clients = []
+    done = []
+    server.poll_client_list(
+        lambda common_name, address: clients.append((common_name, address)),
+        lambda: done.append(True),
+    )
+    assert peer.recv(1024) == b"status 2\n"
+    peer.sendall(
+        b"TITLE,OpenVPN 2.4.7 x86_64-pc-linux-gnu\r\n"
+        b"HEADER,CLIENT_LIST,Common Name,Real Address,Virtual Address,...\r\n"
+        b"CLIENT_LIST,user1@realm,192.0.2.1:1194,10.0.0.2,,1,2,now,0,user1,0,0\r\n"
+        b"CLIENT_LIST,user2@realm,192.0.2.2:1194,,,1,2,now,0,user2,1,1\r\n"
+        b"CLIENT_LIST,broken\r\n"
+        b"CLIENT_LIST,user3@realm,192.0.2.3:1194,10."
+    )
+    server.handle_socket()
+    assert clients == [("user1@realm", "10.0.0.2"), ("user2@realm", None)]
+    assert not done
+
+    peer.sendall(b"0.0.4,,1,2,now,0,user3,2,2\r\nEND\r\n")
+    server.handle_socket()
+    assert clients[2:] == [("user3@realm", "10.0.0.4")]
+    assert done == [True]
+
+
+def test_client_state_events(server):
+    server, peer = server
+    events = []
+    names = []
+    server.add_client_event_handler(lambda srv, event: events.append(event))
+    server.add_client_event_handler(lambda srv, event: names.append(event.common_name))
+    peer.sendall(
+        b">CLIENT:ESTABLISHED,7\r\n"
+        b">CLIENT:ENV,common_name=user@realm\r\n"
+        b">CLIENT:ENV,ifconfig_pool_remote_ip=10.0.0.2\r\n"
+        b">CLIENT:ENV,END\r\n"
+        b">CLIENT:DISCONNECT,7\r\n"
+        b">CLIENT:ENV,common_name=user@realm\r\n"
+        b">CLIENT:ENV,END\r\n"
+    )
+    server.handle_socket()
+    assert [(event.event_type, event.cid) for event in events] == [
+        ("ESTABLISHED", 7),
+        ("DISCONNECT", 7),
+    ]
+    assert events[0].virtual_address == "10.0.0.2"
+    assert events[1].virtual_address is None
+    assert names == ["user@realm", "user@realm"]
+
+
+def _recv_cmds(peer):
+    data = b""
+    peer.settimeout(0.1)
+    try:
+        while True:
+            chunk = peer.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+    except socket.timeout:
+        pass
+    return data.splitlines()
+
+
+def test_pipelined_commands(server):
+    server, peer = server
+    clients = []
+    done = []
+    server.poll_client_list(
+        lambda common_name, address: clients.append(common_name),
+        lambda: done.append(True),
+    )
+    server.disconnect_client("user1@realm")
+    server.disconnect_client("user2@realm")
+    # All commands are sent before the first response arrives.
+    assert _recv_cmds(peer) == [
+        b"status 2",
+        b'kill "user1@realm"',
+        b'kill "user2@realm"',
+    ]
+
+    peer.sendall(
+        b"CLIENT_LIST,user1@realm,192.0.2.1:1194,10.0.0.2,,1,2,now,0,user1,0,0\r\n"
+        b"END\r\n"
+        b"SUCCESS: common name 'user1@realm' found, 1 client(s) killed\r\n"
+    )
+    server.handle_socket()
+    assert clients == ["user1@realm"]
+    assert done == [True]
+    assert server._pending_kills == {"user2@realm"}
+
+    peer.sendall(b"ERROR: common name 'user2@realm' not found\r\n")
+    server.handle_socket()
+    assert not server._pending_kills
+    assert len(server._cmd_state) == 0
+
+
+def test_coalesced_kills(server):
+    server, peer = server
+    server.disconnect_client("user1@realm")
+    server.disconnect_client("user1@realm")
+    assert _recv_cmds(peer) == [b'kill "user1@realm"']
+
+    peer.sendall(b"SUCCESS: common name 'user1@realm' found, 1 client(s) killed\r\n")
+    server.handle_socket()
+    server.disconnect_client("user1@realm")
+    assert _recv_cmds(peer) == [b'kill "user1@realm"']
+
+
+def test_cmds_in_flight_limit(server):
+    server, peer = server
+    names = ["user{}@realm".format(index) for index in range(20)]
+    for name in names:
+        server.disconnect_client(name)
+    limit = OvpnServer.MAX_CMDS_IN_FLIGHT
+    assert _recv_cmds(peer) == [b'kill "%s"' % name.encode() for name in names[:limit]]
+
+    peer.sendall(b"SUCCESS: 1 client(s) killed\r\n" * 2)
+    server.handle_socket()
+    assert _recv_cmds(peer) == [
+        b'kill "%s"' % name.encode() for name in names[limit : limit + 2]
+    ]
+    assert len(server._cmd_state) == limit
+
+
+def _mgmt_metric(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+def test_connect_to_mgmt(tmp_path):
+    path = str(tmp_path / "mgmt.sock")
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(1)
+    successes = _mgmt_metric(
+        "ovpn_mgmt_connect_count_total", server="vpn-connect", result="success"
+    )
+
+    server = OvpnServer(Mock(), name="vpn-connect", socket_fn=path)
+    assert server.connected
+    assert not server.established
+    assert not server.socket._socket.getblocking()
+    peer, _ = listener.accept()
+    peer.sendall(b">INFO:OpenVPN Management Interface Version 1\r\n")
+    server.handle_socket()
+    assert server.established
+    assert _mgmt_metric("ovpn_mgmt_connected", server="vpn-connect") == 1
+    assert (
+        _mgmt_metric(
+            "ovpn_mgmt_connect_count_total", server="vpn-connect", result="success"
+        )
+        == successes + 1
+    )
+
+    peer.close()
+    server.handle_socket()
+    assert not server.connected
+    assert _mgmt_metric("ovpn_mgmt_connected", server="vpn-connect") == 0
+    assert _mgmt_metric("ovpn_mgmt_disconnect_count_total", server="vpn-connect") >= 1
+    listener.close()
+
+
+def test_connect_to_mgmt_failure(tmp_path):
+    failures = _mgmt_metric(
+        "ovpn_mgmt_connect_count_total", server="vpn-missing", result="failure"
+    )
+    server = OvpnServer(
+        Mock(), name="vpn-missing", socket_fn=str(tmp_path / "missing.sock")
+    )
+    assert not server.connected
+    assert (
+        _mgmt_metric(
+            "ovpn_mgmt_connect_count_total", server="vpn-missing", result="failure"
+        )
+        == failures + 1
+    )
+
+
+def test_connect_to_mgmt_backlog_full(tmp_path):
+    path = str(tmp_path / "mgmt.sock")
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(0)
+    pending = []
+    while True:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        pending.append(sock)
+        try:
+            sock.connect(path)
+        except BlockingIOError:
+            break
+    failures = _mgmt_metric(
+        "ovpn_mgmt_connect_count_total", server="vpn-busy", result="failure"
+    )
+
+    # Fails right away instead of blocking or hanging in progress.
+    server = OvpnServer(Mock(), name="vpn-busy", socket_fn=path)
+    assert not server.connected
+    assert (
+        _mgmt_metric(
+            "ovpn_mgmt_connect_count_total", server="vpn-busy", result="failure"
+        )
+        == failures + 1
+    )
+    for sock in pending:
+        sock.close()
+    listener.close()
+
+
+class _FakeServer:
+    def __init__(self):
+        self.connected = False
+        self.established = False
+        self.connects = 0
+        self.closes = 0
+
+    def connect_to_mgmt(self):
+        self.connects += 1
+
+    def close_mgmt(self):
+        self.closes += 1
+        self.connected = False
+
+
+def test_supervisor_backoff():
+    timeout_mgr = Mock()
+    server = _FakeServer()
+    supervisor = OvpnServerSupervisor(timeout_mgr, server, timeout=30, max_timeout=100)
+
+    def next_delay():
+        supervisor.handle_timeout()
+        return supervisor.timeout_time - time.time()
+
+    assert 29 < supervisor.timeout_time - time.time() <= 30
+    delays = [next_delay() for _ in range(5)]
+    assert server.connects == 5
+    for delay, max_delay in zip(delays, [30, 60, 100, 100, 100]):
+        assert max_delay / 2 - 1 < delay <= max_delay
+
+    # A connection that wasn't greeted in time is given up.
+    server.connected = True
+    next_delay()
+    assert server.closes == 1
+    assert server.connects == 6
+
+    server.connected = server.established = True
+    assert 29 < next_delay() <= 30
+    assert server.connects == 6
+
+
+def test_send_failure_mid_command(server):
+    server, peer = server
+    for index in range(OvpnServer.MAX_CMDS_IN_FLIGHT):
+        server.disconnect_client("user{}@realm".format(index))
+    server.client_auth(5, 1, ["ifconfig-push 10.0.0.2 255.255.255.0"])
+    _recv_cmds(peer)
+    # The management console stops accepting commands after the first line of
+    # the held back client-auth command.
+    server._socket.sendall = Mock(side_effect=[None, BlockingIOError()])
+
+    peer.sendall(b"SUCCESS: 1 client(s) killed\r\n" * 2)
+    server.handle_socket()
+    assert not server.connected
+    assert server._sloop.del_socket_handler.call_count == 1